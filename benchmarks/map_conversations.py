@@ -0,0 +1,101 @@
+"""
+Time mapping the conversations of a ChatGPT web account against a local
+fake backend, fetching histories one at a time versus concurrently
+
+Usage: python benchmarks/map_conversations.py
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+from revChatGPT.V1 import AsyncChatbot  # noqa: E402
+from revChatGPT.V1 import Chatbot  # noqa: E402
+
+CONVERSATIONS = 120
+# Seconds the backend takes to answer a history request
+HISTORY_DELAY = 0.03
+
+
+class Backend(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        if url.path == "/conversations":
+            query = parse_qs(url.query)
+            offset, limit = int(query["offset"][0]), int(query["limit"][0])
+            end = min(offset + limit, CONVERSATIONS)
+            body = {
+                "items": [{"id": f"c{index}"} for index in range(offset, end)],
+                "total": CONVERSATIONS,
+            }
+        else:
+            time.sleep(HISTORY_DELAY)
+            body = {"current_node": "node-" + url.path.rsplit("/", 1)[-1]}
+        content = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def map_serially(chatbot: Chatbot) -> None:
+    """
+    One history request after the other, as __map_conversations used to
+    """
+    offset = 0
+    while True:
+        conversations = chatbot.get_conversations(offset=offset, limit=50)
+        for conversation in conversations:
+            history = chatbot.get_msg_history(conversation["id"])
+            chatbot.conversation_mapping[conversation["id"]] = history["current_node"]
+        if len(conversations) < 50:
+            return
+        offset += 50
+
+
+def main() -> None:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Backend)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/"
+    config = {"access_token": "a.b.c"}
+    print(f"{CONVERSATIONS} conversations, {HISTORY_DELAY * 1e3:.0f} ms per history")
+
+    chatbot = Chatbot(dict(config), base_url=base_url)
+    started = time.perf_counter()
+    map_serially(chatbot)
+    print(f"serial       {time.perf_counter() - started:6.2f} s")
+
+    chatbot.conversation_mapping.clear()
+    started = time.perf_counter()
+    chatbot._Chatbot__map_conversations()
+    assert len(chatbot.conversation_mapping) == CONVERSATIONS
+    print(f"Chatbot      {time.perf_counter() - started:6.2f} s")
+
+    async def map_async() -> None:
+        chatbot = AsyncChatbot(dict(config), base_url=base_url)
+        started = time.perf_counter()
+        await chatbot._AsyncChatbot__map_conversations()
+        assert len(chatbot.conversation_mapping) == CONVERSATIONS
+        print(f"AsyncChatbot {time.perf_counter() - started:6.2f} s")
+
+    asyncio.run(map_async())
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Measure the memory of V3 messages as dicts and as store.Message objects
+
+Content strings are shared between both, so only the containers count.
+
+Usage: python benchmarks/message_memory.py
+"""
+from __future__ import annotations
+
+import sys
+import tracemalloc
+from pathlib import Path
+from typing import Callable
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+from revChatGPT.store import Message  # noqa: E402
+
+MESSAGES = 100_000
+
+
+def bytes_per_message(make: Callable[[str, str], object]) -> float:
+    contents = [f"message number {index}" for index in range(MESSAGES)]
+    roles = ["user", "assistant"]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    messages = [make(roles[index % 2], contents[index]) for index in range(MESSAGES)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(messages) == MESSAGES
+    # Leave out the slot of each message in the list
+    return (after - before) / MESSAGES - 8
+
+
+def main() -> None:
+    as_dict = bytes_per_message(
+        lambda role, content: {"role": role, "content": content}
+    )
+    as_message = bytes_per_message(Message)
+    print(f"Python {sys.version.split()[0]}, {MESSAGES} messages")
+    print(f"dict     {as_dict:6.1f} bytes/message")
+    print(
+        f"Message  {as_message:6.1f} bytes/message  ({as_message / as_dict - 1:+.0%})"
+    )
+
+
+if __name__ == "__main__":
+    main()
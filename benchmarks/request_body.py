@@ -0,0 +1,61 @@
+"""
+Time encoding V3 request bodies with json=body versus encode_body, with the
+history already encoded by earlier turns
+
+Usage: python benchmarks/request_body.py
+"""
+from __future__ import annotations
+
+import json
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+from revChatGPT import request_body  # noqa: E402
+from revChatGPT.request_body import encode_body  # noqa: E402
+from revChatGPT.store import Message  # noqa: E402
+
+PARAMETERS = {
+    "model": "gpt-3.5-turbo",
+    "stream": True,
+    "temperature": 0.5,
+    "top_p": 1.0,
+    "presence_penalty": 0.0,
+    "frequency_penalty": 0.0,
+    "n": 1,
+    "user": "user",
+    "max_tokens": 4000,
+}
+# About 120 tokens
+TEXT = "lorem ipsum dolor sit amet " * 20
+
+
+def main() -> None:
+    encoder = "orjson" if request_body.dumps.__module__ == "orjson" else "json"
+    print(f"JSON encoder: {encoder}")
+    print(" msgs  body    json=body  encode_body")
+    for length in (10, 100, 250, 1000):
+        messages = [
+            Message("user" if index % 2 else "assistant", f"{index} {TEXT}")
+            for index in range(length)
+        ]
+        old_body = {
+            **PARAMETERS,
+            "messages": [message.to_dict() for message in messages],
+        }
+        new_body = {**PARAMETERS, "messages": messages}
+        size = len(encode_body(new_body))
+        rounds = 200
+        old = timeit.timeit(lambda: json.dumps(old_body).encode(), number=rounds)
+        new = timeit.timeit(lambda: encode_body(new_body), number=rounds)
+        old, new = old / rounds, new / rounds
+        print(
+            f"{length:5d}  {size / 1e3:4.0f} kB  {old * 1e6:7.1f} us  {new * 1e6:7.1f} us"
+            f"  x{old / new:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Compare the shared SSE decoder with the line parsers V1 and V3 used before
+
+The stream is a recorded-like completion of 20k events cut into 1 KiB
+chunks. Event.json() uses orjson or msgspec when installed, so run this
+with and without them.
+
+Usage: python benchmarks/sse.py
+"""
+from __future__ import annotations
+
+import io
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Callable
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+import httpx  # noqa: E402
+import requests  # noqa: E402
+from revChatGPT import sse  # noqa: E402
+from revChatGPT.sse import iter_events  # noqa: E402
+
+EVENT = (
+    b'data: {"id":"chatcmpl-1","object":"chat.completion.chunk","created":1,'
+    b'"model":"gpt-3.5-turbo","choices":[{"index":0,"delta":{"content":" word"},'
+    b'"finish_reason":null}]}\n\n'
+)
+STREAM = EVENT * 20000 + b"data: [DONE]\n\n"
+CHUNKS = [STREAM[start : start + 1024] for start in range(0, len(STREAM), 1024)]
+
+
+def old_v3() -> None:
+    """
+    V3 before: httpx iter_lines, then a slice and json.loads per line
+    """
+    response = httpx.Response(200, content=iter(CHUNKS))
+    for line in response.iter_lines():
+        line = line.strip()
+        if not line:
+            continue
+        line = line[6:]
+        if line == "[DONE]":
+            break
+        json.loads(line)
+
+
+def new_v3() -> None:
+    response = httpx.Response(200, content=iter(CHUNKS))
+    for event in iter_events(response.iter_bytes()):
+        if event.data == "[DONE]":
+            break
+        event.json()
+
+
+def old_v1() -> None:
+    """
+    V1 before: requests iter_lines, str(bytes) and three replace() passes
+    """
+    response = requests.Response()
+    response.raw = io.BytesIO(STREAM)
+    response.status_code = 200
+    for line in response.iter_lines():
+        line = str(line)[2:-1]
+        if line.lower() == "internal server error":
+            raise ValueError(line)
+        if not line:
+            continue
+        if "data: " in line:
+            line = line[6:]
+        if line == "[DONE]":
+            break
+        line = line.replace('\\"', '"').replace("\\'", "'").replace("\\\\", "\\")
+        json.loads(line)
+
+
+def new_v1() -> None:
+    response = requests.Response()
+    response.raw = io.BytesIO(STREAM)
+    response.status_code = 200
+    for event in iter_events(response.iter_content(chunk_size=None), raw_lines=True):
+        if event.data == "[DONE]":
+            break
+        event.json()
+
+
+def compare(old: Callable[[], None], new: Callable[[], None]) -> tuple[float, float]:
+    """
+    Best times of both parsers, run in turns so both see the same load
+    """
+    times: dict[Callable, list[float]] = {old: [], new: []}
+    for _ in range(15):
+        for parse in (old, new):
+            started = time.perf_counter()
+            parse()
+            times[parse].append(time.perf_counter() - started)
+    return min(times[old]), min(times[new])
+
+
+def main() -> None:
+    print(f"JSON decoder: {sse.loads.__module__}")
+    for name, old, new in (("V3", old_v3, new_v3), ("V1", old_v1, new_v1)):
+        before, after = compare(old, new)
+        print(
+            f"{name}  before {before * 1e3:6.1f} ms  after {after * 1e3:6.1f} ms"
+            f"  x{before / after:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Time truncating long V3 conversations to a small token limit
+
+Usage: python benchmarks/truncation.py
+"""
+from __future__ import annotations
+
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+import tiktoken  # noqa: E402
+import tiktoken.model  # noqa: E402
+from revChatGPT.V3 import Chatbot  # noqa: E402
+
+
+class WordEncoding:
+    """
+    Counts words as tokens, so no BPE ranks are downloaded
+    """
+
+    name = "words"
+
+    def encode(self, text: str) -> list[str]:
+        return text.split()
+
+    def encode_batch(self, texts: list[str], num_threads: int = 8) -> list[list[str]]:
+        return [text.split() for text in texts]
+
+
+def truncate(length: int, limit: int = 200) -> float:
+    """
+    Seconds to truncate a conversation of length messages down to limit
+    """
+    chatbot = Chatbot("key", max_tokens=10**6, truncate_limit=limit)
+    chatbot.reset()
+    for index in range(length):
+        role = "user" if index % 2 else "assistant"
+        chatbot.add_to_conversation(f"message {index} " * 10, role)
+    started = time.perf_counter()
+    chatbot._Chatbot__truncate_conversation()
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    tiktoken.get_encoding = lambda name: WordEncoding()
+    tiktoken.encoding_for_model = (
+        tiktoken.model.encoding_for_model
+    ) = lambda engine: WordEncoding()
+    for length in (1000, 4000, 16000):
+        best = min(truncate(length) for _ in range(5))
+        print(f"{length:6d} messages  {best * 1e3:7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
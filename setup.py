@@ -34,8 +34,9 @@ setup(
     package_data={"": ["*.json"]},
     install_requires=[
         "OpenAIAuth>=3.0.0",
+        "anyio>=3.0.0",
         "requests[socks]",
-        "httpx[socks]",
+        "httpx[socks,http2]>=0.26",
         "prompt-toolkit",
         "tiktoken>=0.3.0",
         "openai",
@@ -3,16 +3,22 @@ Standard ChatGPT
 """
 from __future__ import annotations
 
+import asyncio
 import base64
-import binascii
+import collections
 import contextlib
+import inspect
 import json
 import logging
+import reprlib
 import secrets
 import subprocess
 import sys
+import threading
 import time
 import uuid
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from os import environ
 from os import getenv
@@ -35,11 +41,22 @@ import httpx
 import requests
 from httpx import AsyncClient
 from OpenAIAuth import Auth0 as Authenticator
-from rich.live import Live
-from rich.markdown import Markdown
 
 from . import __version__
 from . import typings as t
+from .metrics import measure
+from .sse import aiter_events
+from .sse import iter_events
+from .sse import JSONDecodeError
+from .streaming import CancelToken
+from .streaming import cut_at_stop
+from .streaming import Deadline
+from .streaming import timed
+from .streaming import within
+from .token_cache import decode_jwt_exp
+from .token_cache import get_token_cache
+from .transport import AsyncRequestTrace
+from .transport import get_transport
 from .utils import create_completer
 from .utils import create_session
 from .utils import get_input
@@ -81,6 +98,10 @@ log = logging.getLogger(__name__)
 def logger(is_timed: bool) -> function:
     """Logger decorator
 
+    Generator functions are timed until the generator is exhausted or
+    closed rather than until it is created. Arguments and return values
+    are abbreviated, and nothing is formatted unless debug logging is on.
+
     Args:
         is_timed (bool): Whether to include function running time in exit log
 
@@ -89,27 +110,53 @@ def logger(is_timed: bool) -> function:
     """
 
     def decorator(func: function) -> function:
-        wraps(func)
-
-        def wrapper(*args, **kwargs):
+        def log_entry(args: tuple, kwargs: dict) -> float:
             log.debug(
                 "Entering %s with args %s and kwargs %s",
                 func.__name__,
-                args,
-                kwargs,
+                reprlib.repr(args),
+                reprlib.repr(kwargs),
             )
-            start = time.time()
-            out = func(*args, **kwargs)
-            end = time.time()
+            return time.perf_counter()
+
+        def log_exit(start: float, out: object) -> None:
             if is_timed:
                 log.debug(
                     "Exiting %s with return value %s. Took %s seconds.",
                     func.__name__,
-                    out,
-                    end - start,
+                    reprlib.repr(out),
+                    time.perf_counter() - start,
                 )
             else:
-                log.debug("Exiting %s with return value %s", func.__name__, out)
+                log.debug(
+                    "Exiting %s with return value %s",
+                    func.__name__,
+                    reprlib.repr(out),
+                )
+
+        if inspect.isgeneratorfunction(func):
+
+            @wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                if not log.isEnabledFor(logging.DEBUG):
+                    return (yield from func(*args, **kwargs))
+                start = log_entry(args, kwargs)
+                out = None
+                try:
+                    out = yield from func(*args, **kwargs)
+                finally:
+                    log_exit(start, out)
+                return out
+
+            return generator_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not log.isEnabledFor(logging.DEBUG):
+                return func(*args, **kwargs)
+            start = log_entry(args, kwargs)
+            out = func(*args, **kwargs)
+            log_exit(start, out)
             return out
 
         return wrapper
@@ -150,14 +197,24 @@ def captcha_solver(images: list[str], challenge_details: dict) -> int:
 
 
 CAPTCHA_URL = getenv("CAPTCHA_URL", "https://bypass.churchless.tech/captcha/")
+# Uptime of the Arkose token endpoints, served by gatus
+ARKOSE_STATUS_URL = getenv(
+    "ARKOSE_STATUS_URL",
+    "https://stats.churchless.tech/api/v1/endpoints/statuses?page=1",
+)
 
 
-def get_arkose_token(
-    download_images: bool = True,
-    solver: function = captcha_solver,
-    captcha_supported: bool = True,
-) -> str:
+class ArkoseTokenProvider:
     """
+    Hands out Arkose tokens for gpt-4 requests
+
+    A small pool of tokens is fetched ahead of use and refilled in the
+    background after each token is taken, so requests rarely wait on the
+    captcha service. The health of the token endpoints is cached for
+    health_ttl seconds instead of being downloaded for every token.
+    Async fetches go through the shared transport of the proxy, which
+    pools one client per event loop.
+
     The solver function should take in a list of images in base64 and a dict of challenge details
     and return the index of the image that matches the challenge details
 
@@ -166,10 +223,247 @@ def get_arkose_token(
         instructions: str - Instructions for the captcha
         URLs: list[str] - URLs of the images or audio files
     """
-    if captcha_supported:
-        resp = requests.get(
+
+    def __init__(
+        self,
+        solver: function = captcha_solver,
+        download_images: bool = True,
+        captcha_supported: bool = False,
+        pool_size: int = 2,
+        token_ttl: float = 120,
+        health_ttl: float = 60,
+        proxy: str | None = None,
+    ) -> None:
+        """Initialize a token provider
+
+        Args:
+            solver (function, optional): Function to solve captcha. Defaults to captcha_solver.
+            download_images (bool, optional): Whether to download captcha images. Defaults to True.
+            captcha_supported (bool, optional): Get tokens by solving captchas instead of from the public endpoints. Defaults to False.
+            pool_size (int, optional): Number of tokens to keep ready. Defaults to 2.
+            token_ttl (float, optional): Seconds a pooled token stays usable. Defaults to 120.
+            health_ttl (float, optional): Seconds to cache endpoint health for. Defaults to 60.
+            proxy (str | None, optional): Proxy URL for all token traffic. Defaults to None.
+        """
+        self.solver = solver
+        self.download_images = download_images
+        self.captcha_supported = captcha_supported
+        self.pool_size = pool_size
+        self.token_ttl = token_ttl
+        self.health_ttl = health_ttl
+        self.session = requests.Session()
+        if proxy:
+            self.session.proxies.update({"http": proxy, "https": proxy})
+        self.transport = get_transport(proxy=proxy)
+        self.pool: collections.deque[tuple[str, float]] = collections.deque()
+        # Guards the pool and the endpoints, shared with the refill thread
+        self.__lock = threading.Lock()
+        self.__refill_thread: threading.Thread | None = None
+        self.__refill_task: asyncio.Task | None = None
+        self.__endpoints: list[str] = []
+        self.__endpoints_checked: float = 0.0
+
+    def __take(self) -> str | None:
+        with self.__lock:
+            while self.pool:
+                token, fetched = self.pool.popleft()
+                if time.monotonic() - fetched < self.token_ttl:
+                    return token
+        return None
+
+    def __put(self, token: str) -> bool:
+        """
+        Add a token to the pool unless it is full, and tell if it was
+        """
+        with self.__lock:
+            if len(self.pool) >= self.pool_size:
+                return False
+            self.pool.append((token, time.monotonic()))
+            return True
+
+    def __pool_full(self) -> bool:
+        with self.__lock:
+            return len(self.pool) >= self.pool_size
+
+    def get_token(self) -> str:
+        """Get a token, from the pool if possible
+
+        Returns:
+            str: Arkose token
+        """
+        token = self.__take() or self.fetch()
+        self.prefetch()
+        return token
+
+    async def get_token_async(self) -> str:
+        """Get a token, from the pool if possible, without blocking the event loop
+
+        Returns:
+            str: Arkose token
+        """
+        token = self.__take() or await self.fetch_async()
+        self.prefetch_async()
+        return token
+
+    def prefetch(self) -> None:
+        """
+        Refill the pool in a background thread
+        """
+        with self.__lock:
+            if self.__refill_thread is not None and self.__refill_thread.is_alive():
+                return
+            self.__refill_thread = threading.Thread(
+                target=self.__refill,
+                name="revChatGPT-arkose",
+                daemon=True,
+            )
+            self.__refill_thread.start()
+
+    def prefetch_async(self) -> None:
+        """
+        Refill the pool in a task on the running event loop
+        """
+        if self.__refill_task is not None and not self.__refill_task.done():
+            return
+        self.__refill_task = asyncio.get_running_loop().create_task(
+            self.__refill_async(),
+        )
+
+    def __refill(self) -> None:
+        while not self.__pool_full():
+            try:
+                token = self.fetch(interactive=False)
+            except Exception as error:
+                log.debug("Could not prefetch an Arkose token: %s", error)
+                return
+            if not self.__put(token):
+                return
+
+    async def __refill_async(self) -> None:
+        while not self.__pool_full():
+            try:
+                token = await self.fetch_async(interactive=False)
+            except Exception as error:
+                log.debug("Could not prefetch an Arkose token: %s", error)
+                return
+            if not self.__put(token):
+                return
+
+    def __pick_endpoints(self, statuses: list[dict]) -> list[str]:
+        working_endpoints: list[str] = []
+        for endpoint in statuses:
+            if endpoint.get("group") != "Arkose Labs":
+                continue
+            # Check the last 5 results
+            results: list[dict] = endpoint.get("results", [])[-5:-1]
+            if not results:
+                log.debug("Endpoint %s has no results", endpoint.get("name"))
+                continue
+            # Check if all the results are up
+            if all(result.get("success") is True for result in results):
+                working_endpoints.append(endpoint.get("name"))
+        with self.__lock:
+            self.__endpoints = working_endpoints
+            self.__endpoints_checked = time.monotonic()
+        return working_endpoints
+
+    def __fresh_endpoints(self) -> list[str] | None:
+        """
+        The working endpoints, None if their health is out of date
+        """
+        with self.__lock:
+            if time.monotonic() - self.__endpoints_checked < self.health_ttl:
+                return self.__endpoints
+        return None
+
+    def __check_interactive(self, interactive: bool) -> None:
+        if not interactive:
+            raise t.Error(
+                source="ArkoseTokenProvider",
+                message="Captcha required",
+                code=t.ErrorType.CLOUDFLARE_ERROR,
+            )
+
+    def fetch(self, interactive: bool = True) -> str:
+        """Get a new token
+
+        Args:
+            interactive (bool, optional): Whether a captcha may be solved. Defaults to True.
+
+        Returns:
+            str: Arkose token
+        """
+        if self.captcha_supported:
+            return self.__solve(interactive)
+        endpoints = self.__fresh_endpoints()
+        if endpoints is None:
+            # Check uptime for different endpoints via gatus
+            endpoints = self.__pick_endpoints(
+                self.session.get(ARKOSE_STATUS_URL).json(),
+            )
+        if not endpoints:
+            self.__check_interactive(interactive)
+            log.warning(
+                "No working endpoints found. Please solve the captcha manually."
+            )
+            return self.__solve(interactive)
+        # Choose a random endpoint
+        resp = self.session.get(random.choice(endpoints))
+        if resp.status_code != 200:
+            if resp.status_code != 511:
+                raise Exception("Failed to get captcha token")
+            self.__check_interactive(interactive)
+            log.warning("Captcha required. Please solve the captcha manually.")
+            return self.__solve(interactive)
+        try:
+            return resp.json().get("token")
+        except Exception:
+            return resp.text
+
+    async def fetch_async(self, interactive: bool = True) -> str:
+        """Get a new token without blocking the event loop
+
+        Args:
+            interactive (bool, optional): Whether a captcha may be solved. Defaults to True.
+
+        Returns:
+            str: Arkose token
+        """
+        if self.captcha_supported:
+            return await asyncio.to_thread(self.__solve, interactive)
+        client = self.transport.aclient
+        endpoints = self.__fresh_endpoints()
+        if endpoints is None:
+            resp = await client.get(ARKOSE_STATUS_URL)
+            endpoints = self.__pick_endpoints(resp.json())
+        if not endpoints:
+            self.__check_interactive(interactive)
+            log.warning(
+                "No working endpoints found. Please solve the captcha manually."
+            )
+            return await asyncio.to_thread(self.__solve, interactive)
+        resp = await client.get(random.choice(endpoints))
+        if resp.status_code != 200:
+            if resp.status_code != 511:
+                raise Exception("Failed to get captcha token")
+            self.__check_interactive(interactive)
+            log.warning("Captcha required. Please solve the captcha manually.")
+            return await asyncio.to_thread(self.__solve, interactive)
+        try:
+            return resp.json().get("token")
+        except Exception:
+            return resp.text
+
+    async def aclose(self) -> None:
+        """
+        Close the async client of the running event loop
+        """
+        await self.transport.aclose()
+
+    def __solve(self, interactive: bool) -> str:
+        resp = self.session.get(
             (CAPTCHA_URL + "start?download_images=true")
-            if download_images
+            if self.download_images
             else CAPTCHA_URL + "start",
         )
         resp_json: dict = resp.json()
@@ -185,50 +479,245 @@ def get_arkose_token(
         if not challenge_details:
             raise Exception("missing details")
 
+        self.__check_interactive(interactive)
         images: list[str] = resp_json.get("images")
 
-        index = solver(images, challenge_details)
+        index = self.solver(images, challenge_details)
 
-        resp = requests.post(
+        resp = self.session.post(
             CAPTCHA_URL + "verify",
             json={"session": resp_json.get("session"), "index": index},
         )
         if resp.status_code != 200:
             raise Exception("Failed to verify captcha")
         return resp_json.get("token")
-    working_endpoints: list[str] = []
-    # Check uptime for different endpoints via gatus
-    resp2: list[dict] = requests.get(
-        "https://stats.churchless.tech/api/v1/endpoints/statuses?page=1",
-    ).json()
-    for endpoint in resp2:
-        # print(endpoint.get("name"))
-        if endpoint.get("group") != "Arkose Labs":
-            continue
-        # Check the last 5 results
-        results: list[dict] = endpoint.get("results", [])[-5:-1]
-        # print(results)
-        if not results:
-            print(f"Endpoint {endpoint.get('name')} has no results")
-            continue
-        # Check if all the results are up
-        if all(result.get("success") is True for result in results):
-            working_endpoints.append(endpoint.get("name"))
-    if not working_endpoints:
-        print("No working endpoints found. Please solve the captcha manually.")
-        return get_arkose_token(download_images=True, captcha_supported=True)
-    # Choose a random endpoint
-    endpoint = random.choice(working_endpoints)
-    resp: requests.Response = requests.get(endpoint)
-    if resp.status_code != 200:
-        if resp.status_code != 511:
-            raise Exception("Failed to get captcha token")
-        print("Captcha required. Please solve the captcha manually.")
-        return get_arkose_token(download_images=True, captcha_supported=True)
-    try:
-        return resp.json().get("token")
-    except Exception:
-        return resp.text
+
+
+def get_arkose_token(
+    download_images: bool = True,
+    solver: function = captcha_solver,
+    captcha_supported: bool = True,
+) -> str:
+    """
+    Get a single Arkose token. See ArkoseTokenProvider for pooled tokens.
+    """
+    return ArkoseTokenProvider(
+        solver=solver,
+        download_images=download_images,
+        captcha_supported=captcha_supported,
+        pool_size=0,
+    ).fetch()
+
+
+class AccessTokenRefresher:
+    """
+    Renews the access token of a Chatbot a margin before its JWT expires
+
+    Renewal logs in again with the chatbot's email and password on a
+    background thread or asyncio task, so requests never wait for it.
+    """
+
+    def __init__(
+        self,
+        chatbot: Chatbot,
+        margin: float = 300,
+        retry_interval: float = 60,
+    ) -> None:
+        """Set up a refresher. Call start or start_async to run it.
+
+        Args:
+            chatbot (Chatbot): Chatbot with email and password in its config
+            margin (float, optional): Seconds before expiry to renew at. Defaults to 300.
+            retry_interval (float, optional): Seconds to wait after a failed renewal. Defaults to 60.
+        """
+        self.chatbot = chatbot
+        self.margin = margin
+        self.retry_interval = retry_interval
+        self.refreshes: int = 0
+        self.failures: int = 0
+        self.last_latency: float | None = None
+        self.total_latency: float = 0.0
+        # Requests sent after the expiry of a token that was renewed early
+        self.saved_requests: int = 0
+        self.__replaced_expiry: float | None = None
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread: threading.Thread | None = None
+        self.__task: asyncio.Task | None = None
+
+    def seconds_until_refresh(self) -> float | None:
+        """
+        Seconds until the token is due for renewal, or None if it never expires
+        """
+        expires_at = self.chatbot.token_expires_at
+        if expires_at is None:
+            return None
+        return max(0.0, expires_at - self.margin - time.time())
+
+    def refresh(self) -> None:
+        """
+        Log in again and swap in the new access token
+        """
+        previous_expiry = self.chatbot.token_expires_at
+        start = time.perf_counter()
+        try:
+            self.chatbot.login()
+        except Exception:
+            with self.__lock:
+                self.failures += 1
+            raise
+        latency = time.perf_counter() - start
+        with self.__lock:
+            self.refreshes += 1
+            self.last_latency = latency
+            self.total_latency += latency
+            self.__replaced_expiry = previous_expiry
+        log.debug("Refreshed access token in %.2f seconds", latency)
+
+    def record_request(self) -> None:
+        """
+        Count a request that the replaced token could no longer have sent
+        """
+        if self.__replaced_expiry is not None and time.time() >= self.__replaced_expiry:
+            with self.__lock:
+                self.saved_requests += 1
+
+    def __next_delay(self, failed: bool, refreshed: bool) -> float | None:
+        if failed:
+            return self.retry_interval
+        delay = self.seconds_until_refresh()
+        if delay is not None and refreshed:
+            # Tokens that live shorter than the margin are renewed at most
+            # once per retry interval
+            delay = max(delay, self.retry_interval)
+        return delay
+
+    def __run(self) -> None:
+        failed = refreshed = False
+        while (delay := self.__next_delay(failed, refreshed)) is not None:
+            if self.__stop.wait(delay):
+                return
+            try:
+                self.refresh()
+                failed, refreshed = False, True
+            except Exception as error:
+                log.warning("Could not refresh access token: %s", error)
+                failed = True
+
+    async def __run_async(self) -> None:
+        failed = refreshed = False
+        while (delay := self.__next_delay(failed, refreshed)) is not None:
+            await asyncio.sleep(delay)
+            try:
+                await asyncio.to_thread(self.refresh)
+                failed, refreshed = False, True
+            except Exception as error:
+                log.warning("Could not refresh access token: %s", error)
+                failed = True
+
+    def start(self) -> None:
+        """
+        Renew tokens on a daemon thread
+        """
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stop.clear()
+        self.__thread = threading.Thread(
+            target=self.__run,
+            name="revChatGPT-token-refresh",
+            daemon=True,
+        )
+        self.__thread.start()
+
+    def start_async(self) -> asyncio.Task:
+        """
+        Renew tokens on a task of the running event loop
+        """
+        if self.__task is None or self.__task.done():
+            self.__task = asyncio.get_running_loop().create_task(self.__run_async())
+        return self.__task
+
+    def stop(self) -> None:
+        """
+        Stop renewing tokens
+        """
+        self.__stop.set()
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+
+    def to_dict(self) -> dict:
+        return {
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "last_latency": self.last_latency,
+            "average_latency": self.total_latency / self.refreshes
+            if self.refreshes
+            else None,
+            "saved_requests": self.saved_requests,
+        }
+
+
+STREAM_MODES = ("full", "delta")
+
+
+class DeltaTracker:
+    """
+    Turns the cumulative messages of a response into deltas
+
+    Each record keeps only the text added since the previous one. author,
+    citations and model are only included when they change.
+
+    reset is set when message is not added to the text so far but replaces
+    it: when a later message of the response starts, or when the server
+    rewrites the text instead of extending it. The first record of a
+    continuation extends the text of the message it continues.
+    """
+
+    def __init__(self) -> None:
+        self.parent_id: str | None = None
+        self.text: str = ""
+        self.metadata: dict = {}
+
+    def __call__(self, record: dict) -> dict:
+        reset = False
+        if record["parent_id"] != self.parent_id:
+            # A new message started, and replaces the one before it
+            reset = self.parent_id is not None
+            self.parent_id = record["parent_id"]
+            self.text = ""
+        message: str = record["message"]
+        delta = record.copy()
+        if message.startswith(self.text):
+            delta["message"] = message[len(self.text) :]
+        else:
+            delta["message"] = message
+            reset = True
+        delta["reset"] = reset
+        self.text = message
+        for key in ("author", "citations", "model"):
+            if key in self.metadata and self.metadata[key] == record[key]:
+                del delta[key]
+            else:
+                self.metadata[key] = record[key]
+        return delta
+
+
+def check_stream_mode(stream_mode: str) -> None:
+    """Make sure a stream mode is known
+
+    Args:
+        stream_mode (str): "full" or "delta"
+
+    Raises:
+        Error: Unknown stream mode
+    """
+    if stream_mode not in STREAM_MODES:
+        raise t.Error(
+            source="User",
+            message=f"stream_mode must be one of {STREAM_MODES}",
+            code=t.ErrorType.USER_ERROR,
+        )
 
 
 class Chatbot:
@@ -246,6 +735,8 @@ class Chatbot:
         base_url: str | None = None,
         captcha_solver: function = captcha_solver,
         captcha_download_images: bool = True,
+        auto_refresh: bool = False,
+        refresh_margin: float = 300,
     ) -> None:
         """Initialize a chatbot
 
@@ -264,6 +755,8 @@ class Chatbot:
             base_url (str | None, optional): Base URL of the ChatGPT server. Defaults to None.
             captcha_solver (function, optional): Function to solve captcha. Defaults to captcha_solver.
             captcha_download_images (bool, optional): Whether to download captcha images. Defaults to True.
+            auto_refresh (bool, optional): Renew the access token in the background before it expires. Needs email and password. Defaults to False.
+            refresh_margin (float, optional): Seconds before expiry to renew the access token at. Defaults to 300.
 
         Raises:
             Exception: _description_
@@ -279,9 +772,12 @@ class Chatbot:
             if not Path(user_home, ".config", "revChatGPT").exists():
                 Path(user_home, ".config", "revChatGPT").mkdir()
             self.cache_path = Path(user_home, ".config", "revChatGPT", "cache.json")
+        self.token_cache = get_token_cache(self.cache_path)
 
         self.config = config
         self.session = requests.Session()
+        self.token_expires_at: float | None = None
+        self.token_refresher: AccessTokenRefresher | None = None
         if "email" in config and "password" in config:
             try:
                 cached_access_token = self.__get_cached_access_token(
@@ -346,6 +842,23 @@ class Chatbot:
             pass
         self.captcha_solver = captcha_solver
         self.captcha_download_images = captcha_download_images
+        self.arkose = ArkoseTokenProvider(
+            solver=captcha_solver,
+            download_images=captcha_download_images,
+            proxy=config.get("proxy"),
+        )
+        if auto_refresh:
+            if "email" not in self.config or "password" not in self.config:
+                error = t.AuthenticationError(
+                    "Refreshing access tokens requires email and password",
+                )
+                raise error
+            self.token_refresher = AccessTokenRefresher(self, margin=refresh_margin)
+            self._start_token_refresher()
+
+    def _start_token_refresher(self) -> None:
+        """Renew tokens on a daemon thread"""
+        self.token_refresher.start()
 
     @logger(is_timed=True)
     def __check_credentials(self) -> None:
@@ -378,17 +891,26 @@ class Chatbot:
         Args:
             access_token (str): access_token
         """
-        self.session.headers.clear()
-        self.session.headers.update(
-            {
-                "Accept": "text/event-stream",
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/json",
-                "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/113.0.0.0 Safari/537.36",
-            },
-        )
+        headers = {
+            "Accept": "text/event-stream",
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+            "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/113.0.0.0 Safari/537.36",
+        }
+        if puid := self.session.headers.get("PUID"):
+            headers["PUID"] = puid
+        # Swap in complete headers at once so that requests sent from other
+        # threads never see them half updated
+        if isinstance(self.session, AsyncClient):
+            self.session.headers = headers
+        else:
+            self.session.headers = requests.structures.CaseInsensitiveDict(headers)
 
         self.config["access_token"] = access_token
+        try:
+            self.token_expires_at = decode_jwt_exp(access_token)
+        except t.Error:
+            self.token_expires_at = None
 
         email = self.config.get("email", None)
         if email is not None:
@@ -402,65 +924,23 @@ class Chatbot:
             email (str | None): email of the account to get access token
 
         Raises:
-            Error: _description_
-            Error: _description_
-            Error: _description_
+            Error: The cached access token is invalid
+            Error: The cached access token has expired
 
         Returns:
             str | None: access token string or None if not found
         """
-        email = email or "default"
-        cache = self.__read_cache()
-        access_token = cache.get("access_tokens", {}).get(email, None)
-
-        # Parse access_token as JWT
-        if access_token is not None:
-            try:
-                # Split access_token into 3 parts
-                s_access_token = access_token.split(".")
-                # Add padding to the middle part
-                s_access_token[1] += "=" * ((4 - len(s_access_token[1]) % 4) % 4)
-                d_access_token = base64.b64decode(s_access_token[1])
-                d_access_token = json.loads(d_access_token)
-            except binascii.Error:
-                del cache["access_tokens"][email]
-                self.__write_cache(cache)
-                error = t.Error(
-                    source="__get_cached_access_token",
-                    message="Invalid access token",
-                    code=t.ErrorType.INVALID_ACCESS_TOKEN_ERROR,
-                )
-                del cache["access_tokens"][email]
-                raise error from None
-            except json.JSONDecodeError:
-                del cache["access_tokens"][email]
-                self.__write_cache(cache)
-                error = t.Error(
-                    source="__get_cached_access_token",
-                    message="Invalid access token",
-                    code=t.ErrorType.INVALID_ACCESS_TOKEN_ERROR,
-                )
-                raise error from None
-            except IndexError:
-                del cache["access_tokens"][email]
-                self.__write_cache(cache)
-                error = t.Error(
-                    source="__get_cached_access_token",
-                    message="Invalid access token",
-                    code=t.ErrorType.INVALID_ACCESS_TOKEN_ERROR,
-                )
-                raise error from None
-
-            exp = d_access_token.get("exp", None)
-            if exp is not None and exp < time.time():
-                error = t.Error(
-                    source="__get_cached_access_token",
-                    message="Access token expired",
-                    code=t.ErrorType.EXPIRED_ACCESS_TOKEN_ERROR,
-                )
-                raise error
-
-        return access_token
+        cached = self.token_cache.get(email or "default")
+        if cached is None:
+            return None
+        if cached.expires_at is not None and cached.expires_at < time.time():
+            error = t.Error(
+                source="__get_cached_access_token",
+                message="Access token expired",
+                code=t.ErrorType.EXPIRED_ACCESS_TOKEN_ERROR,
+            )
+            raise error
+        return cached.access_token
 
     @logger(is_timed=False)
     def __cache_access_token(self, email: str, access_token: str) -> None:
@@ -470,34 +950,7 @@ class Chatbot:
             email (str): account email
             access_token (str): account access token
         """
-        email = email or "default"
-        cache = self.__read_cache()
-        if "access_tokens" not in cache:
-            cache["access_tokens"] = {}
-        cache["access_tokens"][email] = access_token
-        self.__write_cache(cache)
-
-    @logger(is_timed=False)
-    def __write_cache(self, info: dict) -> None:
-        """Write cache info to file
-
-        Args:
-            info (dict): cache info, current format
-            {
-                "access_tokens":{"someone@example.com": 'this account's access token', }
-            }
-        """
-        dirname = self.cache_path.home() or Path(".")
-        dirname.mkdir(parents=True, exist_ok=True)
-        json.dump(info, open(self.cache_path, "w", encoding="utf-8"), indent=4)
-
-    @logger(is_timed=False)
-    def __read_cache(self) -> dict[str, dict[str, str]]:
-        try:
-            cached = json.load(open(self.cache_path, encoding="utf-8"))
-        except (FileNotFoundError, json.decoder.JSONDecodeError):
-            cached = {}
-        return cached
+        self.token_cache.set(email or "default", access_token)
 
     @logger(is_timed=True)
     def login(self) -> None:
@@ -521,101 +974,178 @@ class Chatbot:
         data: dict,
         auto_continue: bool = False,
         timeout: float = 360,
+        stream_mode: str = "full",
+        stop: list[str] | None = None,
+        cancel: CancelToken | None = None,
+        deadline: Deadline | None = None,
         **kwargs,
     ) -> Generator[dict, None, None]:
         log.debug("Sending the payload")
+        if self.token_refresher is not None:
+            self.token_refresher.record_request()
+        if deadline is not None:
+            deadline = deadline.start()
+
+        with measure(
+            "V1",
+            model=data.get("model"),
+            convo_id=data["conversation_id"],
+        ) as metrics:
+            if (
+                data.get("model", "").startswith("gpt-4")
+                and not self.config.get("SERVER_SIDE_ARKOSE")
+                and not getenv("SERVER_SIDE_ARKOSE")
+            ):
+                arkose_started = time.perf_counter()
+                try:
+                    data["arkose_token"] = self.arkose.get_token()
+                    # print(f"Arkose token obtained: {data['arkose_token']}")
+                except Exception as e:
+                    print(e)
+                    raise
+                metrics.add_phase("arkose", time.perf_counter() - arkose_started)
+                if deadline is not None:
+                    deadline.check()
 
-        if (
-            data.get("model", "").startswith("gpt-4")
-            and not self.config.get("SERVER_SIDE_ARKOSE")
-            and not getenv("SERVER_SIDE_ARKOSE")
-        ):
-            try:
-                data["arkose_token"] = get_arkose_token(
-                    self.captcha_download_images,
-                    self.captcha_solver,
-                    captcha_supported=False,
-                )
-                # print(f"Arkose token obtained: {data['arkose_token']}")
-            except Exception as e:
-                print(e)
-                raise
-
-        cid, pid = data["conversation_id"], data["parent_message_id"]
-        message = ""
+            cid, pid = data["conversation_id"], data["parent_message_id"]
+            message = ""
 
-        self.conversation_id_prev_queue.append(cid)
-        self.parent_id_prev_queue.append(pid)
-        response = self.session.post(
-            url=f"{self.base_url}conversation",
-            data=json.dumps(data),
-            timeout=timeout,
-            stream=True,
-        )
-        self.__check_response(response)
-
-        finish_details = None
-        for line in response.iter_lines():
-            # remove b' and ' at the beginning and end and ignore case
-            line = str(line)[2:-1]
-            if line.lower() == "internal server error":
-                log.error(f"Internal Server Error: {line}")
-                error = t.Error(
-                    source="ask",
-                    message="Internal Server Error",
-                    code=t.ErrorType.SERVER_ERROR,
+            self.conversation_id_prev_queue.append(cid)
+            self.parent_id_prev_queue.append(pid)
+            request_timeout = (
+                timeout if deadline is None else deadline.http_timeout(timeout)
+            )
+            try:
+                response = self.session.post(
+                    url=f"{self.base_url}conversation",
+                    data=json.dumps(data),
+                    timeout=request_timeout,
+                    stream=True,
                 )
-                raise error
-            if not line or line is None:
-                continue
-            if "data: " in line:
-                line = line[6:]
-            if line == "[DONE]":
-                break
-
-            # DO NOT REMOVE THIS
-            line = line.replace('\\"', '"')
-            line = line.replace("\\'", "'")
-            line = line.replace("\\\\", "\\")
-
+            except requests.exceptions.Timeout as error:
+                if deadline is None:
+                    raise
+                raise deadline.timeout_error(
+                    connect=isinstance(error, requests.exceptions.ConnectTimeout),
+                ) from error
             try:
-                line = json.loads(line)
-            except json.decoder.JSONDecodeError:
-                continue
-            if not self.__check_fields(line):
-                continue
-            if line.get("message").get("author").get("role") != "assistant":
-                continue
+                metrics.attempts = 1
+                metrics.mark_first_byte()
+                self.__check_response(response)
+
+                finish_details = None
+                track = DeltaTracker() if stream_mode == "delta" else None
+                received = 0
+                stopped = False
+                record = None
+                for event in iter_events(
+                    response.iter_content(chunk_size=None),
+                    raw_lines=True,
+                ):
+                    if cancel is not None and cancel.cancelled:
+                        finish_details = "cancelled"
+                        break
+                    if event.event == "raw":
+                        if event.data.lower() == "internal server error":
+                            log.error(f"Internal Server Error: {event.data}")
+                            error = t.Error(
+                                source="ask",
+                                message="Internal Server Error",
+                                code=t.ErrorType.SERVER_ERROR,
+                            )
+                            raise error
+                        continue
+                    if event.data == "[DONE]":
+                        break
 
-            cid = line["conversation_id"]
-            pid = line["message"]["id"]
-            metadata = line["message"].get("metadata", {})
-            message_exists = False
-            author = {}
-            if line.get("message"):
-                author = metadata.get("author", {}) or line["message"].get("author", {})
+                    try:
+                        line = event.json()
+                    except JSONDecodeError:
+                        continue
+                    if not self.__check_fields(line):
+                        continue
+                    if line.get("message").get("author").get("role") != "assistant":
+                        continue
+
+                    cid = line["conversation_id"]
+                    pid = line["message"]["id"]
+                    metadata = line["message"].get("metadata", {})
+                    message_exists = False
+                    author = {}
+                    if line.get("message"):
+                        author = metadata.get("author", {}) or line["message"].get(
+                            "author",
+                            {},
+                        )
+                        if (
+                            line["message"].get("content")
+                            and line["message"]["content"].get("parts")
+                            and len(line["message"]["content"]["parts"]) > 0
+                        ):
+                            message_exists = True
+                    message: str = (
+                        line["message"]["content"]["parts"][0] if message_exists else ""
+                    )
+                    model = metadata.get("model_slug", None)
+                    finish_details = metadata.get("finish_details", {"type": None})[
+                        "type"
+                    ]
+                    # Each event carries the whole message, about a token longer
+                    if len(message) > received:
+                        metrics.mark_token()
+                        received = len(message)
+                    if deadline is not None:
+                        deadline.check(metrics.tokens)
+                    shown = message
+                    if stop:
+                        shown, stopped = cut_at_stop(message, stop)
+                        if stopped:
+                            message = shown
+                            finish_details = "stop"
+                    record = {
+                        "author": author,
+                        "message": shown,
+                        "conversation_id": cid,
+                        "parent_id": pid,
+                        "model": model,
+                        "finish_details": finish_details,
+                        "end_turn": line["message"].get("end_turn", True),
+                        "recipient": line["message"].get("recipient", "all"),
+                        "citations": metadata.get("citations", []),
+                    }
+                    yield track(record) if track else record
+                    if stopped:
+                        break
                 if (
-                    line["message"].get("content")
-                    and line["message"]["content"].get("parts")
-                    and len(line["message"]["content"]["parts"]) > 0
+                    record is not None
+                    and not stopped
+                    and (finish_details == "cancelled" or record["message"] != message)
                 ):
-                    message_exists = True
-            message: str = (
-                line["message"]["content"]["parts"][0] if message_exists else ""
-            )
-            model = metadata.get("model_slug", None)
-            finish_details = metadata.get("finish_details", {"type": None})["type"]
-            yield {
-                "author": author,
-                "message": message,
-                "conversation_id": cid,
-                "parent_id": pid,
-                "model": model,
-                "finish_details": finish_details,
-                "end_turn": line["message"].get("end_turn", True),
-                "recipient": line["message"].get("recipient", "all"),
-                "citations": metadata.get("citations", []),
-            }
+                    # Show the text held back for a possible stop sequence
+                    record["message"] = message
+                    record["finish_details"] = finish_details
+                    yield track(record) if track else record
+                if finish_details == "cancelled":
+                    metrics.cancel()
+            except GeneratorExit:
+                # The consumer stopped reading, continue from the partial reply
+                metrics.cancel()
+                self.conversation_mapping[cid] = pid
+                if pid is not None:
+                    self.parent_id = pid
+                if cid is not None:
+                    self.conversation_id = cid
+                raise
+            except t.StreamTimeoutError as error:
+                error.partial = message
+                raise
+            except requests.exceptions.ConnectionError as error:
+                # requests reports read timeouts of a stream as connection errors
+                if deadline is None or deadline.expired() is None:
+                    raise
+                raise deadline.timeout_error(message) from error
+            finally:
+                response.close()
 
         self.conversation_mapping[cid] = pid
         if pid is not None:
@@ -631,8 +1161,10 @@ class Chatbot:
             model=model,
             timeout=timeout,
             auto_continue=False,
+            stream_mode=stream_mode,
         ):
-            i["message"] = message + i["message"]
+            if stream_mode == "full":
+                i["message"] = message + i["message"]
             yield i
 
     @logger(is_timed=True)
@@ -645,6 +1177,10 @@ class Chatbot:
         model: str | None = None,
         auto_continue: bool = False,
         timeout: float = 360,
+        stream_mode: str = "full",
+        stop: list[str] | None = None,
+        cancel: CancelToken | None = None,
+        deadline: Deadline | None = None,
         **kwargs,
     ) -> Generator[dict, None, None]:
         """Ask a question to the chatbot
@@ -655,6 +1191,10 @@ class Chatbot:
             model (str | None, optional): The model to use. Defaults to None.
             auto_continue (bool, optional): Whether to continue the conversation automatically. Defaults to False.
             timeout (float, optional): Timeout for getting the full response, unit is second. Defaults to 360.
+            stream_mode (str, optional): "full" yields the whole message so far on every update, "delta" yields only the new text, with reset set when it replaces the text so far, and author, citations and model only when they change. Defaults to "full".
+            stop (list[str] | None, optional): Sequences that end the reply where one first appears, left out of it. Defaults to None.
+            cancel (CancelToken | None, optional): Token to stop the reply early from any thread, keeping the text received with finish_details "cancelled". Defaults to None.
+            deadline (Deadline | None, optional): Limits on connecting, the first token, the gap between tokens and the whole request, past which StreamTimeoutError is raised with the partial message. Defaults to None.
 
         Yields: Generator[dict, None, None] - The response from the chatbot
             dict: {
@@ -662,12 +1202,13 @@ class Chatbot:
                 "conversation_id": str,
                 "parent_id": str,
                 "model": str,
-                "finish_details": str, # "max_tokens" or "stop"
+                "finish_details": str, # "max_tokens", "stop" or "cancelled"
                 "end_turn": bool,
                 "recipient": str,
                 "citations": list[dict],
             }
         """
+        check_stream_mode(stream_mode)
         if plugin_ids is None:
             plugin_ids = []
         if parent_id and not conversation_id:
@@ -725,6 +1266,10 @@ class Chatbot:
             data,
             timeout=timeout,
             auto_continue=auto_continue,
+            stream_mode=stream_mode,
+            stop=stop,
+            cancel=cancel,
+            deadline=deadline,
         )
 
     @logger(is_timed=True)
@@ -737,6 +1282,10 @@ class Chatbot:
         plugin_ids: list = None,
         auto_continue: bool = False,
         timeout: float = 360,
+        stream_mode: str = "full",
+        stop: list[str] | None = None,
+        cancel: CancelToken | None = None,
+        deadline: Deadline | None = None,
         **kwargs,
     ) -> Generator[dict, None, None]:
         """Ask a question to the chatbot
@@ -747,6 +1296,10 @@ class Chatbot:
             model (str, optional): The model to use. Defaults to "".
             auto_continue (bool, optional): Whether to continue the conversation automatically. Defaults to False.
             timeout (float, optional): Timeout for getting the full response, unit is second. Defaults to 360.
+            stream_mode (str, optional): "full" yields the whole message so far on every update, "delta" yields only the new text, with reset set when it replaces the text so far, and author, citations and model only when they change. Defaults to "full".
+            stop (list[str] | None, optional): Sequences that end the reply where one first appears, left out of it. Defaults to None.
+            cancel (CancelToken | None, optional): Token to stop the reply early from any thread, keeping the text received with finish_details "cancelled". Defaults to None.
+            deadline (Deadline | None, optional): Limits on connecting, the first token, the gap between tokens and the whole request, past which StreamTimeoutError is raised with the partial message. Defaults to None.
 
         Yields: The response from the chatbot
             dict: {
@@ -754,7 +1307,7 @@ class Chatbot:
                 "conversation_id": str,
                 "parent_id": str,
                 "model": str,
-                "finish_details": str, # "max_tokens" or "stop"
+                "finish_details": str, # "max_tokens", "stop" or "cancelled"
                 "end_turn": bool,
                 "recipient": str,
             }
@@ -777,6 +1330,10 @@ class Chatbot:
             plugin_ids=plugin_ids,
             model=model,
             auto_continue=auto_continue,
+            stream_mode=stream_mode,
+            stop=stop,
+            cancel=cancel,
+            deadline=deadline,
             timeout=timeout,
         )
 
@@ -788,6 +1345,7 @@ class Chatbot:
         model: str = "",
         auto_continue: bool = False,
         timeout: float = 360,
+        stream_mode: str = "full",
     ) -> Generator[dict, None, None]:
         """let the chatbot continue to write.
         Args:
@@ -796,6 +1354,7 @@ class Chatbot:
             model (str, optional): The model to use. Defaults to None.
             auto_continue (bool, optional): Whether to continue the conversation automatically. Defaults to False.
             timeout (float, optional): Timeout for getting the full response, unit is second. Defaults to 360.
+            stream_mode (str, optional): "full" yields the whole message so far on every update, "delta" yields only the new text, with reset set when it replaces the text so far, and author, citations and model only when they change. Defaults to "full".
 
         Yields:
             dict: {
@@ -803,11 +1362,12 @@ class Chatbot:
                 "conversation_id": str,
                 "parent_id": str,
                 "model": str,
-                "finish_details": str, # "max_tokens" or "stop"
+                "finish_details": str, # "max_tokens", "stop" or "cancelled"
                 "end_turn": bool,
                 "recipient": str,
             }
         """
+        check_stream_mode(stream_mode)
         if parent_id and not conversation_id:
             raise t.Error(
                 source="User",
@@ -862,6 +1422,7 @@ class Chatbot:
             data,
             timeout=timeout,
             auto_continue=auto_continue,
+            stream_mode=stream_mode,
         )
 
     @logger(is_timed=False)
@@ -1022,11 +1583,39 @@ class Chatbot:
         self.__check_response(response)
 
     @logger(is_timed=False)
-    def __map_conversations(self) -> None:
-        conversations = self.get_conversations()
-        histories = [self.get_msg_history(x["id"]) for x in conversations]
-        for x, y in zip(conversations, histories):
-            self.conversation_mapping[x["id"]] = y["current_node"]
+    def __map_conversations(self, concurrency: int = 8, page_size: int = 50) -> None:
+        """Map every conversation to its current node
+
+        Pages through all conversations and fetches their histories on a
+        thread pool while later pages are still loading. The first error
+        cancels the histories not fetched yet.
+
+        Args:
+            concurrency (int, optional): Histories fetched at once. Defaults to 8.
+            page_size (int, optional): Conversations per page. Defaults to 50.
+        """
+
+        def map_conversation(convo_id: str) -> None:
+            history = self.get_msg_history(convo_id)
+            self.conversation_mapping[convo_id] = history["current_node"]
+
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            futures = []
+            offset = 0
+            while True:
+                conversations = self.get_conversations(offset=offset, limit=page_size)
+                futures += [
+                    executor.submit(map_conversation, x["id"]) for x in conversations
+                ]
+                if len(conversations) < page_size:
+                    break
+                offset += page_size
+            for future in as_completed(futures):
+                future.result()
+        finally:
+            # Only unfinished histories are cancelled, i.e. after an error
+            executor.shutdown(cancel_futures=True)
 
     @logger(is_timed=False)
     def reset_chat(self) -> None:
@@ -1104,6 +1693,8 @@ class AsyncChatbot(Chatbot):
         parent_id: str | None = None,
         base_url: str | None = None,
         lazy_loading: bool = True,
+        auto_refresh: bool = False,
+        refresh_margin: float = 300,
     ) -> None:
         """
         Same as Chatbot class, but with async methods.
@@ -1114,109 +1705,222 @@ class AsyncChatbot(Chatbot):
             parent_id=parent_id,
             base_url=base_url,
             lazy_loading=lazy_loading,
+            auto_refresh=auto_refresh,
+            refresh_margin=refresh_margin,
         )
 
         # overwrite inherited normal session with async
         self.session = AsyncClient(headers=self.session.headers)
+        if self.token_refresher is not None:
+            try:
+                self.token_refresher.start_async()
+            except RuntimeError:
+                # No running loop yet, the first request starts the refresher
+                pass
+
+    def _start_token_refresher(self) -> None:
+        """Renew tokens on a task once the async session is set up"""
 
     async def __send_request(
         self,
         data: dict,
         auto_continue: bool = False,
         timeout: float = 360,
+        stream_mode: str = "full",
+        stop: list[str] | None = None,
+        cancel: CancelToken | None = None,
+        deadline: Deadline | None = None,
         **kwargs,
     ) -> AsyncGenerator[dict, None]:
         log.debug("Sending the payload")
-
-        cid, pid = data["conversation_id"], data["parent_message_id"]
-        message = ""
-        self.conversation_id_prev_queue.append(cid)
-        self.parent_id_prev_queue.append(pid)
-        async with self.session.stream(
-            "POST",
-            url=f"{self.base_url}conversation",
-            data=json.dumps(data),
-            timeout=timeout,
-        ) as response:
-            await self.__check_response(response)
-
-            finish_details = None
-            async for line in response.aiter_lines():
-                if line.lower() == "internal server error":
-                    log.error(f"Internal Server Error: {line}")
-                    error = t.Error(
-                        source="ask",
-                        message="Internal Server Error",
-                        code=t.ErrorType.SERVER_ERROR,
-                    )
-                    raise error
-                if not line or line is None:
-                    continue
-                if "data: " in line:
-                    line = line[6:]
-                if line == "[DONE]":
-                    break
-
+        if self.token_refresher is not None:
+            self.token_refresher.start_async()
+            self.token_refresher.record_request()
+        if deadline is not None:
+            deadline = deadline.start()
+
+        with measure(
+            "V1",
+            model=data.get("model"),
+            convo_id=data["conversation_id"],
+        ) as metrics:
+            if (
+                data.get("model", "").startswith("gpt-4")
+                and not self.config.get("SERVER_SIDE_ARKOSE")
+                and not getenv("SERVER_SIDE_ARKOSE")
+            ):
+                arkose_started = time.perf_counter()
                 try:
-                    line = json.loads(line)
-                except json.decoder.JSONDecodeError:
-                    continue
-
-                if not self.__check_fields(line):
-                    continue
-                if line.get("message").get("author").get("role") != "assistant":
-                    continue
-
-                cid = line["conversation_id"]
-                pid = line["message"]["id"]
-                metadata = line["message"].get("metadata", {})
-                message_exists = False
-                author = {}
-                if line.get("message"):
-                    author = metadata.get("author", {}) or line["message"].get(
-                        "author",
-                        {},
+                    data["arkose_token"] = await within(
+                        deadline,
+                        self.arkose.get_token_async(),
                     )
+                except Exception as e:
+                    print(e)
+                    raise
+                metrics.add_phase("arkose", time.perf_counter() - arkose_started)
+
+            cid, pid = data["conversation_id"], data["parent_message_id"]
+            message = ""
+            self.conversation_id_prev_queue.append(cid)
+            self.parent_id_prev_queue.append(pid)
+            trace = AsyncRequestTrace()
+            request_timeout = timeout
+            if deadline is not None:
+                connect, read = deadline.http_timeout(timeout)
+                request_timeout = httpx.Timeout(timeout, connect=connect, read=read)
+            try:
+                async with self.session.stream(
+                    "POST",
+                    url=f"{self.base_url}conversation",
+                    data=json.dumps(data),
+                    timeout=request_timeout,
+                    extensions={"trace": trace},
+                ) as response:
+                    metrics.attempts = 1
+                    metrics.add_trace(trace.events)
+                    metrics.mark_first_byte()
+                    await self.__check_response(response)
+
+                    finish_details = None
+                    track = DeltaTracker() if stream_mode == "delta" else None
+                    received = 0
+                    stopped = False
+                    record = None
+                    events = aiter_events(response.aiter_bytes(), raw_lines=True)
+                    if deadline is not None:
+                        events = timed(events, deadline)
+                    async for event in events:
+                        if cancel is not None and cancel.cancelled:
+                            finish_details = "cancelled"
+                            break
+                        if event.event == "raw":
+                            if event.data.lower() == "internal server error":
+                                log.error(f"Internal Server Error: {event.data}")
+                                error = t.Error(
+                                    source="ask",
+                                    message="Internal Server Error",
+                                    code=t.ErrorType.SERVER_ERROR,
+                                )
+                                raise error
+                            continue
+                        if event.data == "[DONE]":
+                            break
+
+                        try:
+                            line = event.json()
+                        except JSONDecodeError:
+                            continue
+
+                        if not self.__check_fields(line):
+                            continue
+                        if line.get("message").get("author").get("role") != "assistant":
+                            continue
+
+                        cid = line["conversation_id"]
+                        pid = line["message"]["id"]
+                        metadata = line["message"].get("metadata", {})
+                        message_exists = False
+                        author = {}
+                        if line.get("message"):
+                            author = metadata.get("author", {}) or line["message"].get(
+                                "author",
+                                {},
+                            )
+                            if (
+                                line["message"].get("content")
+                                and line["message"]["content"].get("parts")
+                                and len(line["message"]["content"]["parts"]) > 0
+                            ):
+                                message_exists = True
+                        message: str = (
+                            line["message"]["content"]["parts"][0]
+                            if message_exists
+                            else ""
+                        )
+                        model = metadata.get("model_slug", None)
+                        finish_details = metadata.get("finish_details", {"type": None})[
+                            "type"
+                        ]
+                        # Each event carries the whole message, about a token longer
+                        if len(message) > received:
+                            metrics.mark_token()
+                            received = len(message)
+                        if deadline is not None:
+                            deadline.check(metrics.tokens)
+                        shown = message
+                        if stop:
+                            shown, stopped = cut_at_stop(message, stop)
+                            if stopped:
+                                message = shown
+                                finish_details = "stop"
+                        record = {
+                            "author": author,
+                            "message": shown,
+                            "conversation_id": cid,
+                            "parent_id": pid,
+                            "model": model,
+                            "finish_details": finish_details,
+                            "end_turn": line["message"].get("end_turn", True),
+                            "recipient": line["message"].get("recipient", "all"),
+                            "citations": metadata.get("citations", []),
+                        }
+                        yield track(record) if track else record
+                        if stopped:
+                            break
                     if (
-                        line["message"].get("content")
-                        and line["message"]["content"].get("parts")
-                        and len(line["message"]["content"]["parts"]) > 0
+                        record is not None
+                        and not stopped
+                        and (
+                            finish_details == "cancelled"
+                            or record["message"] != message
+                        )
                     ):
-                        message_exists = True
-                message: str = (
-                    line["message"]["content"]["parts"][0] if message_exists else ""
-                )
-                model = metadata.get("model_slug", None)
-                finish_details = metadata.get("finish_details", {"type": None})["type"]
-                yield {
-                    "author": author,
-                    "message": message,
-                    "conversation_id": cid,
-                    "parent_id": pid,
-                    "model": model,
-                    "finish_details": finish_details,
-                    "end_turn": line["message"].get("end_turn", True),
-                    "recipient": line["message"].get("recipient", "all"),
-                    "citations": metadata.get("citations", []),
-                }
+                        # Show the text held back for a possible stop sequence
+                        record["message"] = message
+                        record["finish_details"] = finish_details
+                        yield track(record) if track else record
+                    if finish_details == "cancelled":
+                        metrics.cancel()
+            except (GeneratorExit, asyncio.CancelledError):
+                # The consumer stopped reading, continue from the partial reply
+                metrics.cancel()
+                self.conversation_mapping[cid] = pid
+                if pid is not None:
+                    self.parent_id = pid
+                if cid is not None:
+                    self.conversation_id = cid
+                raise
+            except t.StreamTimeoutError as error:
+                error.partial = message
+                raise
+            except httpx.TimeoutException as error:
+                if deadline is None:
+                    raise
+                raise deadline.timeout_error(
+                    message,
+                    connect=isinstance(error, httpx.ConnectTimeout),
+                ) from error
 
-            self.conversation_mapping[cid] = pid
-            if pid is not None:
-                self.parent_id = pid
-            if cid is not None:
-                self.conversation_id = cid
+        self.conversation_mapping[cid] = pid
+        if pid is not None:
+            self.parent_id = pid
+        if cid is not None:
+            self.conversation_id = cid
 
-            if not (auto_continue and finish_details == "max_tokens"):
-                return
-            message = message.strip("\n")
-            async for i in self.continue_write(
-                conversation_id=cid,
-                model=model,
-                timeout=timeout,
-                auto_continue=False,
-            ):
+        if not (auto_continue and finish_details == "max_tokens"):
+            return
+        message = message.strip("\n")
+        async for i in self.continue_write(
+            conversation_id=cid,
+            model=model,
+            timeout=timeout,
+            auto_continue=False,
+            stream_mode=stream_mode,
+        ):
+            if stream_mode == "full":
                 i["message"] = message + i["message"]
-                yield i
+            yield i
 
     async def post_messages(
         self,
@@ -1227,6 +1931,10 @@ class AsyncChatbot(Chatbot):
         model: str | None = None,
         auto_continue: bool = False,
         timeout: float = 360,
+        stream_mode: str = "full",
+        stop: list[str] | None = None,
+        cancel: CancelToken | None = None,
+        deadline: Deadline | None = None,
         **kwargs,
     ) -> AsyncGenerator[dict, None]:
         """Post messages to the chatbot
@@ -1238,6 +1946,10 @@ class AsyncChatbot(Chatbot):
             model (str | None, optional): The model to use. Defaults to None.
             auto_continue (bool, optional): Whether to continue the conversation automatically. Defaults to False.
             timeout (float, optional): Timeout for getting the full response, unit is second. Defaults to 360.
+            stream_mode (str, optional): "full" yields the whole message so far on every update, "delta" yields only the new text, with reset set when it replaces the text so far, and author, citations and model only when they change. Defaults to "full".
+            stop (list[str] | None, optional): Sequences that end the reply where one first appears, left out of it. Defaults to None.
+            cancel (CancelToken | None, optional): Token to stop the reply early from any thread, keeping the text received with finish_details "cancelled". Defaults to None.
+            deadline (Deadline | None, optional): Limits on connecting, the first token, the gap between tokens and the whole request, past which StreamTimeoutError is raised with the partial message. Defaults to None.
 
         Yields:
             AsyncGenerator[dict, None]: The response from the chatbot
@@ -1252,6 +1964,7 @@ class AsyncChatbot(Chatbot):
                 "citations": list[dict],
             }
         """
+        check_stream_mode(stream_mode)
         if plugin_ids is None:
             plugin_ids = []
         if parent_id and not conversation_id:
@@ -1308,6 +2021,10 @@ class AsyncChatbot(Chatbot):
             data,
             timeout=timeout,
             auto_continue=auto_continue,
+            stream_mode=stream_mode,
+            stop=stop,
+            cancel=cancel,
+            deadline=deadline,
         ):
             yield msg
 
@@ -1320,6 +2037,10 @@ class AsyncChatbot(Chatbot):
         plugin_ids: list = None,
         auto_continue: bool = False,
         timeout: int = 360,
+        stream_mode: str = "full",
+        stop: list[str] | None = None,
+        cancel: CancelToken | None = None,
+        deadline: Deadline | None = None,
         **kwargs,
     ) -> AsyncGenerator[dict, None]:
         """Ask a question to the chatbot
@@ -1331,6 +2052,10 @@ class AsyncChatbot(Chatbot):
             model (str, optional): The model to use. Defaults to "".
             auto_continue (bool, optional): Whether to continue the conversation automatically. Defaults to False.
             timeout (float, optional): Timeout for getting the full response, unit is second. Defaults to 360.
+            stream_mode (str, optional): "full" yields the whole message so far on every update, "delta" yields only the new text, with reset set when it replaces the text so far, and author, citations and model only when they change. Defaults to "full".
+            stop (list[str] | None, optional): Sequences that end the reply where one first appears, left out of it. Defaults to None.
+            cancel (CancelToken | None, optional): Token to stop the reply early from any thread, keeping the text received with finish_details "cancelled". Defaults to None.
+            deadline (Deadline | None, optional): Limits on connecting, the first token, the gap between tokens and the whole request, past which StreamTimeoutError is raised with the partial message. Defaults to None.
 
         Yields:
             AsyncGenerator[dict, None]: The response from the chatbot
@@ -1362,6 +2087,10 @@ class AsyncChatbot(Chatbot):
             plugin_ids=plugin_ids,
             model=model,
             auto_continue=auto_continue,
+            stream_mode=stream_mode,
+            stop=stop,
+            cancel=cancel,
+            deadline=deadline,
             timeout=timeout,
         ):
             yield msg
@@ -1373,6 +2102,7 @@ class AsyncChatbot(Chatbot):
         model: str = "",
         auto_continue: bool = False,
         timeout: float = 360,
+        stream_mode: str = "full",
     ) -> AsyncGenerator[dict, None]:
         """let the chatbot continue to write
         Args:
@@ -1381,6 +2111,7 @@ class AsyncChatbot(Chatbot):
             model (str, optional): Model to use. Defaults to None.
             auto_continue (bool, optional): Whether to continue writing automatically. Defaults to False.
             timeout (float, optional): Timeout for getting the full response, unit is second. Defaults to 360.
+            stream_mode (str, optional): "full" yields the whole message so far on every update, "delta" yields only the new text, with reset set when it replaces the text so far, and author, citations and model only when they change. Defaults to "full".
 
 
         Yields:
@@ -1395,6 +2126,7 @@ class AsyncChatbot(Chatbot):
                 "recipient": str,
             }
         """
+        check_stream_mode(stream_mode)
         if parent_id and not conversation_id:
             error = t.Error(
                 source="User",
@@ -1434,6 +2166,7 @@ class AsyncChatbot(Chatbot):
         async for msg in self.__send_request(
             data=data,
             auto_continue=auto_continue,
+            stream_mode=stream_mode,
             timeout=timeout,
         ):
             yield msg
@@ -1556,11 +2289,55 @@ class AsyncChatbot(Chatbot):
         response = await self.session.patch(url, data='{"is_visible": false}')
         await self.__check_response(response)
 
-    async def __map_conversations(self) -> None:
-        conversations = await self.get_conversations()
-        histories = [await self.get_msg_history(x["id"]) for x in conversations]
-        for x, y in zip(conversations, histories):
-            self.conversation_mapping[x["id"]] = y["current_node"]
+    async def __map_conversations(
+        self,
+        concurrency: int = 8,
+        page_size: int = 50,
+    ) -> None:
+        """Map every conversation to its current node
+
+        Pages through all conversations and fetches their histories
+        concurrently while later pages are still loading. The first error
+        cancels the histories not fetched yet.
+
+        Args:
+            concurrency (int, optional): Histories fetched at once. Defaults to 8.
+            page_size (int, optional): Conversations per page. Defaults to 50.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        stopped = False
+
+        async def map_conversation(convo_id: str) -> None:
+            async with semaphore:
+                history = await self.get_msg_history(convo_id)
+            # httpx can swallow the cancellation of a request in flight, so
+            # histories arriving once mapping stopped are dropped
+            if not stopped:
+                self.conversation_mapping[convo_id] = history["current_node"]
+
+        tasks: list[asyncio.Task] = []
+        try:
+            offset = 0
+            while True:
+                conversations = await self.get_conversations(
+                    offset=offset,
+                    limit=page_size,
+                )
+                tasks += [
+                    asyncio.create_task(map_conversation(x["id"]))
+                    for x in conversations
+                ]
+                if len(conversations) < page_size:
+                    break
+                offset += page_size
+            await asyncio.gather(*tasks)
+        finally:
+            # Only unfinished histories are cancelled, i.e. after an error.
+            # Waiting for them retrieves their exceptions.
+            stopped = True
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
     def __check_fields(self, data: dict) -> bool:
         try:
@@ -1583,6 +2360,284 @@ class AsyncChatbot(Chatbot):
             raise error from ex
 
 
+RATE_LIMIT_CODES = (429, t.ErrorType.RATE_LIMIT_ERROR)
+
+
+class PoolAccount:
+    """
+    An account of a ChatbotPool with its load and counters
+
+    The counters are updated under the lock of the pool.
+    """
+
+    def __init__(self, name: str, chatbot: Chatbot) -> None:
+        self.name = name
+        self.chatbot = chatbot
+        # Requests running on this account, at most one
+        self.in_flight: int = 0
+        self.requests: int = 0
+        self.failures: int = 0
+        self.rate_limited: int = 0
+        self.total_latency: float = 0.0
+        self.cooldown_until: float = 0.0
+        self.started: float = time.monotonic()
+        # A Chatbot tracks one conversation cursor, so it serves one request
+        # at a time. Thread ident of the request using the account, if any.
+        self.holder: int | None = None
+
+    @property
+    def healthy(self) -> bool:
+        """
+        Whether the account is not cooling down after a rate limit
+        """
+        return time.monotonic() >= self.cooldown_until
+
+    def to_dict(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "rate_limited": self.rate_limited,
+            "healthy": self.healthy,
+            "average_latency": self.total_latency / self.requests
+            if self.requests
+            else None,
+            "throughput": self.requests / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+class ChatbotPool:
+    """
+    Spreads requests over several ChatGPT accounts
+
+    Each account serves one request at a time. New conversations go to the
+    idle healthy account that has served the fewest requests. Requests on
+    an existing conversation always go back to the account that owns it.
+    Requests wait while the accounts they can use are busy with other
+    threads, and raise if those accounts are busy with streams of the
+    calling thread itself. Accounts answering 429 cool down before they get
+    new conversations again.
+
+    The owners of the max_conversations most recently used conversations
+    are remembered. Older conversations are treated as unknown and go to
+    any account.
+    """
+
+    def __init__(
+        self,
+        configs: list[dict],
+        cooldown: float = 60,
+        max_conversations: int = 10000,
+        **kwargs,
+    ) -> None:
+        """Log in to all accounts
+
+        Args:
+            configs (list[dict]): One Chatbot config per account, with access_token or email and password, and optionally proxy
+            cooldown (float, optional): Seconds a rate limited account gets no new conversations. Defaults to 60.
+            max_conversations (int, optional): Number of conversation owners to remember. Defaults to 10000.
+            **kwargs: Passed on to every Chatbot
+        """
+        self.cooldown = cooldown
+        self.max_conversations = max_conversations
+        self.__lock = threading.Lock()
+        # Notified whenever an account becomes idle
+        self.__released = threading.Condition(self.__lock)
+        # conversation_id -> owning account, least recently used first
+        self.__owners: collections.OrderedDict[
+            str,
+            PoolAccount,
+        ] = collections.OrderedDict()
+        with ThreadPoolExecutor(max_workers=min(len(configs), 8) or 1) as executor:
+            chatbots = list(
+                executor.map(lambda config: Chatbot(config, **kwargs), configs),
+            )
+        self.accounts: list[PoolAccount] = [
+            PoolAccount(config.get("email") or f"account-{index}", chatbot)
+            for index, (config, chatbot) in enumerate(zip(configs, chatbots))
+        ]
+
+    def __acquire(self, conversation_id: str | None) -> PoolAccount:
+        thread = threading.get_ident()
+        with self.__released:
+            while True:
+                owner = self.__owners.get(conversation_id) if conversation_id else None
+                if owner is not None:
+                    candidates = [owner]
+                else:
+                    candidates = [
+                        account for account in self.accounts if account.healthy
+                    ]
+                    if not candidates:
+                        raise t.Error(
+                            source="ChatbotPool",
+                            message="All accounts are rate limited",
+                            code=t.ErrorType.RATE_LIMIT_ERROR,
+                        )
+                idle = [account for account in candidates if account.holder is None]
+                if idle:
+                    account = min(idle, key=lambda account: account.requests)
+                    account.holder = thread
+                    account.in_flight += 1
+                    return account
+                # Waiting for streams this thread has yet to finish never ends
+                if all(account.holder == thread for account in candidates):
+                    raise t.Error(
+                        source="ChatbotPool",
+                        message="All usable accounts are busy with streams of this thread",
+                        code=t.ErrorType.PROHIBITED_CONCURRENT_QUERY_ERROR,
+                    )
+                self.__released.wait()
+
+    def __release(
+        self,
+        account: PoolAccount,
+        latency: float,
+        failed: bool,
+        rate_limited: bool,
+    ) -> None:
+        with self.__released:
+            account.holder = None
+            account.in_flight -= 1
+            account.requests += 1
+            account.total_latency += latency
+            if failed:
+                account.failures += 1
+            if rate_limited:
+                account.rate_limited += 1
+                account.cooldown_until = time.monotonic() + self.cooldown
+            self.__released.notify_all()
+
+    def __own(self, conversation_id: str, account: PoolAccount) -> None:
+        with self.__lock:
+            self.__owners[conversation_id] = account
+            self.__owners.move_to_end(conversation_id)
+            while len(self.__owners) > self.max_conversations:
+                self.__owners.popitem(last=False)
+
+    def __dispatch(
+        self,
+        method: str,
+        conversation_id: str | None,
+        *args,
+        **kwargs,
+    ) -> Generator[dict, None, None]:
+        while True:
+            account = self.__acquire(conversation_id)
+            records = self.__run(account, method, conversation_id, *args, **kwargs)
+            yielded = False
+            try:
+                for record in records:
+                    yielded = True
+                    yield record
+                return
+            except t.Error as error:
+                # A new conversation can move on to another account
+                if conversation_id or yielded or error.code not in RATE_LIMIT_CODES:
+                    raise
+                log.debug("%s is rate limited, trying another account", account.name)
+            finally:
+                # Release the account as soon as the caller closes this generator
+                records.close()
+
+    def __run(
+        self,
+        account: PoolAccount,
+        method: str,
+        conversation_id: str | None,
+        *args,
+        **kwargs,
+    ) -> Generator[dict, None, None]:
+        """
+        Run a request on the account acquired for it, then release the account
+        """
+        failed = rate_limited = False
+        start = time.perf_counter()
+        records = None
+        try:
+            if not conversation_id:
+                account.chatbot.reset_chat()
+            records = getattr(account.chatbot, method)(
+                *args,
+                conversation_id=conversation_id,
+                **kwargs,
+            )
+            for record in records:
+                if (cid := record.get("conversation_id")) is not None:
+                    self.__own(cid, account)
+                yield record
+        except t.Error as error:
+            failed = True
+            rate_limited = error.code in RATE_LIMIT_CODES
+            raise
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if records is not None:
+                records.close()
+            self.__release(account, time.perf_counter() - start, failed, rate_limited)
+
+    def ask(
+        self,
+        prompt: str,
+        conversation_id: str | None = None,
+        parent_id: str = "",
+        **kwargs,
+    ) -> Generator[dict, None, None]:
+        """
+        Chatbot.ask on the owner of conversation_id, or on the least loaded
+        healthy account for a new conversation
+
+        The account serves nobody else until the generator is exhausted or
+        closed, so close it when stopping early.
+        """
+        yield from self.__dispatch(
+            "ask",
+            conversation_id,
+            prompt,
+            parent_id=parent_id,
+            **kwargs,
+        )
+
+    def post_messages(
+        self,
+        messages: list[dict],
+        conversation_id: str | None = None,
+        parent_id: str | None = None,
+        **kwargs,
+    ) -> Generator[dict, None, None]:
+        """
+        Chatbot.post_messages on the owner of conversation_id, or on the least
+        loaded healthy account for a new conversation
+
+        The account serves nobody else until the generator is exhausted or
+        closed, so close it when stopping early.
+        """
+        yield from self.__dispatch(
+            "post_messages",
+            conversation_id,
+            messages,
+            parent_id=parent_id,
+            **kwargs,
+        )
+
+    def owner(self, conversation_id: str) -> PoolAccount | None:
+        """
+        The account a conversation belongs to, if it was started in this pool
+        """
+        with self.__lock:
+            return self.__owners.get(conversation_id)
+
+    def stats(self) -> dict[str, dict]:
+        """
+        Load and counters of every account by name
+        """
+        with self.__lock:
+            return {account.name: account.to_dict() for account in self.accounts}
+
+
 get_input = logger(is_timed=False)(get_input)
 
 
@@ -1612,6 +2667,9 @@ def main(config: dict) -> NoReturn:
     """
     Main function for the chatGPT program.
     """
+    from rich.live import Live
+    from rich.markdown import Markdown
+
     chatbot = Chatbot(
         config,
         conversation_id=config.get("conversation_id"),
@@ -1664,11 +2722,11 @@ def main(config: dict) -> NoReturn:
         elif command.startswith("!continue"):
             print()
             print(f"{bcolors.OKGREEN + bcolors.BOLD}Chatbot: {bcolors.ENDC}")
-            prev_text = ""
-            for data in chatbot.continue_write():
-                message = data["message"][len(prev_text) :]
-                print(message, end="", flush=True)
-                prev_text = data["message"]
+            for data in chatbot.continue_write(stream_mode="delta"):
+                if data["reset"]:
+                    # Printed text cannot be taken back, start a new line
+                    print()
+                print(data["message"], end="", flush=True)
             print(bcolors.ENDC)
             print()
         elif command.startswith("!share"):
@@ -1711,12 +2769,25 @@ def main(config: dict) -> NoReturn:
             if chatbot.config.get("model") == "gpt-4-browsing":
                 print("Browsing takes a while, please wait...")
             with Live(Markdown(""), auto_refresh=False) as live:
-                for data in chatbot.ask(prompt=prompt, auto_continue=True):
+                message = ""
+                rendered_at = 0.0
+                for data in chatbot.ask(
+                    prompt=prompt,
+                    auto_continue=True,
+                    stream_mode="delta",
+                ):
                     if data["recipient"] != "all":
                         continue
-                    result = data
-                    message = data["message"]
-                    live.update(Markdown(message), refresh=True)
+                    result.update(data)
+                    if data["reset"]:
+                        message = data["message"]
+                    else:
+                        message += data["message"]
+                    # Re-rendering the whole answer is costly, so cap the rate
+                    if time.perf_counter() - rendered_at > 0.1:
+                        live.update(Markdown(message), refresh=True)
+                        rendered_at = time.perf_counter()
+                live.update(Markdown(message), refresh=True)
             print()
 
             if result.get("citations", False):
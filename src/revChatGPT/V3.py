@@ -2,26 +2,67 @@
 A simple wrapper for the official ChatGPT API
 """
 import argparse
+import asyncio
+import collections
+import contextlib
 import json
 import os
 import sys
+import time
+import uuid
 from importlib.resources import path
 from pathlib import Path
 from typing import AsyncGenerator
+from typing import AsyncIterator
+from typing import Callable
+from typing import Iterator
 from typing import NoReturn
+from typing import TYPE_CHECKING
+from typing import Union
 
 import httpx
-import requests
-import tiktoken
 
 from . import __version__
+from . import tokenizer
 from . import typings as t
+from .hedging import hedged
+from .hedging import HedgePolicy
+from .metrics import measure
+from .metrics import percentile
+from .metrics import RequestMetrics
+from .ratelimit import get_rate_limiter
+from .ratelimit import RateLimiter
+from .ratelimit import RetryPolicy
+from .request_body import encode_body
+from .response_cache import request_key
+from .response_cache import ResponseCache
+from .sse import aiter_events
+from .sse import Event
+from .sse import iter_events
+from .sse import JSONDecodeError
+from .store import as_dict
+from .store import ConversationStore
+from .store import MemoryStore
+from .store import Message
+from .store import MessageTable
+from .store import remove_indices
+from .streaming import CancelToken
+from .streaming import Deadline
+from .streaming import StopScanner
+from .streaming import timed
+from .transport import AsyncRequestTrace
+from .transport import get_transport
+from .transport import RequestTrace
+from .transport import Transport
 from .utils import create_completer
 from .utils import create_keybindings
 from .utils import create_session
 from .utils import get_filtered_keys_from_object
 from .utils import get_input
 
+if TYPE_CHECKING:
+    import tiktoken
+
 ENGINES = [
     "gpt-3.5-turbo",
     "gpt-3.5-turbo-16k",
@@ -36,12 +77,348 @@ ENGINES = [
     "gpt-4-32k-0613",
 ]
 
+# USD per 1000 prompt tokens, matched by engine prefix in this order
+COST_PER_1K_TOKENS = {
+    "gpt-4-32k": 0.06,
+    "gpt-4": 0.03,
+    "gpt-3.5-turbo-16k": 0.003,
+    "gpt-3.5-turbo": 0.002,
+}
+
+
+class TruncationPolicy:
+    """
+    Decides which messages to drop when a conversation is over its token limit
+
+    The first message (the system prompt) is never dropped. Messages are
+    dropped oldest first, starting after the first keep_head messages and
+    skipping pinned ones, until enough tokens have been freed.
+    """
+
+    keep_head: int = 0
+
+    def is_pinned(self, message: dict) -> bool:
+        """
+        Whether a message must survive truncation
+        """
+        return False
+
+    def plan(self, messages: list[dict], sizes: list[int], excess: int) -> list[int]:
+        """
+        Get the indices of the messages to drop, in a single pass
+
+        Args:
+            messages (list[dict]): The conversation
+            sizes (list[int]): Token count of each message
+            excess (int): Number of tokens that must be freed
+
+        Returns:
+            list[int]: Ascending indices to drop
+        """
+        drop: list[int] = []
+        if excess <= 0:
+            return drop
+        for index in range(1 + self.keep_head, len(messages)):
+            if self.is_pinned(messages[index]):
+                continue
+            drop.append(index)
+            excess -= sizes[index]
+            if excess <= 0:
+                break
+        return drop
+
+
+class KeepNewest(TruncationPolicy):
+    """
+    Keep the system prompt and the newest messages that fit
+    """
+
+
+class KeepPinned(TruncationPolicy):
+    """
+    Keep the system prompt, pinned messages and the newest messages that fit
+
+    By default every system message is pinned, e.g. injected search results
+    """
+
+    def __init__(self, predicate: Callable[[dict], bool] = None) -> None:
+        self.predicate = predicate or (lambda message: message["role"] == "system")
+
+    def is_pinned(self, message: dict) -> bool:
+        return self.predicate(message)
+
+
+class DropMiddle(TruncationPolicy):
+    """
+    Keep the system prompt, the first keep_head messages after it and the
+    newest messages that fit
+    """
+
+    def __init__(self, keep_head: int = 1) -> None:
+        self.keep_head = keep_head
+
+
+class BatchResult:
+    """
+    Outcome of one prompt of Chatbot.ask_many
+    """
+
+    __slots__ = (
+        "index",
+        "prompt",
+        "convo_id",
+        "response",
+        "error",
+        "latency",
+        "tokens",
+    )
+
+    def __init__(self, index: int, prompt: str, convo_id: str) -> None:
+        self.index = index
+        self.prompt = prompt
+        self.convo_id = convo_id
+        self.response: str = None
+        self.error: Exception = None
+        self.latency: float = None
+        # Tokens of the conversation including the response
+        self.tokens: int = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self) -> str:
+        outcome = (
+            f"error={self.error!r}" if self.error else f"response={self.response!r}"
+        )
+        return f"BatchResult(index={self.index}, {outcome})"
+
+
+class BatchReport:
+    """
+    Results of Chatbot.ask_many in the order of the prompts
+    """
+
+    def __init__(self, results: list[BatchResult], elapsed: float) -> None:
+        self.results = results
+        self.elapsed = elapsed
+
+    def __iter__(self) -> Iterator[BatchResult]:
+        return iter(self.results)
+
+    def __len__(self) -> int:
+        return len(self.results)
+
+    def stats(self) -> dict:
+        """
+        Throughput, token usage and latency percentiles of the batch
+        """
+        succeeded = [result for result in self.results if result.ok]
+        latencies = [result.latency for result in succeeded]
+        tokens = sum(result.tokens or 0 for result in succeeded)
+        return {
+            "count": len(self.results),
+            "succeeded": len(succeeded),
+            "failed": len(self.results) - len(succeeded),
+            "elapsed": self.elapsed,
+            "throughput": len(succeeded) / self.elapsed if self.elapsed else 0.0,
+            "tokens": tokens,
+            "tokens_per_second": tokens / self.elapsed if self.elapsed else 0.0,
+            "latency_p50": percentile(latencies, 50),
+            "latency_p95": percentile(latencies, 95),
+        }
+
+
+class Reply:
+    """
+    The choices of a reply as they are streamed
+
+    Text is cut at the client-side stop sequences, if any, and the finish
+    reason of each choice is tracked: "stop" or "length" as sent by the
+    API, "stop" for a stop sequence, or "cancelled".
+    """
+
+    def __init__(
+        self,
+        n: int = 1,
+        stop: list[str] = None,
+        on_token: Callable[[], None] = None,
+    ) -> None:
+        self.n = n
+        self.on_token = on_token
+        self.roles: dict[int, str] = {}
+        self.texts: dict[int, list[str]] = collections.defaultdict(list)
+        self.finish_reasons: dict[int, str] = {}
+        # Every chunk of text in order, as (index, text), to cache the reply
+        self.chunks: list[tuple[int, str]] = []
+        self.scanners: dict[int, StopScanner] = (
+            collections.defaultdict(lambda: StopScanner(stop)) if stop else None
+        )
+
+    def add(self, index: int, content: str) -> str:
+        """
+        Add text to a choice and get the part that can be shown
+        """
+        if self.scanners is not None:
+            scanner = self.scanners[index]
+            content = scanner.feed(content)
+            if scanner.stopped:
+                self.finish_reasons[index] = "stop"
+        if content:
+            self.texts[index].append(content)
+            self.chunks.append((index, content))
+        return content
+
+    def feed(self, resp: dict) -> list[tuple[int, str]]:
+        """
+        Take a streamed chunk of the API and get the text to show per choice
+        """
+        shown = []
+        for choice in resp.get("choices") or ():
+            index: int = choice.get("index", 0)
+            delta: dict[str, str] = choice.get("delta") or {}
+            if "role" in delta:
+                self.roles[index] = delta["role"]
+            if delta.get("content") is not None and index not in self.finish_reasons:
+                if self.on_token is not None:
+                    self.on_token()
+                if content := self.add(index, delta["content"]):
+                    shown.append((index, content))
+            if choice.get("finish_reason") and index not in self.finish_reasons:
+                self.finish_reasons[index] = choice["finish_reason"]
+        return shown
+
+    @property
+    def done(self) -> bool:
+        """
+        Whether every choice has finished, so the stream can be closed
+        """
+        return len(self.finish_reasons) >= self.n
+
+    def flush(self) -> list[tuple[int, str]]:
+        """
+        Get the text held back at possible stop sequences once the stream ended
+        """
+        shown = []
+        for index, scanner in (self.scanners or {}).items():
+            if content := scanner.flush():
+                self.texts[index].append(content)
+                self.chunks.append((index, content))
+                shown.append((index, content))
+        return shown
+
+    def cancel(self) -> None:
+        """
+        Mark every unfinished choice as cancelled, keeping its text so far
+        """
+        self.flush()
+        for index in {0, *self.texts}:
+            self.finish_reasons.setdefault(index, "cancelled")
+
+    @property
+    def cancelled(self) -> bool:
+        return "cancelled" in self.finish_reasons.values()
+
+
+def has_token(event: Event) -> bool:
+    """
+    Whether a streamed chunk of the API carries text
+    """
+    if event.data == "[DONE]":
+        return False
+    try:
+        choices = event.json().get("choices")
+    except JSONDecodeError:
+        return False
+    return any((choice.get("delta") or {}).get("content") for choice in choices or ())
+
+
+def split_choices(stream: Iterator[tuple[int, str]], n: int) -> list[Iterator[str]]:
+    """
+    Split an all_choices stream of ask_stream into one text stream per choice
+
+    The streams share one response, so text of a choice that is not being
+    read yet is buffered until it is.
+    """
+    stream = iter(stream)
+    buffers = [collections.deque() for _ in range(n)]
+
+    def choice_stream(index: int) -> Iterator[str]:
+        buffer = buffers[index]
+        while True:
+            if buffer:
+                yield buffer.popleft()
+                continue
+            try:
+                other, text = next(stream)
+            except StopIteration:
+                return
+            if other < n:
+                buffers[other].append(text)
+
+    return [choice_stream(index) for index in range(n)]
+
+
+def asplit_choices(
+    stream: AsyncIterator[tuple[int, str]],
+    n: int,
+) -> list[AsyncIterator[str]]:
+    """
+    Same as split_choices for ask_stream_async, to be called in the event loop
+    that reads the streams. They can be read from concurrent tasks.
+    """
+    buffers = [collections.deque() for _ in range(n)]
+    lock = asyncio.Lock()
+    finished = False
+
+    async def choice_stream(index: int) -> AsyncIterator[str]:
+        nonlocal finished
+        buffer = buffers[index]
+        while True:
+            if buffer:
+                yield buffer.popleft()
+                continue
+            async with lock:
+                if buffer:
+                    continue
+                if finished:
+                    return
+                try:
+                    other, text = await stream.__anext__()
+                except StopAsyncIteration:
+                    finished = True
+                    return
+                if other < n:
+                    buffers[other].append(text)
+
+    return [choice_stream(index) for index in range(n)]
+
+
+# A prompt, or (prompt, convo_id) or (prompt, convo_id, overrides)
+BatchItem = Union[str, tuple]
+
 
 class Chatbot:
     """
     Official ChatGPT API
     """
 
+    # Attributes holding objects rather than configuration, which save
+    # leaves out and load keeps
+    UNSAVED_KEYS = frozenset(
+        (
+            "transport",
+            "truncate_policy",
+            "rate_limiter",
+            "retry_policy",
+            "finish_reasons",
+            "response_cache",
+            "message_table",
+            "deadline",
+            "hedge_policy",
+        ),
+    )
+
     def __init__(
         self,
         api_key: str,
@@ -56,9 +433,41 @@ class Chatbot:
         reply_count: int = 1,
         truncate_limit: int = None,
         system_prompt: str = "You are ChatGPT, a large language model trained by OpenAI. Respond conversationally",
+        check_token_count: bool = False,
+        truncate_policy: TruncationPolicy = None,
+        warm_up: bool = False,
+        transport: Transport = None,
+        conversation_store: ConversationStore = None,
+        rate_limiter: RateLimiter = None,
+        retry_policy: RetryPolicy = None,
+        response_cache: ResponseCache = None,
+        message_table: MessageTable = None,
+        deadline: Deadline = None,
+        hedge_policy: HedgePolicy = None,
     ) -> None:
         """
         Initialize Chatbot with API key (from https://platform.openai.com/account/api-keys)
+
+        When check_token_count is set, every get_token_count call verifies the
+        cached token ledger against a full recount of the conversation.
+        When warm_up is set, the encoder for the engine is loaded in a
+        background thread instead of on the first token count.
+        HTTP clients come from transport, which defaults to the process-wide
+        pooled transport for the proxy.
+        Conversations are kept in conversation_store, which defaults to an
+        in-memory MemoryStore. Pass a SQLiteStore to persist them.
+        Requests wait for rate_limiter, which defaults to the process-wide
+        limiter of the API key and engine, and failed requests are retried
+        as retry_policy decides.
+        With response_cache set, replies to requests with temperature 0 are
+        cached and replayed. Pass cache=True or False to ask to override.
+        Messages are interned in message_table, which can be shared between
+        chatbots to hold and count common prompts once.
+        Streams are bounded by the limits of deadline, which can be passed
+        per call as well, and raise StreamTimeoutError with the partial
+        reply once one runs out.
+        With hedge_policy set, ask_stream_async sends a duplicate request
+        when the first token is late and keeps the faster stream.
         """
         self.engine: str = engine
         self.api_key: str = api_key
@@ -87,42 +496,68 @@ class Chatbot:
         self.frequency_penalty: float = frequency_penalty
         self.reply_count: int = reply_count
         self.timeout: float = timeout
+        self.check_token_count: bool = check_token_count
+        self.truncate_policy: TruncationPolicy = truncate_policy or KeepNewest()
+        self.rate_limiter: RateLimiter = rate_limiter
+        self.retry_policy: RetryPolicy = retry_policy or RetryPolicy()
+        self.response_cache: ResponseCache = response_cache
+        self.deadline: Deadline = deadline
+        self.hedge_policy: HedgePolicy = hedge_policy
         self.proxy = proxy
-        self.session = requests.Session()
-        self.session.proxies.update(
-            {
-                "http": proxy,
-                "https": proxy,
-            },
+        self.transport: Transport = transport or get_transport(
+            proxy=proxy
+            or os.environ.get("all_proxy")
+            or os.environ.get("ALL_PROXY")
+            or None,
         )
-        if proxy := (
-            proxy or os.environ.get("all_proxy") or os.environ.get("ALL_PROXY") or None
-        ):
-            if "socks5h" not in proxy:
-                self.aclient = httpx.AsyncClient(
-                    follow_redirects=True,
-                    proxies=proxy,
-                    timeout=timeout,
-                )
-        else:
-            self.aclient = httpx.AsyncClient(
-                follow_redirects=True,
-                proxies=proxy,
-                timeout=timeout,
-            )
 
-        self.conversation: dict[str, list[dict]] = {
-            "default": [
-                {
-                    "role": "system",
-                    "content": system_prompt,
-                },
-            ],
-        }
+        # How the last reply of each conversation ended, e.g. "stop"
+        self.finish_reasons: dict[str, str] = {}
+        self.message_table: MessageTable = message_table or MessageTable()
+        self.conversation: ConversationStore = (
+            MemoryStore() if conversation_store is None else conversation_store
+        )
+        self.conversation.message_table = self.message_table
+        if "default" not in self.conversation:
+            self.conversation["default"] = [
+                self.message_table.intern(Message("system", system_prompt)),
+            ]
+        # Per-message token counts, kept in step with self.conversation
+        self.__token_ledger: dict[str, list[int]] = {}
+        self.__token_totals: dict[str, int] = {}
+        self.__token_engine: str = None
+        self.__token_encoding: tiktoken.Encoding = None
+        self.conversation.on_evict = self.__clear_token_ledger
 
-        if self.get_token_count("default") > self.max_tokens:
+        if self.engine not in ENGINES:
+            raise NotImplementedError(
+                f"Engine {self.engine} is not supported. Select from {ENGINES}",
+            )
+        if warm_up:
+            tokenizer.warm_up([self.engine])
+        # Every token is at least one byte, so a short system prompt can be
+        # checked without waiting for the encoder to load
+        upper_bound = len(system_prompt.encode("utf-8")) + len("system") + 10
+        if (
+            upper_bound > self.max_tokens
+            and self.get_token_count("default") > self.max_tokens
+        ):
             raise t.ActionRefuseError("System prompt is too long")
 
+    @property
+    def session(self) -> httpx.Client:
+        """
+        Pooled sync client of the transport
+        """
+        return self.transport.client
+
+    @property
+    def aclient(self) -> httpx.AsyncClient:
+        """
+        Pooled async client of the transport for the running event loop
+        """
+        return self.transport.aclient
+
     def add_to_conversation(
         self,
         message: str,
@@ -132,53 +567,443 @@ class Chatbot:
         """
         Add a message to the conversation
         """
-        self.conversation[convo_id].append({"role": role, "content": message})
+        messages = self.conversation[convo_id]
+        ledger = self.__token_ledger.get(convo_id)
+        in_sync = ledger is not None and len(ledger) == len(messages)
+        message = self.message_table.intern(Message(role, message))
+        if in_sync and self.__token_engine == self.engine:
+            num_tokens = self.__count_message_tokens(message)
+            self.conversation.append_message(
+                convo_id,
+                message,
+                tokens=num_tokens,
+                encoding=self.__token_encoding.name,
+            )
+            ledger.append(num_tokens)
+            self.__token_totals[convo_id] += num_tokens
+        else:
+            self.conversation.append_message(convo_id, message)
 
     def __truncate_conversation(self, convo_id: str = "default") -> None:
         """
         Truncate the conversation
         """
-        while True:
-            if (
-                self.get_token_count(convo_id) > self.truncate_limit
-                and len(self.conversation[convo_id]) > 1
-            ):
-                # Don't remove the first message
-                self.conversation[convo_id].pop(1)
-            else:
-                break
+        excess = self.get_token_count(convo_id) - self.truncate_limit
+        messages = self.conversation[convo_id]
+        ledger = self.__token_ledger[convo_id]
+        drop = self.truncate_policy.plan(messages, ledger, excess)
+        if not drop:
+            return
+        self.__token_totals[convo_id] -= sum(ledger[index] for index in drop)
+        self.conversation.remove_messages(convo_id, drop)
+        remove_indices(ledger, drop)
 
-    # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-    def get_token_count(self, convo_id: str = "default") -> int:
+    def __count_message_tokens(self, message: dict) -> int:
         """
-        Get token count
+        Count the tokens of a single message, once per content and encoding
+        """
+        num_tokens = self.message_table.get_tokens(message, self.__token_encoding.name)
+        if num_tokens is None:
+            num_tokens = self.__encode_message_tokens(message)
+            self.message_table.set_tokens(
+                message,
+                self.__token_encoding.name,
+                num_tokens,
+            )
+        return num_tokens
+
+    def __encode_message_tokens(
+        self,
+        message: dict,
+        encoded_lengths: Iterator[int] = None,
+    ) -> int:
+        """
+        Encode and count the tokens of a single message, taking the length of
+        each non-empty value from encoded_lengths when it is given
+        """
+        # every message follows <im_start>{role/name}\n{content}<im_end>\n
+        num_tokens = 5
+        for key, value in message.items():
+            if value:
+                num_tokens += (
+                    next(encoded_lengths)
+                    if encoded_lengths is not None
+                    else len(self.__token_encoding.encode(value))
+                )
+            if key == "name":  # if there's a name, the role is omitted
+                num_tokens += 5  # role is always required and always 1 token
+        return num_tokens
+
+    def __get_token_ledger(self, convo_id: str) -> list[int]:
+        """
+        Get the per-message token counts of a conversation, recounting it if the
+        ledger is missing or out of step with the conversation
+        """
+        self.__check_token_engine()
+        messages = self.conversation[convo_id]
+        ledger = self.__token_ledger.get(convo_id)
+        if ledger is None or len(ledger) != len(messages):
+            ledger = self.__load_token_ledger(convo_id)
+        if ledger is None:
+            ledger = [self.__count_message_tokens(message) for message in messages]
+            self.__set_token_ledger(convo_id, ledger)
+        return ledger
+
+    def __load_token_ledger(self, convo_id: str) -> list[int]:
+        """
+        Take the token counts of a conversation from the store if it has them
+        for the current encoding
+        """
+        ledger = self.conversation.get_token_counts(
+            convo_id,
+            self.__token_encoding.name,
+        )
+        if ledger is None or len(ledger) != len(self.conversation[convo_id]):
+            return None
+        self.__token_ledger[convo_id] = ledger
+        self.__token_totals[convo_id] = sum(ledger)
+        return ledger
+
+    def __set_token_ledger(self, convo_id: str, ledger: list[int]) -> None:
+        """
+        Cache freshly counted tokens of a conversation and persist them
+        """
+        self.__token_ledger[convo_id] = ledger
+        self.__token_totals[convo_id] = sum(ledger)
+        self.conversation.set_token_counts(
+            convo_id,
+            self.__token_encoding.name,
+            ledger,
+        )
+
+    def __check_token_engine(self) -> None:
+        """
+        Load the encoder for the current engine, dropping all cached counts
+        if the engine has changed since they were made
         """
         if self.engine not in ENGINES:
             raise NotImplementedError(
                 f"Engine {self.engine} is not supported. Select from {ENGINES}",
             )
-        tiktoken.model.MODEL_TO_ENCODING["gpt-4"] = "cl100k_base"
-
-        encoding = tiktoken.encoding_for_model(self.engine)
-
-        num_tokens = 0
-        for message in self.conversation[convo_id]:
-            # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            num_tokens += 5
-            for key, value in message.items():
-                if value:
-                    num_tokens += len(encoding.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens += 5  # role is always required and always 1 token
+        if self.__token_engine != self.engine:
+            self.__token_encoding = tokenizer.get_encoding(self.engine)
+            self.__token_engine = self.engine
+            self.__token_ledger.clear()
+            self.__token_totals.clear()
+
+    def __clear_token_ledger(self, convo_id: str = None) -> None:
+        """
+        Drop cached token counts for a conversation, or for all of them
+        """
+        if convo_id is None:
+            self.__token_ledger.clear()
+            self.__token_totals.clear()
+        else:
+            self.__token_ledger.pop(convo_id, None)
+            self.__token_totals.pop(convo_id, None)
+
+    # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    def get_token_count(self, convo_id: str = "default") -> int:
+        """
+        Get token count
+        """
+        self.__get_token_ledger(convo_id)
+        num_tokens = self.__token_totals[convo_id]
         num_tokens += 5  # every reply is primed with <im_start>assistant
+        if self.check_token_count:
+            recount = sum(
+                self.__encode_message_tokens(message)
+                for message in self.conversation[convo_id]
+            )
+            assert (
+                num_tokens == recount + 5
+            ), f"Token ledger out of sync for {convo_id}: {num_tokens} != {recount + 5}"
         return num_tokens
 
+    def count_tokens_bulk(
+        self,
+        convo_ids: list[str] = None,
+        num_threads: int = 8,
+    ) -> dict[str, dict]:
+        """
+        Get the token count and cost estimate of many conversations at once
+
+        Messages of conversations without up to date cached counts are encoded
+        together in one batch on tiktoken's thread pool, each distinct message
+        only once.
+
+        Args:
+            convo_ids (list[str], optional): Conversations to count. Defaults to all.
+            num_threads (int, optional): Encoder threads. Defaults to 8.
+
+        Returns:
+            dict[str, dict]: {
+                "<convo_id>": {
+                    "tokens": int,
+                    "cost": float, # USD
+                },
+            }
+        """
+        self.__check_token_engine()
+        if convo_ids is None:
+            convo_ids = list(self.conversation)
+        # Loading conversations from a store can evict others and their
+        # ledgers, so totals are collected as each conversation is counted
+        totals: dict[str, int] = {}
+        stale = []
+        for convo_id in convo_ids:
+            ledger = self.__token_ledger.get(convo_id)
+            if ledger is None or len(ledger) != len(self.conversation[convo_id]):
+                ledger = self.__load_token_ledger(convo_id)
+            if ledger is None:
+                stale.append(convo_id)
+            else:
+                totals[convo_id] = self.__token_totals[convo_id]
+        encoding = self.__token_encoding.name
+        # Counts by content hash, kept here since the table drops those of
+        # conversations evicted meanwhile and never holds plain dicts
+        counted: dict[str, int] = {}
+        uncounted: dict[str, dict] = {}
+        for convo_id in stale:
+            for message in self.conversation[convo_id]:
+                key = self.message_table.key_of(message)
+                if key in counted or key in uncounted:
+                    continue
+                num_tokens = self.message_table.get_tokens(message, encoding)
+                if num_tokens is None:
+                    uncounted[key] = message
+                else:
+                    counted[key] = num_tokens
+        texts = [
+            value
+            for message in uncounted.values()
+            for value in message.values()
+            if value
+        ]
+        encoded_lengths = (
+            len(tokens)
+            for tokens in self.__token_encoding.encode_batch(
+                texts,
+                num_threads=num_threads,
+            )
+        )
+        for key, message in uncounted.items():
+            counted[key] = self.__encode_message_tokens(message, encoded_lengths)
+            self.message_table.set_tokens(message, encoding, counted[key])
+        for convo_id in stale:
+            ledger = [
+                counted[self.message_table.key_of(message)]
+                for message in self.conversation[convo_id]
+            ]
+            self.__set_token_ledger(convo_id, ledger)
+            totals[convo_id] = sum(ledger)
+        counts = {}
+        for convo_id in convo_ids:
+            # every reply is primed with <im_start>assistant
+            num_tokens = totals[convo_id] + 5
+            counts[convo_id] = {"tokens": num_tokens, "cost": self.get_cost(num_tokens)}
+        return counts
+
+    def get_cost(self, num_tokens: int) -> float:
+        """
+        Estimate the cost in USD of sending num_tokens prompt tokens
+        """
+        for prefix, cost in COST_PER_1K_TOKENS.items():
+            if self.engine.startswith(prefix):
+                return num_tokens / 1000 * cost
+        return 0.0
+
     def get_max_tokens(self, convo_id: str) -> int:
         """
         Get max tokens
         """
         return self.max_tokens - self.get_token_count(convo_id)
 
+    @contextlib.contextmanager
+    def __stream(
+        self,
+        url: str,
+        headers: dict,
+        body: dict,
+        num_tokens: int,
+        timeout: float,
+        api_key: str,
+        metrics: RequestMetrics,
+        deadline: Deadline = None,
+    ) -> Iterator[httpx.Response]:
+        """
+        Open a streamed completion once it fits the rate limits, retrying
+        failures that occur before the response starts, as long as the
+        deadline allows
+        """
+        limiter = self.rate_limiter or get_rate_limiter(api_key, body["model"])
+        headers = {**headers, "Content-Type": "application/json"}
+        content = encode_body(body)
+        started = False
+        for attempt in range(self.retry_policy.max_retries + 1):
+            metrics.add_phase("queue", limiter.acquire(num_tokens))
+            metrics.attempts = attempt + 1
+            attempt_timeout = timeout
+            if deadline is not None:
+                deadline.check()
+                connect, read = deadline.http_timeout(timeout)
+                attempt_timeout = httpx.Timeout(timeout, connect=connect, read=read)
+            trace = RequestTrace()
+            try:
+                with self.session.stream(
+                    "post",
+                    url,
+                    headers=headers,
+                    content=content,
+                    timeout=attempt_timeout,
+                    extensions={"trace": trace},
+                ) as response:
+                    self.transport.stats.record(trace)
+                    metrics.add_trace(trace.events)
+                    limiter.observe(response.headers)
+                    if response.status_code == 200:
+                        metrics.mark_first_byte()
+                        # Errors while streaming are not retried
+                        started = True
+                        yield response
+                        return
+                    response.read()
+                    delay = self.retry_policy.get_delay(
+                        attempt,
+                        response.status_code,
+                        response.headers,
+                    )
+                    if delay is None:
+                        raise t.APIConnectionError(
+                            f"{response.status_code} {response.reason_phrase} {response.text}",
+                        )
+            except httpx.TransportError:
+                delay = self.retry_policy.get_delay(attempt)
+                if started or delay is None:
+                    raise
+            remaining = None if deadline is None else deadline.remaining()
+            if remaining is not None and remaining < delay:
+                # The retry would start after a limit has run out
+                raise deadline.timeout_error()
+            metrics.add_phase("retry", delay)
+            time.sleep(delay)
+
+    @contextlib.asynccontextmanager
+    async def __astream(
+        self,
+        url: str,
+        headers: dict,
+        body: dict,
+        num_tokens: int,
+        timeout: float,
+        api_key: str,
+        metrics: RequestMetrics,
+        deadline: Deadline = None,
+    ) -> AsyncIterator[httpx.Response]:
+        """
+        Same as __stream on the async client
+        """
+        limiter = self.rate_limiter or get_rate_limiter(api_key, body["model"])
+        headers = {**headers, "Content-Type": "application/json"}
+        content = encode_body(body)
+        started = False
+        for attempt in range(self.retry_policy.max_retries + 1):
+            metrics.add_phase("queue", await limiter.acquire_async(num_tokens))
+            metrics.attempts = attempt + 1
+            attempt_timeout = timeout
+            if deadline is not None:
+                deadline.check()
+                connect, read = deadline.http_timeout(timeout)
+                attempt_timeout = httpx.Timeout(timeout, connect=connect, read=read)
+            trace = AsyncRequestTrace()
+            try:
+                async with self.aclient.stream(
+                    "post",
+                    url,
+                    headers=headers,
+                    content=content,
+                    timeout=attempt_timeout,
+                    extensions={"trace": trace},
+                ) as response:
+                    self.transport.stats.record(trace)
+                    metrics.add_trace(trace.events)
+                    limiter.observe(response.headers)
+                    if response.status_code == 200:
+                        metrics.mark_first_byte()
+                        # Errors while streaming are not retried
+                        started = True
+                        yield response
+                        return
+                    await response.aread()
+                    delay = self.retry_policy.get_delay(
+                        attempt,
+                        response.status_code,
+                        response.headers,
+                    )
+                    if delay is None:
+                        raise t.APIConnectionError(
+                            f"{response.status_code} {response.reason_phrase} {response.text}",
+                        )
+            except httpx.TransportError:
+                delay = self.retry_policy.get_delay(attempt)
+                if started or delay is None:
+                    raise
+            remaining = None if deadline is None else deadline.remaining()
+            if remaining is not None and remaining < delay:
+                # The retry would start after a limit has run out
+                raise deadline.timeout_error()
+            metrics.add_phase("retry", delay)
+            await asyncio.sleep(delay)
+
+    @contextlib.asynccontextmanager
+    async def __aevents(
+        self,
+        url: str,
+        body: dict,
+        num_tokens: int,
+        timeout: float,
+        api_key: str,
+        metrics: RequestMetrics,
+        deadline: Deadline = None,
+        hedge_policy: HedgePolicy = None,
+    ) -> AsyncIterator[AsyncIterator[Event]]:
+        """
+        Events of a streamed completion, raced against a duplicate request
+        if it is slow to start and hedge_policy is set
+        """
+        if hedge_policy is None:
+            async with self.__astream(
+                url,
+                {"Authorization": f"Bearer {api_key}"},
+                body,
+                num_tokens=num_tokens,
+                timeout=timeout,
+                api_key=api_key,
+                metrics=metrics,
+                deadline=deadline,
+            ) as response:
+                yield aiter_events(response.aiter_bytes())
+            return
+
+        @contextlib.asynccontextmanager
+        async def open_stream(hedge: bool) -> AsyncIterator[AsyncIterator[Event]]:
+            key = (hedge and hedge_policy.api_key) or api_key
+            async with self.__astream(
+                (hedge and hedge_policy.api_url) or url,
+                {"Authorization": f"Bearer {key}"},
+                body,
+                num_tokens=num_tokens,
+                timeout=timeout,
+                api_key=key,
+                # The duplicate's connection phases are not the request's
+                metrics=RequestMetrics("V3", model=body["model"]) if hedge else metrics,
+                deadline=deadline,
+            ) as response:
+                yield aiter_events(response.aiter_bytes())
+
+        async with hedged(hedge_policy, open_stream, has_token, deadline) as events:
+            yield events
+
     def ask_stream(
         self,
         prompt: str,
@@ -186,16 +1011,36 @@ class Chatbot:
         convo_id: str = "default",
         model: str = None,
         pass_history: bool = True,
+        all_choices: bool = False,
+        stop: list[str] = None,
+        cancel: CancelToken = None,
         **kwargs,
     ):
         """
         Ask a question
+
+        With n > 1 the first choice is streamed and added to convo_id, and
+        every other choice is stored in its own branch, see choice_branch.
+        all_choices streams (index, text) tuples of every choice instead.
+
+        Text is cut at the first of the stop sequences and the stream is
+        closed once every choice has stopped. Cancelling the cancel token,
+        closing the generator or cancelling its task closes the connection
+        and keeps the reply so far. finish_reasons[convo_id] tells how the
+        reply ended, "cancelled" in that case.
+
+        The deadline argument overrides the Chatbot's for this call.
         """
+        deadline = kwargs.get("deadline", self.deadline)
+        if deadline is not None:
+            deadline = deadline.start()
         # Make conversation if it doesn't exist
         if convo_id not in self.conversation:
             self.reset(convo_id=convo_id, system_prompt=self.system_prompt)
         self.add_to_conversation(prompt, "user", convo_id=convo_id)
         self.__truncate_conversation(convo_id=convo_id)
+        if deadline is not None:
+            deadline.check()
         # Get response
         if os.environ.get("API_URL") and os.environ.get("MODEL_NAME"):
             # https://learn.microsoft.com/en-us/azure/cognitive-services/openai/chatgpt-quickstart?tabs=command-line&pivots=rest-api
@@ -212,61 +1057,92 @@ class Chatbot:
                 or "https://api.openai.com/v1/chat/completions"
             )
             headers = {"Authorization": f"Bearer {kwargs.get('api_key', self.api_key)}"}
-        response = self.session.post(
-            url,
-            headers=headers,
-            json={
-                "model": os.environ.get("MODEL_NAME") or model or self.engine,
-                "messages": self.conversation[convo_id] if pass_history else [prompt],
-                "stream": True,
-                # kwargs
-                "temperature": kwargs.get("temperature", self.temperature),
-                "top_p": kwargs.get("top_p", self.top_p),
-                "presence_penalty": kwargs.get(
-                    "presence_penalty",
-                    self.presence_penalty,
-                ),
-                "frequency_penalty": kwargs.get(
-                    "frequency_penalty",
-                    self.frequency_penalty,
-                ),
-                "n": kwargs.get("n", self.reply_count),
-                "user": role,
-                "max_tokens": min(
-                    self.get_max_tokens(convo_id=convo_id),
-                    kwargs.get("max_tokens", self.max_tokens),
-                ),
-            },
-            timeout=kwargs.get("timeout", self.timeout),
-            stream=True,
-        )
-        if response.status_code != 200:
-            raise t.APIConnectionError(
-                f"{response.status_code} {response.reason} {response.text}",
-            )
-        response_role: str or None = None
-        full_response: str = ""
-        for line in response.iter_lines():
-            if not line:
-                continue
-            # Remove "data: "
-            line = line.decode("utf-8")[6:]
-            if line == "[DONE]":
-                break
-            resp: dict = json.loads(line)
-            choices = resp.get("choices")
-            if not choices:
-                continue
-            delta = choices[0].get("delta")
-            if not delta:
-                continue
-            if "role" in delta:
-                response_role = delta["role"]
-            if "content" in delta:
-                content = delta["content"]
-                full_response += content
+        body = {
+            "model": os.environ.get("MODEL_NAME") or model or self.engine,
+            # Encoded from each message's cached JSON when the request is sent
+            "messages": self.conversation[convo_id] if pass_history else [prompt],
+            "stream": True,
+            # kwargs
+            "temperature": kwargs.get("temperature", self.temperature),
+            "top_p": kwargs.get("top_p", self.top_p),
+            "presence_penalty": kwargs.get(
+                "presence_penalty",
+                self.presence_penalty,
+            ),
+            "frequency_penalty": kwargs.get(
+                "frequency_penalty",
+                self.frequency_penalty,
+            ),
+            "n": kwargs.get("n", self.reply_count),
+            "user": role,
+            "max_tokens": min(
+                self.get_max_tokens(convo_id=convo_id),
+                kwargs.get("max_tokens", self.max_tokens),
+            ),
+        }
+        cache_key, cached = self.__lookup_cache(body, kwargs, stop)
+        if cached is not None:
+            reply = Reply(n=body["n"])
+            yield from self.__replay(cached, reply, all_choices)
+            self.__store_choices(convo_id, reply)
+            return
+        with measure("V3", model=body["model"], convo_id=convo_id) as metrics:
+            reply = Reply(n=body["n"], stop=stop, on_token=metrics.mark_token)
+            try:
+                with self.__stream(
+                    url,
+                    headers,
+                    body,
+                    # max_tokens counts towards the token limit as well
+                    num_tokens=self.get_token_count(convo_id) + body["max_tokens"],
+                    timeout=kwargs.get("timeout", self.timeout),
+                    api_key=kwargs.get("api_key", self.api_key),
+                    metrics=metrics,
+                    deadline=deadline,
+                ) as response:
+                    for event in iter_events(response.iter_bytes()):
+                        if event.data == "[DONE]":
+                            break
+                        if cancel is not None and cancel.cancelled:
+                            # Leaving the block closes the connection
+                            reply.cancel()
+                            break
+                        shown = reply.feed(event.json())
+                        if deadline is not None:
+                            deadline.check(metrics.tokens)
+                        for index, content in shown:
+                            if all_choices:
+                                yield index, content
+                            elif index == 0:
+                                yield content
+                        if reply.done:
+                            break
+            except GeneratorExit:
+                # The consumer stopped early, keep what it has seen
+                reply.cancel()
+                metrics.cancel()
+                self.__store_choices(convo_id, reply)
+                raise
+            except t.StreamTimeoutError as error:
+                error.partial = "".join(reply.texts.get(0, ()))
+                raise
+            except httpx.TimeoutException as error:
+                if deadline is None:
+                    raise
+                raise deadline.timeout_error(
+                    "".join(reply.texts.get(0, ())),
+                    connect=isinstance(error, httpx.ConnectTimeout),
+                ) from error
+            if reply.cancelled:
+                metrics.cancel()
+        for index, content in reply.flush():
+            if all_choices:
+                yield index, content
+            elif index == 0:
                 yield content
-        self.add_to_conversation(full_response, response_role, convo_id=convo_id)
+        if cache_key is not None and not reply.cancelled:
+            self.__cache_reply(cache_key, reply)
+        self.__store_choices(convo_id, reply)
 
     async def ask_stream_async(
         self,
@@ -275,77 +1151,216 @@ class Chatbot:
         convo_id: str = "default",
         model: str = None,
         pass_history: bool = True,
+        all_choices: bool = False,
+        stop: list[str] = None,
+        cancel: CancelToken = None,
         **kwargs,
-    ) -> AsyncGenerator[str, None]:
+    ) -> AsyncGenerator[Union[str, tuple[int, str]], None]:
         """
         Ask a question
+
+        With n > 1 the first choice is streamed and added to convo_id, and
+        every other choice is stored in its own branch, see choice_branch.
+        all_choices streams (index, text) tuples of every choice instead.
+
+        Text is cut at the first of the stop sequences and the stream is
+        closed once every choice has stopped. Cancelling the cancel token,
+        closing the generator or cancelling its task closes the connection
+        and keeps the reply so far. finish_reasons[convo_id] tells how the
+        reply ended, "cancelled" in that case.
+
+        The deadline and hedge_policy arguments override the Chatbot's for
+        this call.
         """
+        deadline = kwargs.get("deadline", self.deadline)
+        if deadline is not None:
+            deadline = deadline.start()
         # Make conversation if it doesn't exist
         if convo_id not in self.conversation:
             self.reset(convo_id=convo_id, system_prompt=self.system_prompt)
         self.add_to_conversation(prompt, "user", convo_id=convo_id)
         self.__truncate_conversation(convo_id=convo_id)
+        if deadline is not None:
+            deadline.check()
         # Get response
-        async with self.aclient.stream(
-            "post",
-            os.environ.get("API_URL") or "https://api.openai.com/v1/chat/completions",
-            headers={"Authorization": f"Bearer {kwargs.get('api_key', self.api_key)}"},
-            json={
-                "model": model or self.engine,
-                "messages": self.conversation[convo_id] if pass_history else [prompt],
-                "stream": True,
-                # kwargs
-                "temperature": kwargs.get("temperature", self.temperature),
-                "top_p": kwargs.get("top_p", self.top_p),
-                "presence_penalty": kwargs.get(
-                    "presence_penalty",
-                    self.presence_penalty,
-                ),
-                "frequency_penalty": kwargs.get(
-                    "frequency_penalty",
-                    self.frequency_penalty,
-                ),
-                "n": kwargs.get("n", self.reply_count),
-                "user": role,
-                "max_tokens": min(
-                    self.get_max_tokens(convo_id=convo_id),
-                    kwargs.get("max_tokens", self.max_tokens),
-                ),
+        body = {
+            "model": model or self.engine,
+            # Encoded from each message's cached JSON when the request is sent
+            "messages": self.conversation[convo_id] if pass_history else [prompt],
+            "stream": True,
+            # kwargs
+            "temperature": kwargs.get("temperature", self.temperature),
+            "top_p": kwargs.get("top_p", self.top_p),
+            "presence_penalty": kwargs.get(
+                "presence_penalty",
+                self.presence_penalty,
+            ),
+            "frequency_penalty": kwargs.get(
+                "frequency_penalty",
+                self.frequency_penalty,
+            ),
+            "n": kwargs.get("n", self.reply_count),
+            "user": role,
+            "max_tokens": min(
+                self.get_max_tokens(convo_id=convo_id),
+                kwargs.get("max_tokens", self.max_tokens),
+            ),
+        }
+        cache_key, cached = self.__lookup_cache(body, kwargs, stop)
+        if cached is not None:
+            reply = Reply(n=body["n"])
+            for item in self.__replay(cached, reply, all_choices):
+                yield item
+            self.__store_choices(convo_id, reply)
+            return
+        with measure("V3", model=body["model"], convo_id=convo_id) as metrics:
+            reply = Reply(n=body["n"], stop=stop, on_token=metrics.mark_token)
+            try:
+                async with self.__aevents(
+                    os.environ.get("API_URL")
+                    or "https://api.openai.com/v1/chat/completions",
+                    body,
+                    # max_tokens counts towards the token limit as well
+                    num_tokens=self.get_token_count(convo_id) + body["max_tokens"],
+                    timeout=kwargs.get("timeout", self.timeout),
+                    api_key=kwargs.get("api_key", self.api_key),
+                    metrics=metrics,
+                    deadline=deadline,
+                    hedge_policy=kwargs.get("hedge_policy", self.hedge_policy),
+                ) as events:
+                    if deadline is not None:
+                        events = timed(events, deadline)
+                    async for event in events:
+                        if event.data == "[DONE]":
+                            break
+                        if cancel is not None and cancel.cancelled:
+                            # Leaving the block closes the connection
+                            reply.cancel()
+                            break
+                        resp: dict = event.json()
+                        if "error" in resp:
+                            raise t.ResponseError(f"{resp['error']}")
+                        shown = reply.feed(resp)
+                        if deadline is not None:
+                            deadline.check(metrics.tokens)
+                        for index, content in shown:
+                            if all_choices:
+                                yield index, content
+                            elif index == 0:
+                                yield content
+                        if reply.done:
+                            break
+            except (GeneratorExit, asyncio.CancelledError):
+                # aclose() or a cancelled task, keep what was streamed
+                reply.cancel()
+                metrics.cancel()
+                self.__store_choices(convo_id, reply)
+                raise
+            except t.StreamTimeoutError as error:
+                error.partial = "".join(reply.texts.get(0, ()))
+                raise
+            except httpx.TimeoutException as error:
+                if deadline is None:
+                    raise
+                raise deadline.timeout_error(
+                    "".join(reply.texts.get(0, ())),
+                    connect=isinstance(error, httpx.ConnectTimeout),
+                ) from error
+            if reply.cancelled:
+                metrics.cancel()
+        for index, content in reply.flush():
+            if all_choices:
+                yield index, content
+            elif index == 0:
+                yield content
+        if cache_key is not None and not reply.cancelled:
+            self.__cache_reply(cache_key, reply)
+        self.__store_choices(convo_id, reply)
+
+    def __lookup_cache(
+        self,
+        body: dict,
+        kwargs: dict,
+        stop: list[str] = None,
+    ) -> tuple[str, dict]:
+        """
+        Get the cache key of a request and its cached reply, if it is cacheable
+        """
+        if self.response_cache is None or not kwargs.get(
+            "cache",
+            body["temperature"] == 0,
+        ):
+            return None, None
+        # Replies cut at stop sequences are cached apart from whole ones
+        cache_key = request_key({**body, "stop": stop} if stop else body)
+        return cache_key, self.response_cache.get(cache_key)
+
+    def __cache_reply(self, cache_key: str, reply: Reply) -> None:
+        """
+        Cache a finished reply under the key of its request
+        """
+        self.response_cache.set(
+            cache_key,
+            {
+                "roles": list(reply.roles.items()),
+                "chunks": reply.chunks,
+                "finish_reasons": list(reply.finish_reasons.items()),
             },
-            timeout=kwargs.get("timeout", self.timeout),
-        ) as response:
-            if response.status_code != 200:
-                await response.aread()
-                raise t.APIConnectionError(
-                    f"{response.status_code} {response.reason_phrase} {response.text}",
-                )
+        )
 
-            response_role: str = ""
-            full_response: str = ""
-            async for line in response.aiter_lines():
-                line = line.strip()
-                if not line:
-                    continue
-                # Remove "data: "
-                line = line[6:]
-                if line == "[DONE]":
-                    break
-                resp: dict = json.loads(line)
-                if "error" in resp:
-                    raise t.ResponseError(f"{resp['error']}")
-                choices = resp.get("choices")
-                if not choices:
-                    continue
-                delta: dict[str, str] = choices[0].get("delta")
-                if not delta:
-                    continue
-                if "role" in delta:
-                    response_role = delta["role"]
-                if "content" in delta:
-                    content: str = delta["content"]
-                    full_response += content
-                    yield content
-        self.add_to_conversation(full_response, response_role, convo_id=convo_id)
+    @staticmethod
+    def __replay(
+        cached: dict,
+        reply: Reply,
+        all_choices: bool,
+    ) -> Iterator[Union[str, tuple[int, str]]]:
+        """
+        Stream a cached reply the way it was streamed by the API
+        """
+        reply.roles.update({index: role for index, role in cached["roles"]})
+        reply.finish_reasons.update(
+            {index: reason for index, reason in cached.get("finish_reasons", ())},
+        )
+        for index, content in cached["chunks"]:
+            reply.add(index, content)
+            if all_choices:
+                yield index, content
+            elif index == 0:
+                yield content
+
+    @staticmethod
+    def choice_branch(convo_id: str, index: int) -> str:
+        """
+        The conversation holding choice index of a reply on convo_id
+        """
+        return convo_id if index == 0 else f"{convo_id}#{index}"
+
+    def __store_choices(self, convo_id: str, reply: Reply) -> None:
+        """
+        Add the first choice to the conversation and every other choice to
+        a branch copied from the conversation, noting their finish reasons
+        """
+        history = list(self.conversation[convo_id])
+        for index in sorted(reply.texts):
+            if index == 0:
+                continue
+            branch = self.choice_branch(convo_id, index)
+            self.conversation[branch] = history + [
+                self.message_table.intern(
+                    Message(
+                        reply.roles.get(index, "assistant"),
+                        "".join(reply.texts[index]),
+                    ),
+                ),
+            ]
+            self.__clear_token_ledger(branch)
+            self.finish_reasons[branch] = reply.finish_reasons.get(index)
+        self.add_to_conversation(
+            "".join(reply.texts.get(0, ())),
+            reply.roles.get(0, "assistant"),
+            convo_id=convo_id,
+        )
+        self.finish_reasons[convo_id] = reply.finish_reasons.get(0)
 
     async def ask_async(
         self,
@@ -363,11 +1378,96 @@ class Chatbot:
             prompt=prompt,
             role=role,
             convo_id=convo_id,
+            model=model,
+            pass_history=pass_history,
             **kwargs,
         )
         full_response: str = "".join([r async for r in response])
         return full_response
 
+    async def ask_many_async(
+        self,
+        items: list[BatchItem],
+        concurrency: int = 8,
+        on_result: Callable[[BatchResult], None] = None,
+    ) -> BatchReport:
+        """
+        Ask many prompts concurrently on the shared async client
+
+        Items without a convo_id each get a fresh conversation that is
+        removed afterwards. Items on the same conversation run one after
+        another in the order given. Overrides are passed on to ask_async.
+        Errors are captured per item instead of raised.
+
+        on_result is called with each result as it completes, while the
+        report keeps them in the order of the items.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        locks: dict[str, asyncio.Lock] = collections.defaultdict(asyncio.Lock)
+        batch_id = uuid.uuid4().hex[:8]
+
+        async def run(index: int, item: BatchItem) -> BatchResult:
+            prompt, convo_id, overrides = (
+                (item, None, {})
+                if isinstance(item, str)
+                else (tuple(item) + (None, {}))[:3]
+            )
+            temporary = convo_id is None
+            if temporary:
+                convo_id = f"batch-{batch_id}-{index}"
+            result = BatchResult(index, prompt, convo_id)
+            # Take the conversation first, so waiting items hold no slot
+            async with locks[convo_id], semaphore:
+                start = time.perf_counter()
+                try:
+                    result.response = await self.ask_async(
+                        prompt,
+                        convo_id=convo_id,
+                        **(overrides or {}),
+                    )
+                    result.tokens = self.get_token_count(convo_id)
+                except Exception as error:
+                    result.error = error
+                result.latency = time.perf_counter() - start
+            if temporary:
+                self.conversation.pop(convo_id, None)
+                self.__clear_token_ledger(convo_id)
+            if on_result is not None:
+                on_result(result)
+            return result
+
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(run(index, item) for index, item in enumerate(items)),
+        )
+        return BatchReport(list(results), time.perf_counter() - start)
+
+    def ask_many(
+        self,
+        items: list[BatchItem],
+        concurrency: int = 8,
+        on_result: Callable[[BatchResult], None] = None,
+    ) -> BatchReport:
+        """
+        ask_many_async on a new event loop, for callers without one
+
+        Connections are reused within the batch and closed with its loop.
+        Callers with their own loop keep them across batches with
+        ask_many_async.
+        """
+
+        async def run() -> BatchReport:
+            try:
+                return await self.ask_many_async(
+                    items,
+                    concurrency=concurrency,
+                    on_result=on_result,
+                )
+            finally:
+                await self.transport.aclose()
+
+        return asyncio.run(run())
+
     def ask(
         self,
         prompt: str,
@@ -395,16 +1495,55 @@ class Chatbot:
         """
         Rollback the conversation
         """
+        ledger = self.__token_ledger.get(convo_id)
+        in_sync = ledger is not None and len(ledger) == len(
+            self.conversation[convo_id],
+        )
         for _ in range(n):
-            self.conversation[convo_id].pop()
+            self.conversation.pop_message(convo_id)
+            if in_sync:
+                self.__token_totals[convo_id] -= ledger.pop()
 
     def reset(self, convo_id: str = "default", system_prompt: str = None) -> None:
         """
         Reset the conversation
         """
         self.conversation[convo_id] = [
-            {"role": "system", "content": system_prompt or self.system_prompt},
+            self.message_table.intern(
+                Message("system", system_prompt or self.system_prompt),
+            ),
         ]
+        self.__clear_token_ledger(convo_id)
+
+    def snapshot(self, convo_ids: list[str] = None) -> dict[str, tuple[dict, ...]]:
+        """
+        Capture conversations as tuples of their messages, without copying
+        them. The snapshot keeps its messages in the message_table.
+        """
+        if convo_ids is None:
+            convo_ids = list(self.conversation)
+        return {
+            convo_id: self.message_table.snapshot(self.conversation[convo_id])
+            for convo_id in convo_ids
+        }
+
+    def restore(self, snapshot: dict[str, tuple[dict, ...]]) -> None:
+        """
+        Restore conversations captured by snapshot
+        """
+        for convo_id, messages in snapshot.items():
+            self.conversation[convo_id] = self.message_table.restore(messages)
+            self.__clear_token_ledger(convo_id)
+
+    def get_shared_prefix(self, convo_ids: list[str]) -> dict[str, int]:
+        """
+        Number of leading messages the conversations share and their tokens
+        """
+        length = self.message_table.shared_prefix(
+            [self.conversation[convo_id] for convo_id in convo_ids],
+        )
+        tokens = sum(self.__get_token_ledger(convo_ids[0])[:length]) if length else 0
+        return {"messages": length, "tokens": tokens}
 
     def save(self, file: str, *keys: str) -> None:
         """
@@ -414,11 +1553,22 @@ class Chatbot:
             data = {
                 key: self.__dict__[key]
                 for key in get_filtered_keys_from_object(self, *keys)
+                # private state such as the token ledger is rebuilt on load
+                if not key.startswith("_") and key not in self.UNSAVED_KEYS
             }
             # saves session.proxies dict as session
             # leave this here for compatibility
-            data["session"] = data["proxy"]
-            del data["aclient"]
+            if "proxy" in data:
+                data["session"] = data["proxy"]
+            if not isinstance(self.conversation, dict) and "conversation" not in keys:
+                # Persistent stores hold their own conversations, only
+                # export them when asked for explicitly
+                data.pop("conversation", None)
+            elif "conversation" in data:
+                data["conversation"] = {
+                    convo_id: [as_dict(message) for message in messages]
+                    for convo_id, messages in self.conversation.items()
+                }
             json.dump(
                 data,
                 f,
@@ -432,34 +1582,32 @@ class Chatbot:
         with open(file, encoding="utf-8") as f:
             # load json, if session is in keys, load proxies
             loaded_config = json.load(f)
-            keys = get_filtered_keys_from_object(self, *keys_)
+            # session is saved as an alias of proxy
+            keys_ = tuple("proxy" if key == "session" else key for key in keys_)
+            keys = get_filtered_keys_from_object(self, *keys_) - self.UNSAVED_KEYS
 
-            if (
-                "session" in keys
-                and loaded_config["session"]
-                or "proxy" in keys
-                and loaded_config["proxy"]
+            if "proxy" in keys and (
+                proxy := loaded_config.get("session") or loaded_config.get("proxy")
             ):
-                self.proxy = loaded_config.get("session", loaded_config["proxy"])
-                self.session = httpx.Client(
-                    follow_redirects=True,
-                    proxies=self.proxy,
-                    timeout=self.timeout,
-                    cookies=self.session.cookies,
-                    headers=self.session.headers,
-                )
-                self.aclient = httpx.AsyncClient(
-                    follow_redirects=True,
-                    proxies=self.proxy,
-                    timeout=self.timeout,
-                    cookies=self.session.cookies,
-                    headers=self.session.headers,
-                )
-            if "session" in keys:
-                keys.remove("session")
-            if "aclient" in keys:
-                keys.remove("aclient")
-            self.__dict__.update({key: loaded_config[key] for key in keys})
+                self.proxy = proxy
+                self.transport = get_transport(proxy=self.proxy)
+                keys.remove("proxy")
+            if "conversation" in keys:
+                keys.remove("conversation")
+                if "conversation" in loaded_config:
+                    if isinstance(self.conversation, dict):
+                        # In memory the loaded conversations replace all
+                        # others, persistent stores keep the ones not loaded
+                        self.conversation.clear()
+                        self.__clear_token_ledger()
+                    for convo_id, messages in loaded_config["conversation"].items():
+                        self.conversation[convo_id] = [
+                            self.message_table.intern(message) for message in messages
+                        ]
+                        self.__clear_token_ledger(convo_id)
+            self.__dict__.update(
+                {key: loaded_config[key] for key in keys if key in loaded_config},
+            )
 
 
 class ChatbotCLI(Chatbot):
@@ -477,7 +1625,7 @@ ChatGPT Configuration:
   Conversation ID:  {convo_id}
   Messages:         {len(self.conversation[convo_id])}
   Tokens used:      {( num_tokens := self.get_token_count(convo_id) )} / {self.max_tokens}
-  Cost:             {"${:.5f}".format(( num_tokens / 1000 ) * 0.002)}
+  Cost:             {"${:.5f}".format(self.get_cost(num_tokens))}
   Engine:           {self.engine}
   Temperature:      {self.temperature}
   Top_p:            {self.top_p}
@@ -711,8 +1859,8 @@ def main() -> NoReturn:
             try:
                 chatbot.handle_commands(prompt)
             except (
-                requests.exceptions.Timeout,
-                requests.exceptions.ConnectionError,
+                httpx.TimeoutException,
+                httpx.TransportError,
             ) as err:
                 print(f"Error: {err}")
                 continue
@@ -729,6 +1877,8 @@ def main() -> NoReturn:
             # Get search results
             search_results = '{"results": "No search results"}'
             if query != "none":
+                import requests
+
                 resp = requests.post(
                     url="https://ddg-api.herokuapp.com/search",
                     json={"query": query, "limit": 3},
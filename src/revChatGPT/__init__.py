@@ -4,29 +4,32 @@ The __init__ file does not a main file
 You can import the following module to use:
 revChatGPT.V1
 revChatGPT.V3
+
+Both are imported on first access, e.g. revChatGPT.V3, so importing the
+package alone does not load their dependencies.
 """
+import importlib
+import sys
+
 from .version import version
 
 __version__ = version
 __all__ = ()
 
+_LAZY_MODULES = ("V1", "V3")
+
 
 def verify() -> None:
     # Available Python Version Verify
-    from . import typings as t
+    major, minor = sys.version_info[:2]
+    if major < 3 or minor < 9:
+        from . import typings as t
 
-    if int(__import__("platform").python_version_tuple()[0]) < 3:
-        error = t.NotAllowRunning("Not available Python version")
-        raise error
-    if int(__import__("platform").python_version_tuple()[1]) < 9:
         error = t.NotAllowRunning(
-            f"Not available Python version: {__import__('platform').python_version()}",
+            f"Not available Python version: {'.'.join(map(str, sys.version_info[:3]))}",
         )
         raise error
-    if (
-        int(__import__("platform").python_version_tuple()[1]) < 10
-        and int(__import__("platform").python_version_tuple()[0]) == 3
-    ):
+    if major == 3 and minor < 10:
         __import__("warnings").warn(
             UserWarning(
                 "The current Python is not a recommended version, 3.10+ is recommended",
@@ -34,4 +37,14 @@ def verify() -> None:
         )
 
 
+def __getattr__(name: str) -> object:
+    if name in _LAZY_MODULES:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> list:
+    return sorted([*globals(), *_LAZY_MODULES])
+
+
 verify()
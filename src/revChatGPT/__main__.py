@@ -6,8 +6,6 @@ import sys
 
 from . import __version__
 from . import typings as t
-from . import V1
-from . import V3
 
 __all__ = ()
 
@@ -34,7 +32,10 @@ def main() -> None:
     args, _ = parser.parse_known_args()
     mode = "V1" if args.V1 else "V3" if args.V3 else input("Version (V1/V3):")
 
+    # The clients are only imported once the mode is known
     if mode == "V1":
+        from . import V1
+
         print(
             f"""
         ChatGPT - A command-line interface to OpenAI's ChatGPT (https://chat.openai.com/chat)
@@ -48,6 +49,8 @@ def main() -> None:
         )
         V1.main(V1.configure())
     elif mode == "V3":
+        from . import V3
+
         try:
             V3.main()
         except Exception as exc:
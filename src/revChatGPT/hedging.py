@@ -0,0 +1,244 @@
+"""
+Hedged requests, to cut the tail of the time to first token
+"""
+from __future__ import annotations
+
+import asyncio
+import collections
+import contextlib
+import threading
+import time
+from typing import AsyncContextManager
+from typing import AsyncIterator
+from typing import Callable
+from typing import TypeVar
+
+import anyio
+
+from .metrics import percentile
+from .streaming import Deadline
+from .streaming import within
+
+T = TypeVar("T")
+
+# Marks the end of a stream in its queue
+_END = object()
+
+
+class HedgePolicy:
+    """
+    When and where to send a duplicate of a slow request
+
+    A duplicate is sent once the first token of a request is later than a
+    percentile of recent times to first token, and the first of both
+    streams to produce a token is kept. Every fired hedge is a second
+    request to pay for, so the percentile bounds how often that happens.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95,
+        window: int = 200,
+        min_samples: int = 20,
+        initial_delay: float = None,
+        min_delay: float = 0.05,
+        api_key: str = None,
+        api_url: str = None,
+    ) -> None:
+        """Configure hedging
+
+        Args:
+            percentile (float, optional): Percentile of recent times to first token to wait for. Defaults to 95.
+            window (int, optional): Recent times to first token kept. Defaults to 200.
+            min_samples (int, optional): Times needed before the percentile is used. Defaults to 20.
+            initial_delay (float, optional): Wait in seconds until then, None to not hedge. Defaults to None.
+            min_delay (float, optional): Shortest wait in seconds. Defaults to 0.05.
+            api_key (str, optional): API key of the duplicate. Defaults to the one of the request.
+            api_url (str, optional): Endpoint of the duplicate. Defaults to the one of the request.
+        """
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.api_key = api_key
+        self.api_url = api_url
+        self.__lock = threading.Lock()
+        self.__samples: collections.deque[float] = collections.deque(maxlen=window)
+        self.requests: int = 0
+        self.fired: int = 0
+        self.won: int = 0
+
+    def observe(self, seconds: float) -> None:
+        """
+        Add the time to first token of a stream to the window
+        """
+        with self.__lock:
+            self.__samples.append(seconds)
+
+    def delay(self) -> float | None:
+        """
+        Seconds to wait for the first token before hedging, None to not hedge
+        """
+        with self.__lock:
+            if len(self.__samples) < self.min_samples:
+                delay = self.initial_delay
+            else:
+                delay = percentile(list(self.__samples), self.percentile)
+        return None if delay is None else max(delay, self.min_delay)
+
+    def record(self, fired: bool, won: bool) -> None:
+        """
+        Count a request, whether a hedge was fired for it and whether the
+        hedge won
+        """
+        with self.__lock:
+            self.requests += 1
+            self.fired += fired
+            self.won += won
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "fired": self.fired,
+            "won": self.won,
+            "fire_rate": self.fired / self.requests if self.requests else 0.0,
+            "win_rate": self.won / self.fired if self.fired else 0.0,
+            "delay": self.delay(),
+        }
+
+
+class _Stream:
+    """
+    One of the raced requests, read into a queue by its own task
+    """
+
+    def __init__(
+        self,
+        open_stream: Callable[[bool], AsyncContextManager[AsyncIterator[T]]],
+        has_token: Callable[[T], bool],
+        hedge: bool,
+    ) -> None:
+        self.hedge = hedge
+        self.started: float = time.perf_counter()
+        self.first_token: float | None = None
+        self.error: Exception | None = None
+        self.queue: asyncio.Queue = asyncio.Queue()
+        # Cancelling the task instead could interrupt closing the response
+        # inside httpcore, whose shields only hold against anyio, and leave
+        # its connection checked out of the pool
+        self.scope = anyio.CancelScope()
+        # Done at the first token or at the end of the stream
+        self.ready: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.task = asyncio.ensure_future(self.__run(open_stream, has_token))
+
+    async def __run(
+        self,
+        open_stream: Callable[[bool], AsyncContextManager[AsyncIterator[T]]],
+        has_token: Callable[[T], bool],
+    ) -> None:
+        try:
+            with self.scope:
+                async with open_stream(self.hedge) as events:
+                    async for event in events:
+                        self.queue.put_nowait(event)
+                        if self.first_token is None and has_token(event):
+                            self.first_token = time.perf_counter() - self.started
+                            self.ready.set_result(None)
+        except Exception as error:
+            self.error = error
+        finally:
+            self.queue.put_nowait(_END)
+            if not self.ready.done():
+                self.ready.set_result(None)
+
+    def stop(self) -> None:
+        """
+        Stop reading the events, and so close the stream
+        """
+        self.scope.cancel()
+
+    async def events(self) -> AsyncIterator[T]:
+        while True:
+            event = await self.queue.get()
+            if event is _END:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield event
+
+
+@contextlib.asynccontextmanager
+async def hedged(
+    policy: HedgePolicy,
+    open_stream: Callable[[bool], AsyncContextManager[AsyncIterator[T]]],
+    has_token: Callable[[T], bool],
+    deadline: Deadline = None,
+) -> AsyncIterator[AsyncIterator[T]]:
+    """Race a streamed request against a duplicate sent once it is late
+
+    Args:
+        policy (HedgePolicy): When to send the duplicate, updated with the outcome
+        open_stream (Callable[[bool], AsyncContextManager[AsyncIterator[T]]]): Opens the events of the request, or of the duplicate when passed True
+        has_token (Callable[[T], bool]): Whether an event carries a token
+        deadline (Deadline, optional): Limits on waiting for the first token. Defaults to None.
+
+    Yields:
+        AsyncIterator[T]: Events of the first stream to produce a token, or to end if
+        none does. The other is stopped, which closes its connection, and
+        so is the winner when the block exits.
+    """
+    streams = [_Stream(open_stream, has_token, hedge=False)]
+    delay = policy.delay()
+    winner = None
+    try:
+        try:
+            while winner is None:
+                ready = [stream for stream in streams if stream.ready.done()]
+                winners = [stream for stream in ready if stream.error is None]
+                if winners:
+                    winner = winners[0]
+                elif len(ready) == len(streams):
+                    # Every stream failed, report the first error
+                    winner = streams[0]
+                else:
+                    timeout = None
+                    if delay is not None and len(streams) == 1:
+                        timeout = max(
+                            streams[0].started + delay - time.perf_counter(),
+                            0.0,
+                        )
+                    done, _ = await within(
+                        deadline,
+                        asyncio.wait(
+                            [
+                                stream.ready
+                                for stream in streams
+                                if not stream.ready.done()
+                            ],
+                            timeout=timeout,
+                            return_when=asyncio.FIRST_COMPLETED,
+                        ),
+                    )
+                    if not done:
+                        streams.append(_Stream(open_stream, has_token, hedge=True))
+        finally:
+            # Also counted when the deadline runs out before any token
+            policy.record(
+                fired=len(streams) > 1,
+                won=winner is not None and winner.hedge,
+            )
+        if winner.first_token is not None:
+            # As seen by the caller, a lower bound of the request's own when
+            # the hedge won
+            policy.observe(winner.started + winner.first_token - streams[0].started)
+        for stream in streams:
+            if stream is not winner:
+                stream.stop()
+        yield winner.events()
+    finally:
+        for stream in streams:
+            stream.stop()
+        await asyncio.gather(
+            *(stream.task for stream in streams),
+            return_exceptions=True,
+        )
@@ -0,0 +1,327 @@
+"""
+Latency and throughput measurements of streamed requests
+"""
+from __future__ import annotations
+
+import contextlib
+import http.server
+import math
+import threading
+import time
+from typing import Callable
+from typing import Iterator
+
+# httpcore trace events delimiting each connection phase
+_PHASES = {
+    # Resolving the host is part of opening the TCP connection
+    "connect": "connection.connect_tcp",
+    "tls": "connection.start_tls",
+}
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    """
+    Nearest-rank percentile of values, None if there are none
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(len(ordered) * q / 100) - 1)]
+
+
+class RequestMetrics:
+    """
+    Timings of one streamed request, in seconds since it was started
+
+    Filled in by the chatbots while the request runs and passed to every
+    hook once it is done.
+    """
+
+    def __init__(self, source: str, model: str = None, convo_id: str = None) -> None:
+        self.source = source
+        self.model = model
+        self.convo_id = convo_id
+        self.started: float = time.perf_counter()
+        self.finished: float | None = None
+        # Durations of phases before the response, e.g. connect, tls, queue
+        self.phases: dict[str, float] = {}
+        # Requests sent, more than one if failures were retried
+        self.attempts: int = 0
+        self.first_byte: float | None = None
+        self.first_token: float | None = None
+        self.last_token: float | None = None
+        self.gaps: list[float] = []
+        self.tokens: int = 0
+        self.error: str | None = None
+
+    def add_phase(self, name: str, seconds: float) -> None:
+        """
+        Add time spent in a phase, e.g. waiting for a rate limit
+        """
+        if seconds:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def add_trace(self, events: dict[str, float]) -> None:
+        """
+        Take the connection phases of an attempt from its RequestTrace events
+        """
+        for name, event in _PHASES.items():
+            started = events.get(f"{event}.started")
+            complete = events.get(f"{event}.complete")
+            if started is not None and complete is not None:
+                self.add_phase(name, complete - started)
+
+    def mark_first_byte(self) -> None:
+        """
+        Record that the response headers arrived
+        """
+        self.first_byte = time.perf_counter() - self.started
+
+    def mark_token(self, count: int = 1) -> None:
+        """
+        Record the arrival of count tokens
+        """
+        now = time.perf_counter() - self.started
+        if self.first_token is None:
+            self.first_token = now
+        else:
+            self.gaps.append(now - self.last_token)
+        self.last_token = now
+        self.tokens += count
+
+    def finish(self, error: BaseException = None) -> None:
+        """
+        Record the end of the request and the error that ended it, if any
+        """
+        self.finished = time.perf_counter() - self.started
+        if error is not None and self.error is None:
+            self.error = type(error).__name__
+
+    def cancel(self) -> None:
+        """
+        Record that the consumer cancelled the request
+        """
+        self.error = "cancelled"
+
+    @property
+    def ok(self) -> bool:
+        return self.finished is not None and self.error is None
+
+    @property
+    def tokens_per_second(self) -> float | None:
+        """
+        Generation speed from the first to the last token
+        """
+        if self.first_token is None or self.last_token == self.first_token:
+            return None
+        return (self.tokens - 1) / (self.last_token - self.first_token)
+
+    def to_dict(self) -> dict:
+        return {
+            "source": self.source,
+            "model": self.model,
+            "convo_id": self.convo_id,
+            "ok": self.ok,
+            "error": self.error,
+            "attempts": self.attempts,
+            **{phase: seconds for phase, seconds in self.phases.items()},
+            "time_to_first_byte": self.first_byte,
+            "time_to_first_token": self.first_token,
+            "duration": self.finished,
+            "tokens": self.tokens,
+            "tokens_per_second": self.tokens_per_second,
+            "gap_p50": percentile(self.gaps, 50),
+            "gap_p99": percentile(self.gaps, 99),
+            "gap_max": max(self.gaps, default=None),
+        }
+
+
+Hook = Callable[[RequestMetrics], None]
+
+_hooks: tuple[Hook, ...] = ()
+_hooks_lock = threading.Lock()
+
+
+def add_hook(hook: Hook) -> None:
+    """Call hook with the RequestMetrics of every finished request
+
+    Hooks run on the thread or event loop of the request, so they should
+    return quickly. Exceptions they raise are not caught.
+
+    Args:
+        hook (Hook): Callback taking a RequestMetrics
+    """
+    global _hooks
+    with _hooks_lock:
+        _hooks = (*_hooks, hook)
+
+
+def remove_hook(hook: Hook) -> None:
+    """
+    Stop calling a hook added with add_hook
+    """
+    global _hooks
+    with _hooks_lock:
+        _hooks = tuple(added for added in _hooks if added is not hook)
+
+
+def emit(metrics: RequestMetrics) -> None:
+    """
+    Pass finished request metrics to the hooks
+    """
+    for hook in _hooks:
+        hook(metrics)
+
+
+@contextlib.contextmanager
+def measure(
+    source: str,
+    model: str = None,
+    convo_id: str = None,
+) -> Iterator[RequestMetrics]:
+    """
+    Measure a request and emit its metrics when the block exits, including
+    through an exception
+    """
+    metrics = RequestMetrics(source, model=model, convo_id=convo_id)
+    try:
+        yield metrics
+    except BaseException as error:
+        metrics.finish(error)
+        emit(metrics)
+        raise
+    metrics.finish()
+    emit(metrics)
+
+
+class PrometheusExporter:
+    """
+    Aggregates request metrics into Prometheus histograms and counters
+
+    Register it with add_hook, then expose render() on a metrics endpoint
+    or let serve() do so.
+    """
+
+    SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+    RATE_BUCKETS = (1, 5, 10, 20, 40, 80, 160)
+    HISTOGRAMS = {
+        "time_to_first_byte_seconds": ("Time until response headers", "first_byte"),
+        "time_to_first_token_seconds": ("Time until the first token", "first_token"),
+        "request_duration_seconds": ("Time until the stream ended", "finished"),
+        "inter_token_gap_seconds": ("Time between tokens", "gaps"),
+        "tokens_per_second": ("Generation speed of a request", "tokens_per_second"),
+    }
+
+    def __init__(self, prefix: str = "revchatgpt") -> None:
+        self.prefix = prefix
+        self.__lock = threading.Lock()
+        # (name, labels) to [bucket counts..., sum, count]
+        self.__histograms: dict[tuple[str, tuple], list[float]] = {}
+        self.__counters: dict[tuple[str, tuple], float] = {}
+
+    def __call__(self, metrics: RequestMetrics) -> None:
+        labels = (("source", metrics.source), ("model", metrics.model or ""))
+        status = "ok" if metrics.ok else metrics.error or "unfinished"
+        with self.__lock:
+            self.__count("requests_total", (*labels, ("status", status)))
+            self.__count("tokens_total", labels, metrics.tokens)
+            for name, (_, attribute) in self.HISTOGRAMS.items():
+                value = getattr(metrics, attribute)
+                for sample in value if isinstance(value, list) else (value,):
+                    if sample is not None:
+                        self.__observe(name, labels, sample)
+
+    def __count(self, name: str, labels: tuple, amount: float = 1) -> None:
+        key = (name, labels)
+        self.__counters[key] = self.__counters.get(key, 0) + amount
+
+    def __buckets(self, name: str) -> tuple:
+        return (
+            self.RATE_BUCKETS if name == "tokens_per_second" else self.SECONDS_BUCKETS
+        )
+
+    def __observe(self, name: str, labels: tuple, value: float) -> None:
+        buckets = self.__buckets(name)
+        key = (name, labels)
+        histogram = self.__histograms.get(key)
+        if histogram is None:
+            histogram = self.__histograms[key] = [0] * (len(buckets) + 2)
+        for index, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    @staticmethod
+    def __labels(labels: tuple) -> str:
+        return ",".join(
+            '{}="{}"'.format(
+                label,
+                value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+            )
+            for label, value in labels
+        )
+
+    def render(self) -> str:
+        """
+        The aggregated metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self.__lock:
+            for name, help_text in (
+                ("requests_total", "Streamed requests by outcome"),
+                ("tokens_total", "Tokens received"),
+            ):
+                lines.append(f"# HELP {self.prefix}_{name} {help_text}")
+                lines.append(f"# TYPE {self.prefix}_{name} counter")
+                for (counter, labels), value in sorted(self.__counters.items()):
+                    if counter == name:
+                        lines.append(
+                            f"{self.prefix}_{name}{{{self.__labels(labels)}}} {value}",
+                        )
+            for name, (help_text, _) in self.HISTOGRAMS.items():
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} histogram")
+                for (histogram, labels), values in sorted(self.__histograms.items()):
+                    if histogram != name:
+                        continue
+                    label_text = self.__labels(labels)
+                    for bound, count in zip(self.__buckets(name), values):
+                        lines.append(
+                            f'{metric}_bucket{{{label_text},le="{bound}"}} {count}',
+                        )
+                    lines.append(
+                        f'{metric}_bucket{{{label_text},le="+Inf"}} {values[-1]}',
+                    )
+                    lines.append(f"{metric}_sum{{{label_text}}} {values[-2]}")
+                    lines.append(f"{metric}_count{{{label_text}}} {values[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int = 9464, host: str = "") -> http.server.HTTPServer:
+        """Serve render() over HTTP from a daemon thread
+
+        Args:
+            port (int, optional): Port to listen on. Defaults to 9464.
+            host (str, optional): Address to bind. Defaults to all interfaces.
+
+        Returns:
+            http.server.HTTPServer: The server, stop it with shutdown()
+        """
+        exporter = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                body = exporter.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -0,0 +1,265 @@
+"""
+Client-side rate limiting and retries for the official API
+"""
+from __future__ import annotations
+
+import asyncio
+import email.utils
+import random
+import re
+import threading
+import time
+from typing import Mapping
+
+# e.g. "6m0s", "1.5s", "20ms" as sent in x-ratelimit-reset-* headers
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: str) -> float | None:
+    """Parse a duration such as 6m0s into seconds
+
+    Args:
+        value (str): Duration string
+
+    Returns:
+        float | None: Seconds, or None if value is not a duration
+    """
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _UNITS[unit] for number, unit in parts)
+
+
+class TokenBucket:
+    """
+    A bucket refilled continuously with capacity units per minute
+
+    acquire reserves units right away and returns how long the caller has
+    to wait for them, so waiting callers are served in order.
+    """
+
+    def __init__(self, capacity: float) -> None:
+        self.capacity = capacity
+        self.available = capacity
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        """
+        Units refilled per second
+        """
+        return self.capacity / 60
+
+    def __refill(self, now: float) -> None:
+        self.available = min(
+            self.capacity,
+            self.available + (now - self.updated) * self.rate,
+        )
+        self.updated = now
+
+    def acquire(self, amount: float) -> float:
+        """
+        Reserve amount units and get the seconds to wait before using them
+        """
+        self.__refill(time.monotonic())
+        # A request larger than the bucket could never go through otherwise
+        self.available -= min(amount, self.capacity)
+        return -self.available / self.rate if self.available < 0 else 0.0
+
+    def resize(self, capacity: float) -> None:
+        """
+        Change the capacity, e.g. to a limit reported by the server
+        """
+        self.__refill(time.monotonic())
+        self.available += capacity - self.capacity
+        self.capacity = capacity
+
+    def limit_to(self, remaining: float) -> None:
+        """
+        Lower the available units to what the server reports as remaining
+        """
+        self.__refill(time.monotonic())
+        self.available = min(self.available, remaining)
+
+
+class RateLimiter:
+    """
+    Request and token budgets of one API key and engine
+
+    Limits can be given up front and are otherwise learned from the
+    x-ratelimit-* headers of responses. Unknown limits are not enforced.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = None,
+        tokens_per_minute: float = None,
+    ) -> None:
+        self.__lock = threading.Lock()
+        self.requests = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def __reserve(self, num_tokens: int) -> float:
+        with self.__lock:
+            delay = 0.0
+            if self.requests is not None:
+                delay = max(delay, self.requests.acquire(1))
+            if self.tokens is not None:
+                delay = max(delay, self.tokens.acquire(num_tokens))
+            return delay
+
+    def acquire(self, num_tokens: int) -> float:
+        """
+        Wait until a request of num_tokens tokens fits the budgets, and get
+        the seconds waited
+        """
+        delay = self.__reserve(num_tokens)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    async def acquire_async(self, num_tokens: int) -> float:
+        """
+        Same as acquire, without blocking the event loop
+        """
+        delay = self.__reserve(num_tokens)
+        if delay:
+            await asyncio.sleep(delay)
+        return delay
+
+    def observe(self, headers: Mapping[str, str]) -> None:
+        """
+        Adapt the budgets to the x-ratelimit-* headers of a response
+        """
+        with self.__lock:
+            for kind in ("requests", "tokens"):
+                bucket: TokenBucket = getattr(self, kind)
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                if limit and limit.isdigit() and int(limit) > 0:
+                    if bucket is None:
+                        bucket = TokenBucket(int(limit))
+                        setattr(self, kind, bucket)
+                    elif bucket.capacity != int(limit):
+                        bucket.resize(int(limit))
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                if bucket is not None and remaining and remaining.isdigit():
+                    bucket.limit_to(int(remaining))
+
+
+class RetryPolicy:
+    """
+    Jittered exponential backoff that follows the server's hints
+
+    Retry-After, retry-after-ms and, for 429s, the x-ratelimit-reset-*
+    header of the exhausted budget take precedence over the backoff.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 2,
+        base_delay: float = 0.5,
+        max_delay: float = 60,
+        retry_statuses: tuple[int, ...] = (408, 409, 429, 500, 502, 503, 504),
+    ) -> None:
+        """Configure retries
+
+        Args:
+            max_retries (int, optional): Retries after the first attempt. Defaults to 2.
+            base_delay (float, optional): Backoff of the first retry in seconds. Defaults to 0.5.
+            max_delay (float, optional): Longest wait; longer server hints give up instead. Defaults to 60.
+            retry_statuses (tuple[int, ...], optional): Status codes worth retrying.
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = retry_statuses
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Exponential backoff for an attempt, with half of it jittered
+        """
+        delay = min(self.max_delay, self.base_delay * 2**attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def server_delay(
+        self,
+        status_code: int,
+        headers: Mapping[str, str],
+    ) -> float | None:
+        """
+        The wait the server asks for, if any
+        """
+        if (retry_after_ms := headers.get("retry-after-ms")) is not None:
+            try:
+                return float(retry_after_ms) / 1000
+            except ValueError:
+                pass
+        if (retry_after := headers.get("retry-after")) is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                try:
+                    retry_at = email.utils.parsedate_to_datetime(retry_after)
+                    return max(0.0, retry_at.timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+        if status_code == 429:
+            resets = [
+                parse_duration(headers.get(f"x-ratelimit-reset-{kind}", ""))
+                for kind in ("requests", "tokens")
+                if headers.get(f"x-ratelimit-remaining-{kind}") == "0"
+            ]
+            resets = [reset for reset in resets if reset is not None]
+            if resets:
+                return max(resets)
+        return None
+
+    def get_delay(
+        self,
+        attempt: int,
+        status_code: int = None,
+        headers: Mapping[str, str] = None,
+    ) -> float | None:
+        """Decide whether and when to retry a failed attempt
+
+        Args:
+            attempt (int): Zero-based number of the failed attempt
+            status_code (int, optional): Response status, None if the request
+                failed before a response arrived. Defaults to None.
+            headers (Mapping[str, str], optional): Response headers. Defaults to None.
+
+        Returns:
+            float | None: Seconds to wait before retrying, or None to give up
+        """
+        if attempt >= self.max_retries:
+            return None
+        if status_code is not None and status_code not in self.retry_statuses:
+            return None
+        delay = self.server_delay(status_code, headers or {})
+        if delay is None:
+            return self.backoff(attempt)
+        return delay if delay <= self.max_delay else None
+
+
+_lock = threading.Lock()
+_limiters: dict[tuple[str, str], RateLimiter] = {}
+
+
+def get_rate_limiter(api_key: str, engine: str) -> RateLimiter:
+    """Get the process-wide rate limiter of an API key and engine
+
+    Args:
+        api_key (str): API key
+        engine (str): Model name
+
+    Returns:
+        RateLimiter: The shared limiter, learning its limits from responses
+    """
+    key = (api_key, engine)
+    with _lock:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter()
+        return _limiters[key]
@@ -0,0 +1,59 @@
+"""
+Pre-encoded JSON request bodies for the official API
+"""
+from __future__ import annotations
+
+import json
+from typing import Mapping
+
+from .store import Message
+
+# Prefer a faster JSON encoder when one is installed
+try:
+    import orjson
+
+    dumps = orjson.dumps
+except ImportError:
+
+    def dumps(obj: object) -> bytes:
+        """
+        Encode obj as compact UTF-8 JSON
+        """
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode(
+            "utf-8",
+        )
+
+
+def encode_message(message: Mapping | str) -> bytes:
+    """Encode a message, once per Message
+
+    Args:
+        message (Mapping | str): Message of a conversation
+
+    Returns:
+        bytes: The message as JSON in the format of the API
+    """
+    if isinstance(message, Message):
+        if message.encoded is None:
+            message.encoded = dumps(message.to_dict())
+        return message.encoded
+    return dumps(message)
+
+
+def encode_body(body: dict) -> bytes:
+    """Encode a chat completion request body
+
+    The messages are joined from their cached encodings, so only the new
+    messages of a conversation are encoded on each turn.
+
+    Args:
+        body (dict): Request body, with the messages under "messages"
+
+    Returns:
+        bytes: The body as JSON
+    """
+    params = dumps({key: value for key, value in body.items() if key != "messages"})
+    messages = b",".join([encode_message(message) for message in body["messages"]])
+    # params is "{...}", or "{}" when messages are the only field
+    tail = b"," + params[1:] if len(params) > 2 else b"}"
+    return b"".join((b'{"messages":[', messages, b"]", tail))
@@ -0,0 +1,218 @@
+"""
+Caches of complete responses to deterministic requests
+"""
+from __future__ import annotations
+
+import abc
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from .request_body import encode_message
+
+
+def request_key(body: dict) -> str:
+    """Hash a request body into a stable cache key
+
+    Args:
+        body (dict): Request body with model, messages and sampling parameters
+
+    Returns:
+        str: Hex digest that ignores key order and whether the body streams
+    """
+    params = {
+        key: value for key, value in body.items() if key not in ("messages", "stream")
+    }
+    encoded = json.dumps(
+        params,
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    digest = hashlib.sha256(encoded.encode("utf-8"))
+    # Messages are hashed from their cached encodings
+    for message in body.get("messages", ()):
+        digest.update(encode_message(message))
+    return digest.hexdigest()
+
+
+class ResponseCache(abc.ABC):
+    """
+    Interface of response caches, counting hits and misses
+
+    Entries are the JSON-compatible records Chatbot stores, replayed in
+    place of a request. Entries older than ttl seconds are never returned
+    and the least recently used ones are evicted beyond max_entries.
+    """
+
+    def __init__(self, max_entries: int, ttl: float = None) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def get(self, key: str) -> dict | None:
+        """
+        Get a live entry, counting a hit or a miss
+        """
+        entry = self._get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    @abc.abstractmethod
+    def set(self, key: str, entry: dict) -> None:
+        """
+        Store an entry, evicting old ones as needed
+        """
+
+    @abc.abstractmethod
+    def _get(self, key: str) -> dict | None:
+        """
+        Get an entry that has not expired, without counting the lookup
+        """
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+        }
+
+
+class MemoryResponseCache(ResponseCache):
+    """
+    Keeps responses in an in-memory LRU
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = None) -> None:
+        super().__init__(max_entries=max_entries, ttl=ttl)
+        self.__lock = threading.Lock()
+        self.__entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+
+    def _get(self, key: str) -> dict | None:
+        with self.__lock:
+            item = self.__entries.get(key)
+            if item is None:
+                return None
+            created, entry = item
+            if self._expired(created):
+                del self.__entries[key]
+                return None
+            self.__entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, entry: dict) -> None:
+        with self.__lock:
+            self.__entries[key] = (time.time(), entry)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+
+class SQLiteResponseCache(ResponseCache):
+    """
+    Keeps responses in a SQLite database in WAL mode, shared by processes
+
+    Expired and surplus entries are deleted every EVICT_EVERY writes rather
+    than on each one, so the table may briefly exceed max_entries.
+    """
+
+    EVICT_EVERY = 64
+
+    def __init__(
+        self,
+        path: str | Path,
+        max_entries: int = 100000,
+        ttl: float = None,
+    ) -> None:
+        super().__init__(max_entries=max_entries, ttl=ttl)
+        self.__lock = threading.Lock()
+        self.__writes: int = 0
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                entry TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+            """,
+        )
+        self.__db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)",
+        )
+        self.__db.commit()
+
+    def _get(self, key: str) -> dict | None:
+        with self.__lock, self.__db:
+            row = self.__db.execute(
+                "SELECT entry, created FROM responses WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            entry, created = row
+            if self._expired(created):
+                self.__db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self.__db.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            return json.loads(entry)
+
+    def set(self, key: str, entry: dict) -> None:
+        now = time.time()
+        with self.__lock, self.__db:
+            self.__db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, json.dumps(entry), now, now),
+            )
+            self.__writes += 1
+            if self.__writes % self.EVICT_EVERY:
+                return
+            if self.ttl is not None:
+                self.__db.execute(
+                    "DELETE FROM responses WHERE created < ?",
+                    (now - self.ttl,),
+                )
+            self.__db.execute(
+                """
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            )
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return self.__db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def close(self) -> None:
+        """
+        Close the database
+        """
+        with self.__lock:
+            self.__db.close()
@@ -0,0 +1,186 @@
+"""
+Incremental decoder for server-sent event streams
+"""
+from __future__ import annotations
+
+import json
+from typing import AsyncIterable
+from typing import AsyncIterator
+from typing import Iterable
+from typing import Iterator
+
+# Prefer a faster JSON parser when one is installed
+try:
+    import orjson
+
+    loads = orjson.loads
+    JSONDecodeError: tuple = (ValueError,)
+except ImportError:
+    try:
+        import msgspec
+
+        loads = msgspec.json.decode
+        JSONDecodeError = (ValueError, msgspec.DecodeError)
+    except ImportError:
+        loads = json.loads
+        JSONDecodeError = (ValueError,)
+
+
+class Event:
+    """
+    A single server-sent event
+    """
+
+    __slots__ = ("event", "data", "id", "retry")
+
+    def __init__(
+        self,
+        event: str = "message",
+        data: str = "",
+        id: str | None = None,
+        retry: int | None = None,
+    ) -> None:
+        self.event = event
+        self.data = data
+        self.id = id
+        self.retry = retry
+
+    def json(self) -> dict:
+        """
+        Decode the data of the event as JSON
+        """
+        return loads(self.data)
+
+    def __repr__(self) -> str:
+        return f"Event(event={self.event!r}, data={self.data!r}, id={self.id!r})"
+
+
+class SSEDecoder:
+    """
+    Turns raw byte chunks into events
+
+    Chunks may split lines and events anywhere. Complete lines are split
+    straight out of the chunk and only a trailing partial line is buffered.
+    Multi-line data fields are joined with newlines as in the spec.
+
+    With raw_lines set, lines that are not SSE fields (such as a plain text
+    error body) are passed on as events of type "raw" instead of ignored.
+    """
+
+    def __init__(self, raw_lines: bool = False) -> None:
+        self.raw_lines = raw_lines
+        self.last_id: str | None = None
+        self.retry: int | None = None
+        self.__buffer = b""
+        self.__event: str = ""
+        self.__data: list[bytes] = []
+
+    def feed(self, chunk: bytes) -> list[Event]:
+        """
+        Add a chunk and get the events it completes
+        """
+        if self.__buffer:
+            chunk = self.__buffer + chunk
+        lines = chunk.split(b"\n")
+        # Keep the partial last line for the next chunk
+        self.__buffer = lines.pop()
+        if b"\r" in chunk:
+            lines = [line[:-1] if line.endswith(b"\r") else line for line in lines]
+        events: list[Event] = []
+        data = self.__data
+        for line in lines:
+            if line[:6] == b"data: ":
+                # Fast path for the only field the APIs really use
+                data.append(line[6:])
+            elif not line:
+                if data:
+                    events.append(self.__dispatch())
+                    data = self.__data
+                else:
+                    self.__event = ""
+            else:
+                event = self.__parse_line(line)
+                if event is not None:
+                    events.append(event)
+        return events
+
+    def flush(self) -> list[Event]:
+        """
+        Finish the stream, dispatching any event left without a blank line
+        """
+        events = self.feed(b"\n") if self.__buffer else []
+        if event := self.__dispatch():
+            events.append(event)
+        return events
+
+    def __parse_line(self, line: bytes) -> Event | None:
+        if line[0] == 58:  # ":" starts a comment
+            return None
+        field, colon, value = line.partition(b":")
+        if value[:1] == b" ":
+            value = value[1:]
+        if field == b"data":
+            self.__data.append(value)
+        elif field == b"event":
+            self.__event = value.decode("utf-8")
+        elif field == b"id":
+            if b"\0" not in value:
+                self.last_id = value.decode("utf-8")
+        elif field == b"retry":
+            if value.isdigit():
+                self.retry = int(value)
+        elif self.raw_lines and not colon:
+            return Event(event="raw", data=line.decode("utf-8", "replace"))
+        return None
+
+    def __dispatch(self) -> Event | None:
+        if not self.__data:
+            self.__event = ""
+            return None
+        data = self.__data
+        event = Event(
+            self.__event or "message",
+            (data[0] if len(data) == 1 else b"\n".join(data)).decode("utf-8"),
+            self.last_id,
+            self.retry,
+        )
+        self.__event = ""
+        self.__data = []
+        return event
+
+
+def iter_events(chunks: Iterable[bytes], raw_lines: bool = False) -> Iterator[Event]:
+    """Decode events from an iterable of byte chunks
+
+    Args:
+        chunks (Iterable[bytes]): e.g. httpx.Response.iter_bytes()
+        raw_lines (bool, optional): Pass on non-SSE lines. Defaults to False.
+
+    Yields:
+        Event: The decoded events
+    """
+    decoder = SSEDecoder(raw_lines=raw_lines)
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    yield from decoder.flush()
+
+
+async def aiter_events(
+    chunks: AsyncIterable[bytes],
+    raw_lines: bool = False,
+) -> AsyncIterator[Event]:
+    """Decode events from an async iterable of byte chunks
+
+    Args:
+        chunks (AsyncIterable[bytes]): e.g. httpx.Response.aiter_bytes()
+        raw_lines (bool, optional): Pass on non-SSE lines. Defaults to False.
+
+    Yields:
+        Event: The decoded events
+    """
+    decoder = SSEDecoder(raw_lines=raw_lines)
+    async for chunk in chunks:
+        for event in decoder.feed(chunk):
+            yield event
+    for event in decoder.flush():
+        yield event
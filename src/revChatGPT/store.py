@@ -0,0 +1,531 @@
+"""
+Conversation stores for the official API chatbot
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable
+from typing import Iterator
+from typing import Mapping
+from typing import MutableMapping
+
+
+def remove_indices(items: list, indices: list[int]) -> None:
+    """Remove items at ascending indices in one pass
+
+    Args:
+        items (list): List to remove from, in place
+        indices (list[int]): Ascending indices to remove
+    """
+    if not indices:
+        return
+    if indices[-1] - indices[0] + 1 == len(indices):
+        # Contiguous run, remove it with a single slice
+        del items[indices[0] : indices[-1] + 1]
+    else:
+        dropped = set(indices)
+        items[:] = [item for i, item in enumerate(items) if i not in dropped]
+
+
+class Message(Mapping):
+    """
+    A chat message, far smaller than the equivalent dict
+
+    Roles are interned, so every message shares one string per role. For
+    compatibility the message reads like its {"role", "content"[, "name"]}
+    dict, e.g. message["content"]; to_dict gives the wire format.
+
+    Messages must not be changed once created: they are shared through
+    MessageTable, their JSON encoding is cached in encoded and their content
+    hash in key.
+    """
+
+    __slots__ = ("role", "content", "name", "encoded", "key", "__weakref__")
+
+    FIELDS = frozenset(("role", "content", "name"))
+
+    def __init__(self, role: str, content: str, name: str | None = None) -> None:
+        self.role = sys.intern(role) if type(role) is str else role
+        self.content = content
+        self.name = name
+        self.encoded: bytes | None = None
+        self.key: str | None = None
+
+    @classmethod
+    def from_dict(cls, message: Mapping) -> Message | Mapping:
+        """
+        Convert a message dict, leaving dicts with other fields as they are
+        """
+        if (
+            isinstance(message, cls)
+            or "role" not in message
+            or "content" not in message
+            or not cls.FIELDS.issuperset(message)
+        ):
+            return message
+        return cls(message["role"], message["content"], message.get("name"))
+
+    def to_dict(self) -> dict:
+        """
+        The message in the format of the API
+        """
+        if self.name is None:
+            return {"role": self.role, "content": self.content}
+        return {"role": self.role, "content": self.content, "name": self.name}
+
+    def keys(self) -> tuple[str, ...]:
+        if self.name is None:
+            return ("role", "content")
+        return ("role", "content", "name")
+
+    def items(self) -> tuple[tuple[str, str], ...]:
+        if self.name is None:
+            return (("role", self.role), ("content", self.content))
+        return (("role", self.role), ("content", self.content), ("name", self.name))
+
+    def __getitem__(self, key: str) -> str:
+        if key not in self.FIELDS or (key == "name" and self.name is None):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return 2 if self.name is None else 3
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, Message):
+            return (self.role, self.content, self.name) == (
+                other.role,
+                other.content,
+                other.name,
+            )
+        return super().__eq__(other)
+
+    def __repr__(self) -> str:
+        return f"Message({self.to_dict()!r})"
+
+
+def as_dict(message: Mapping) -> dict:
+    """
+    A message in the format of the API, ready to be JSON encoded
+    """
+    return message.to_dict() if isinstance(message, Message) else message
+
+
+class MessageTable:
+    """
+    Content-addressed table of messages shared by conversations
+
+    Interning a message returns the one stored copy of every equal message,
+    so conversations become lists of references into the table and common
+    prompts are held once. Token counts are cached per content hash and
+    encoding, so shared messages are only encoded once.
+
+    The table holds messages weakly: once no conversation, snapshot or
+    caller refers to a message any more, it is dropped together with its
+    token counts. Message dicts with extra fields cannot be referenced
+    weakly and are not interned.
+    """
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__messages: dict[str, weakref.ref] = {}
+        # Token counts of each stored message by encoding
+        self.__tokens: dict[str, dict[str, int]] = {}
+
+        messages = self.__messages
+        tokens = self.__tokens
+
+        def release(ref: weakref.ref) -> None:
+            # The key may have been taken by an equal message in the meantime
+            if messages.get(ref.key) is ref:
+                del messages[ref.key]
+                tokens.pop(ref.key, None)
+
+        self.__release = release
+
+    @staticmethod
+    def hash(message: dict) -> str:
+        """
+        Content hash of a message
+        """
+        encoded = json.dumps(
+            as_dict(message),
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+    def key_of(self, message: dict) -> str:
+        """
+        Content hash of a message, hashing each Message only once
+        """
+        if not isinstance(message, Message):
+            return self.hash(message)
+        if message.key is None:
+            message.key = self.hash(message)
+        return message.key
+
+    def __lookup(self, key: str) -> Message | None:
+        ref = self.__messages.get(key)
+        return None if ref is None else ref()
+
+    def intern(self, message: dict) -> dict:
+        """
+        Get the stored copy of message, storing it if it is new
+
+        Plain message dicts are stored as Message.
+        """
+        message = Message.from_dict(message)
+        if not isinstance(message, Message):
+            return message
+        key = self.key_of(message)
+        with self.__lock:
+            stored = self.__lookup(key)
+            if stored is None:
+                ref = weakref.KeyedRef(message, self.__release, key)
+                self.__messages[key] = ref
+                stored = message
+        return stored
+
+    def get(self, key: str) -> dict:
+        """
+        The message with a content hash
+        """
+        message = self.__lookup(key)
+        if message is None:
+            raise KeyError(key)
+        return message
+
+    def get_tokens(self, message: dict, encoding: str) -> int | None:
+        """
+        Cached token count of a message under encoding
+        """
+        counts = self.__tokens.get(self.key_of(message))
+        return None if counts is None else counts.get(encoding)
+
+    def set_tokens(self, message: dict, encoding: str, tokens: int) -> None:
+        """
+        Cache the token count of a message under encoding, if it is stored
+        """
+        key = self.key_of(message)
+        with self.__lock:
+            if self.__lookup(key) is not None:
+                self.__tokens.setdefault(key, {})[encoding] = tokens
+
+    def snapshot(self, messages: list[dict]) -> tuple[dict, ...]:
+        """
+        A conversation as an immutable sequence of references to its
+        messages, which keeps them stored
+        """
+        return tuple(messages)
+
+    def restore(self, snapshot: tuple[dict, ...]) -> list[dict]:
+        """
+        The messages of a snapshot, referencing the stored copies
+        """
+        return [self.intern(message) for message in snapshot]
+
+    def shared_prefix(self, conversations: list[list[dict]]) -> int:
+        """
+        Number of leading messages all conversations have in common
+        """
+        if not conversations:
+            return 0
+        length = 0
+        for messages in zip(*conversations):
+            first = self.key_of(messages[0])
+            if any(self.key_of(message) != first for message in messages[1:]):
+                break
+            length += 1
+        return length
+
+    def __len__(self) -> int:
+        return len(self.__messages)
+
+
+class ConversationStore:
+    """
+    Interface of conversation stores: a mapping of conversation ID to its
+    list of messages, plus the mutations Chatbot makes to a conversation
+
+    Stores may persist messages, so conversations should be changed through
+    these methods rather than by editing the lists directly.
+    """
+
+    # Called with a conversation ID when it is dropped from memory
+    on_evict: Callable[[str], None] | None = None
+    # Interns messages loaded by the store
+    message_table: MessageTable | None = None
+
+    def append_message(
+        self,
+        convo_id: str,
+        message: dict,
+        tokens: int | None = None,
+        encoding: str | None = None,
+    ) -> None:
+        """
+        Append a message, with its token count under encoding if known
+        """
+        raise NotImplementedError
+
+    def pop_message(self, convo_id: str) -> dict:
+        """
+        Remove and return the last message
+        """
+        raise NotImplementedError
+
+    def remove_messages(self, convo_id: str, indices: list[int]) -> None:
+        """
+        Remove the messages at ascending indices
+        """
+        raise NotImplementedError
+
+    def get_token_counts(self, convo_id: str, encoding: str) -> list[int] | None:
+        """
+        Get stored per-message token counts, if all are known for encoding
+        """
+        return None
+
+    def set_token_counts(self, convo_id: str, encoding: str, counts: list[int]) -> None:
+        """
+        Store per-message token counts under encoding
+        """
+
+
+class MemoryStore(ConversationStore, dict):
+    """
+    Keeps conversations in a plain dict, in memory only
+    """
+
+    def append_message(
+        self,
+        convo_id: str,
+        message: dict,
+        tokens: int | None = None,
+        encoding: str | None = None,
+    ) -> None:
+        self[convo_id].append(message)
+
+    def pop_message(self, convo_id: str) -> dict:
+        return self[convo_id].pop()
+
+    def remove_messages(self, convo_id: str, indices: list[int]) -> None:
+        remove_indices(self[convo_id], indices)
+
+
+class SQLiteStore(ConversationStore, MutableMapping):
+    """
+    Keeps conversations in a SQLite database in WAL mode
+
+    Conversations are loaded on first access and the least recently used
+    ones are dropped from memory beyond max_cached. Appending a message
+    writes a single row, and token counts are stored next to each message.
+    """
+
+    def __init__(self, path: str | Path, max_cached: int = 1000) -> None:
+        """Open or create a store
+
+        Args:
+            path (str | Path): Database file
+            max_cached (int, optional): Conversations kept in memory. Defaults to 1000.
+        """
+        self.max_cached = max_cached
+        self.__lock = threading.RLock()
+        self.__cache: OrderedDict[str, list[dict]] = OrderedDict()
+        # Row sequence numbers of the cached messages
+        self.__seqs: dict[str, list[int]] = {}
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.execute(
+            "CREATE TABLE IF NOT EXISTS conversations (id TEXT PRIMARY KEY)",
+        )
+        self.__db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                convo_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                message TEXT NOT NULL,
+                tokens INTEGER,
+                encoding TEXT,
+                PRIMARY KEY (convo_id, seq)
+            ) WITHOUT ROWID
+            """,
+        )
+        self.__db.commit()
+
+    def __load(self, convo_id: str) -> list[dict]:
+        if convo_id in self.__cache:
+            self.__cache.move_to_end(convo_id)
+            return self.__cache[convo_id]
+        if not self.__db.execute(
+            "SELECT 1 FROM conversations WHERE id = ?",
+            (convo_id,),
+        ).fetchone():
+            raise KeyError(convo_id)
+        rows = self.__db.execute(
+            "SELECT seq, message FROM messages WHERE convo_id = ? ORDER BY seq",
+            (convo_id,),
+        ).fetchall()
+        messages = [json.loads(message) for _, message in rows]
+        if self.message_table is not None:
+            messages = [self.message_table.intern(message) for message in messages]
+        self.__cache[convo_id] = messages
+        self.__seqs[convo_id] = [seq for seq, _ in rows]
+        self.__evict()
+        return messages
+
+    def __evict(self) -> None:
+        while len(self.__cache) > self.max_cached:
+            convo_id, _ = self.__cache.popitem(last=False)
+            del self.__seqs[convo_id]
+            if self.on_evict is not None:
+                self.on_evict(convo_id)
+
+    def __getitem__(self, convo_id: str) -> list[dict]:
+        with self.__lock:
+            return self.__load(convo_id)
+
+    def __setitem__(self, convo_id: str, messages: list[dict]) -> None:
+        with self.__lock, self.__db:
+            self.__db.execute(
+                "INSERT OR IGNORE INTO conversations (id) VALUES (?)",
+                (convo_id,),
+            )
+            self.__db.execute("DELETE FROM messages WHERE convo_id = ?", (convo_id,))
+            self.__db.executemany(
+                "INSERT INTO messages (convo_id, seq, message) VALUES (?, ?, ?)",
+                [
+                    (convo_id, seq, json.dumps(as_dict(message)))
+                    for seq, message in enumerate(messages)
+                ],
+            )
+            self.__cache[convo_id] = messages
+            self.__cache.move_to_end(convo_id)
+            self.__seqs[convo_id] = list(range(len(messages)))
+            self.__evict()
+
+    def __delitem__(self, convo_id: str) -> None:
+        with self.__lock, self.__db:
+            if not self.__db.execute(
+                "DELETE FROM conversations WHERE id = ?",
+                (convo_id,),
+            ).rowcount:
+                raise KeyError(convo_id)
+            self.__db.execute("DELETE FROM messages WHERE convo_id = ?", (convo_id,))
+            self.__cache.pop(convo_id, None)
+            self.__seqs.pop(convo_id, None)
+
+    def clear(self) -> None:
+        """
+        Delete every conversation, in one statement per table
+        """
+        with self.__lock, self.__db:
+            self.__db.execute("DELETE FROM messages")
+            self.__db.execute("DELETE FROM conversations")
+            cached = list(self.__cache)
+            self.__cache.clear()
+            self.__seqs.clear()
+        if self.on_evict is not None:
+            for convo_id in cached:
+                self.on_evict(convo_id)
+
+    def __contains__(self, convo_id: object) -> bool:
+        with self.__lock:
+            return (
+                convo_id in self.__cache
+                or self.__db.execute(
+                    "SELECT 1 FROM conversations WHERE id = ?",
+                    (convo_id,),
+                ).fetchone()
+                is not None
+            )
+
+    def __iter__(self) -> Iterator[str]:
+        with self.__lock:
+            rows = self.__db.execute("SELECT id FROM conversations").fetchall()
+        return iter([convo_id for convo_id, in rows])
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return self.__db.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+    def append_message(
+        self,
+        convo_id: str,
+        message: dict,
+        tokens: int | None = None,
+        encoding: str | None = None,
+    ) -> None:
+        with self.__lock, self.__db:
+            messages = self.__load(convo_id)
+            seqs = self.__seqs[convo_id]
+            seq = seqs[-1] + 1 if seqs else 0
+            self.__db.execute(
+                "INSERT INTO messages VALUES (?, ?, ?, ?, ?)",
+                (convo_id, seq, json.dumps(as_dict(message)), tokens, encoding),
+            )
+            messages.append(message)
+            seqs.append(seq)
+
+    def pop_message(self, convo_id: str) -> dict:
+        with self.__lock, self.__db:
+            messages = self.__load(convo_id)
+            seq = self.__seqs[convo_id].pop()
+            self.__db.execute(
+                "DELETE FROM messages WHERE convo_id = ? AND seq = ?",
+                (convo_id, seq),
+            )
+            return messages.pop()
+
+    def remove_messages(self, convo_id: str, indices: list[int]) -> None:
+        with self.__lock, self.__db:
+            messages = self.__load(convo_id)
+            seqs = self.__seqs[convo_id]
+            self.__db.executemany(
+                "DELETE FROM messages WHERE convo_id = ? AND seq = ?",
+                [(convo_id, seqs[index]) for index in indices],
+            )
+            remove_indices(messages, indices)
+            remove_indices(seqs, indices)
+
+    def get_token_counts(self, convo_id: str, encoding: str) -> list[int] | None:
+        with self.__lock:
+            rows = self.__db.execute(
+                "SELECT tokens, encoding FROM messages WHERE convo_id = ? ORDER BY seq",
+                (convo_id,),
+            ).fetchall()
+        if any(
+            tokens is None or row_encoding != encoding for tokens, row_encoding in rows
+        ):
+            return None
+        return [tokens for tokens, _ in rows]
+
+    def set_token_counts(self, convo_id: str, encoding: str, counts: list[int]) -> None:
+        with self.__lock, self.__db:
+            self.__load(convo_id)
+            self.__db.executemany(
+                "UPDATE messages SET tokens = ?, encoding = ? WHERE convo_id = ? AND seq = ?",
+                [
+                    (tokens, encoding, convo_id, seq)
+                    for tokens, seq in zip(counts, self.__seqs[convo_id])
+                ],
+            )
+
+    def close(self) -> None:
+        """
+        Close the database
+        """
+        with self.__lock:
+            self.__db.close()
@@ -0,0 +1,266 @@
+"""
+Cancellation, client-side stop sequences and deadlines of streamed replies
+"""
+from __future__ import annotations
+
+import threading
+import time
+from typing import AsyncIterator
+from typing import Awaitable
+from typing import TypeVar
+
+import anyio
+
+from . import typings as t
+
+T = TypeVar("T")
+
+
+class CancelToken:
+    """
+    Cancels the streams it is passed to, from any thread
+
+    Streams check the token on every event they receive. Once cancelled,
+    they close their connection, so the server stops generating, and keep
+    the partial reply with the finish reason "cancelled".
+    """
+
+    def __init__(self) -> None:
+        self.__event = threading.Event()
+
+    def cancel(self) -> None:
+        """
+        Cancel the streams using this token
+        """
+        self.__event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.__event.is_set()
+
+
+def held_suffix(text: str, stop: list[str]) -> int:
+    """
+    Length of the longest end of text that could be the start of a stop
+    sequence, and so cannot be shown yet
+    """
+    longest = 0
+    for sequence in stop:
+        for length in range(min(len(sequence) - 1, len(text)), longest, -1):
+            if sequence.startswith(text[-length:]):
+                longest = length
+                break
+    return longest
+
+
+def cut_at_stop(text: str, stop: list[str]) -> tuple[str, bool]:
+    """Cut the whole text streamed so far at the first stop sequence
+
+    Args:
+        text (str): Text so far
+        stop (list[str]): Stop sequences
+
+    Returns:
+        tuple[str, bool]: The text that can be shown, and whether a stop
+        sequence was found. Without one, an end that could start a stop
+        sequence is left out until more text arrives.
+    """
+    found = [
+        index for index in (text.find(sequence) for sequence in stop) if index >= 0
+    ]
+    if found:
+        return text[: min(found)], True
+    return text[: len(text) - held_suffix(text, stop)], False
+
+
+class StopScanner:
+    """
+    Cuts a stream of text chunks at the first stop sequence
+
+    Only the text held back since the last chunk is searched again, so the
+    cost per chunk does not grow with the reply.
+    """
+
+    __slots__ = ("stop", "held", "stopped")
+
+    def __init__(self, stop: list[str]) -> None:
+        self.stop = stop
+        self.held = ""
+        self.stopped = False
+
+    def feed(self, chunk: str) -> str:
+        """
+        Take a chunk and get the text that can be shown
+        """
+        if self.stopped:
+            return ""
+        combined = self.held + chunk
+        text, self.stopped = cut_at_stop(combined, self.stop)
+        self.held = "" if self.stopped else combined[len(text) :]
+        return text
+
+    def flush(self) -> str:
+        """
+        Get the held back text once the stream has ended
+        """
+        text, self.held = self.held, ""
+        return text
+
+
+class Deadline:
+    """
+    Time limits of a streamed request in seconds, None for no limit
+
+    connect bounds opening each connection, first_token the time from the
+    call to the first token, token_gap the silence between two tokens and
+    total the whole call, including getting an arkose token, truncating the
+    conversation, waiting for rate limits and retries.
+
+    The limits are given once, e.g. to a Chatbot, and every call runs on a
+    copy made by start().
+    """
+
+    __slots__ = (
+        "connect",
+        "first_token",
+        "token_gap",
+        "total",
+        "started",
+        "last_token",
+        "tokens",
+    )
+
+    def __init__(
+        self,
+        connect: float = None,
+        first_token: float = None,
+        token_gap: float = None,
+        total: float = None,
+    ) -> None:
+        self.connect = connect
+        self.first_token = first_token
+        self.token_gap = token_gap
+        self.total = total
+        self.started: float = time.monotonic()
+        self.last_token: float | None = None
+        self.tokens: int = 0
+
+    def start(self) -> Deadline:
+        """
+        A copy of these limits whose clock starts now
+        """
+        return Deadline(self.connect, self.first_token, self.token_gap, self.total)
+
+    def __next_limit(self) -> tuple[str, float] | None:
+        """
+        The limit that runs out next and when, on the monotonic clock
+        """
+        limits = []
+        if self.total is not None:
+            limits.append(("total", self.started + self.total))
+        if self.last_token is None:
+            if self.first_token is not None:
+                limits.append(("first_token", self.started + self.first_token))
+        elif self.token_gap is not None:
+            limits.append(("token_gap", self.last_token + self.token_gap))
+        return min(limits, key=lambda limit: limit[1], default=None)
+
+    def remaining(self) -> float | None:
+        """
+        Seconds until the next limit runs out, None if there is none
+        """
+        limit = self.__next_limit()
+        return None if limit is None else limit[1] - time.monotonic()
+
+    def expired(self) -> str | None:
+        """
+        The limit that has run out, if any
+        """
+        limit = self.__next_limit()
+        if limit is None or time.monotonic() < limit[1]:
+            return None
+        return limit[0]
+
+    def check(self, tokens: int = None) -> None:
+        """
+        Raise StreamTimeoutError if a limit has run out, then note the
+        tokens received so far
+        """
+        limit = self.expired()
+        if limit is not None:
+            raise t.StreamTimeoutError(limit)
+        if tokens is not None and tokens != self.tokens:
+            self.tokens = tokens
+            self.last_token = time.monotonic()
+
+    def timeout_error(
+        self,
+        partial: str = "",
+        connect: bool = False,
+    ) -> t.StreamTimeoutError:
+        """
+        The error to raise for a timeout of the HTTP client, or for giving
+        up before a limit runs out
+        """
+        if connect:
+            limit = "connect"
+        else:
+            next_limit = self.__next_limit()
+            if next_limit is not None:
+                limit = next_limit[0]
+            else:
+                limit = "first_token" if self.last_token is None else "token_gap"
+        return t.StreamTimeoutError(limit, partial)
+
+    def http_timeout(self, default: float = None) -> tuple[float, float]:
+        """Connect and read timeouts of the next request
+
+        Socket reads cannot tell the first token from the next ones, so
+        they wait for the longer of both limits and stalls are caught within
+        that time. Streams then check the precise limits on every event.
+
+        Args:
+            default (float, optional): Timeout for what has no limit. Defaults to None.
+
+        Returns:
+            tuple[float, float]: The connect and read timeouts
+        """
+        waits = [
+            wait for wait in (self.first_token, self.token_gap) if wait is not None
+        ]
+        read = max(waits, default=default)
+        if self.total is not None:
+            left = max(self.started + self.total - time.monotonic(), 0.0)
+            read = left if read is None else min(read, left)
+        return (default if self.connect is None else self.connect), read
+
+
+async def within(deadline: Deadline | None, awaitable: Awaitable[T]) -> T:
+    """
+    Await awaitable, raising StreamTimeoutError if a limit of the deadline
+    runs out first
+
+    The wait is cancelled through an anyio cancel scope, which httpcore
+    shields the closing of a response from, so a timed out read still
+    returns its connection to the pool.
+    """
+    remaining = None if deadline is None else deadline.remaining()
+    if remaining is None:
+        return await awaitable
+    with anyio.move_on_after(max(remaining, 0.0)):
+        return await awaitable
+    raise deadline.timeout_error()
+
+
+async def timed(events: AsyncIterator[T], deadline: Deadline) -> AsyncIterator[T]:
+    """
+    Iterate events, raising StreamTimeoutError as soon as a limit of the
+    deadline runs out between two of them
+    """
+    iterator = events.__aiter__()
+    while True:
+        try:
+            event = await within(deadline, iterator.__anext__())
+        except StopAsyncIteration:
+            return
+        yield event
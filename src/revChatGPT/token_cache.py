@@ -0,0 +1,259 @@
+"""
+Access token cache shared by processes through one JSON file
+"""
+from __future__ import annotations
+
+import base64
+import binascii
+import contextlib
+import json
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Callable
+from typing import Iterator
+from typing import NamedTuple
+
+from . import typings as t
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+class CachedToken(NamedTuple):
+    """
+    An access token with its decoded expiry, in seconds since the epoch
+    """
+
+    access_token: str
+    expires_at: float | None
+
+
+def decode_jwt_exp(access_token: str) -> float | None:
+    """Decode the expiry of a JWT access token without verifying it
+
+    Args:
+        access_token (str): The JWT
+
+    Raises:
+        t.Error: The token is not a JWT
+
+    Returns:
+        float | None: The exp claim, or None if the token has none
+    """
+    try:
+        payload = access_token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+        exp = claims.get("exp")
+    except (IndexError, binascii.Error, ValueError, AttributeError):
+        raise t.Error(
+            source="decode_jwt_exp",
+            message="Invalid access token",
+            code=t.ErrorType.INVALID_ACCESS_TOKEN_ERROR,
+        ) from None
+    return float(exp) if exp is not None else None
+
+
+@contextlib.contextmanager
+def _file_lock(path: Path) -> Iterator[None]:
+    """
+    Hold an exclusive lock on a sidecar file of path across processes
+    """
+    with open(path.with_name(path.name + ".lock"), "a+b") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class TokenCache:
+    """
+    Access tokens by account email, kept in a JSON file
+
+    Writes take an inter-process lock, re-read the file and atomically
+    replace it, so concurrent processes never see a torn file or lose each
+    other's tokens. Reads are served from a decoded in-memory view that is
+    only reloaded when the file's mtime or size changes.
+
+    The file keeps the {"access_tokens": {email: token}} format, with the
+    decoded expiry of each token under "access_token_expiry".
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        self.__lock = threading.Lock()
+        self.__stamp: tuple[int, int, int] | None = None
+        self.__entries: dict[str, CachedToken] = {}
+        # Tokens that could not be decoded, kept apart to report on lookup
+        self.__invalid: set[str] = set()
+
+    def __stat(self) -> tuple[int, int, int] | None:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        # Atomic replaces give the file a new inode as well
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def __read(self) -> dict:
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                data = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def __decode(self, data: dict) -> None:
+        """
+        Rebuild the in-memory view from the file contents
+        """
+        entries = {}
+        invalid = set()
+        expiry = data.get("access_token_expiry", {})
+        for email, access_token in data.get("access_tokens", {}).items():
+            if email in expiry:
+                entries[email] = CachedToken(access_token, expiry[email])
+                continue
+            # Written by an older version without the decoded expiry
+            try:
+                entries[email] = CachedToken(access_token, decode_jwt_exp(access_token))
+            except t.Error:
+                invalid.add(email)
+        self.__entries = entries
+        self.__invalid = invalid
+
+    def __refresh(self) -> None:
+        stamp = self.__stat()
+        if stamp != self.__stamp:
+            self.__decode(self.__read() if stamp is not None else {})
+            self.__stamp = stamp
+
+    def __update(self, change: Callable[[dict], None]) -> None:
+        """
+        Apply change to the latest file contents and write them back atomically
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with _file_lock(self.path):
+            data = self.__read()
+            data.setdefault("access_tokens", {})
+            data.setdefault("access_token_expiry", {})
+            change(data)
+            fd, temp_path = tempfile.mkstemp(
+                dir=self.path.parent,
+                prefix=self.path.name,
+                suffix=".tmp",
+            )
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as file:
+                    json.dump(data, file, separators=(",", ":"))
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temp_path, self.path)
+            except BaseException:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(temp_path)
+                raise
+            self.__decode(data)
+            self.__stamp = self.__stat()
+
+    def get(self, email: str) -> CachedToken | None:
+        """Look up the token of an account
+
+        Args:
+            email (str): Account email
+
+        Raises:
+            t.Error: The cached token is not a JWT. It is removed from the cache.
+
+        Returns:
+            CachedToken | None: The token and its expiry, or None if not cached
+        """
+        with self.__lock:
+            self.__refresh()
+            if email in self.__invalid:
+                self.__update(lambda data: self.__remove(data, email))
+                raise t.Error(
+                    source="TokenCache.get",
+                    message="Invalid access token",
+                    code=t.ErrorType.INVALID_ACCESS_TOKEN_ERROR,
+                )
+            return self.__entries.get(email)
+
+    def set(self, email: str, access_token: str) -> CachedToken:
+        """Cache the token of an account, unless it is cached already
+
+        Args:
+            email (str): Account email
+            access_token (str): The JWT
+
+        Returns:
+            CachedToken: The token and its expiry, which is None for tokens
+            that are not JWTs. Those are reported as invalid on lookup.
+        """
+        with self.__lock:
+            self.__refresh()
+            entry = self.__entries.get(email)
+            if entry is not None and entry.access_token == access_token:
+                return entry
+            try:
+                entry = CachedToken(access_token, decode_jwt_exp(access_token))
+                valid = True
+            except t.Error:
+                entry = CachedToken(access_token, None)
+                valid = False
+
+            def change(data: dict) -> None:
+                data["access_tokens"][email] = entry.access_token
+                if valid:
+                    data["access_token_expiry"][email] = entry.expires_at
+                else:
+                    data["access_token_expiry"].pop(email, None)
+
+            self.__update(change)
+            return entry
+
+    def delete(self, email: str) -> None:
+        """
+        Remove the token of an account
+        """
+        with self.__lock:
+            self.__update(lambda data: self.__remove(data, email))
+
+    @staticmethod
+    def __remove(data: dict, email: str) -> None:
+        data["access_tokens"].pop(email, None)
+        data["access_token_expiry"].pop(email, None)
+
+
+_lock = threading.Lock()
+_caches: dict[Path, TokenCache] = {}
+
+
+def get_token_cache(path: str | Path) -> TokenCache:
+    """Get the process-wide token cache of a file
+
+    Args:
+        path (str | Path): Cache file
+
+    Returns:
+        TokenCache: The shared cache
+    """
+    path = Path(path).absolute()
+    with _lock:
+        if path not in _caches:
+            _caches[path] = TokenCache(path)
+        return _caches[path]
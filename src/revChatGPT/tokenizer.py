@@ -0,0 +1,149 @@
+"""
+Process-wide registry of tiktoken encoders
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+# tiktoken is imported when the first encoder is needed
+if TYPE_CHECKING:
+    import tiktoken
+
+log = logging.getLogger(__name__)
+
+BPE_URLS = {
+    "cl100k_base": "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken",
+    "p50k_base": "https://openaipublic.blob.core.windows.net/encodings/p50k_base.tiktoken",
+    "r50k_base": "https://openaipublic.blob.core.windows.net/encodings/r50k_base.tiktoken",
+}
+
+_lock = threading.Lock()
+_encodings: dict[str, tiktoken.Encoding] = {}
+# Local cache of BPE files once set_offline was called
+_offline_dir: Path | None = None
+
+
+def get_encoding_name(engine: str) -> str:
+    """Resolve an engine to the name of its encoding
+
+    Args:
+        engine (str): Model name, e.g. gpt-3.5-turbo
+
+    Raises:
+        NotImplementedError: Unknown engine
+
+    Returns:
+        str: Encoding name, e.g. cl100k_base
+    """
+    import tiktoken.model
+
+    if engine in tiktoken.model.MODEL_TO_ENCODING:
+        return tiktoken.model.MODEL_TO_ENCODING[engine]
+    # Older tiktoken releases have no prefix table and no entry for gpt-4
+    prefixes = getattr(tiktoken.model, "MODEL_PREFIX_TO_ENCODING", {})
+    for prefix, name in prefixes.items():
+        if engine.startswith(prefix):
+            return name
+    if engine.startswith(("gpt-4", "gpt-3.5-turbo")):
+        return "cl100k_base"
+    raise NotImplementedError(f"No known encoding for engine {engine}")
+
+
+def get_encoding(engine: str) -> tiktoken.Encoding:
+    """Get the encoder of an engine, loading it once per process
+
+    Args:
+        engine (str): Model name, e.g. gpt-3.5-turbo
+
+    Returns:
+        tiktoken.Encoding: The shared encoder
+    """
+    encoding = _encodings.get(engine)
+    if encoding is not None:
+        return encoding
+    import tiktoken
+
+    with _lock:
+        if engine not in _encodings:
+            name = get_encoding_name(engine)
+            _check_offline(name)
+            _encodings[engine] = tiktoken.get_encoding(name)
+        return _encodings[engine]
+
+
+def _cache_key(name: str) -> str:
+    """
+    File name tiktoken caches the BPE file of an encoding under
+    """
+    return hashlib.sha1(BPE_URLS[name].encode()).hexdigest()
+
+
+def _check_offline(name: str) -> None:
+    """
+    Raise instead of letting tiktoken download a BPE file that is missing
+    from the offline cache
+    """
+    if _offline_dir is None:
+        return
+    if name not in BPE_URLS or not (_offline_dir / _cache_key(name)).exists():
+        raise FileNotFoundError(
+            f"No BPE file for {name} in the offline cache {_offline_dir}",
+        )
+
+
+def warm_up(engines: list[str], background: bool = True) -> threading.Thread | None:
+    """Load the encoders of some engines ahead of their first use
+
+    Args:
+        engines (list[str]): Engines to resolve
+        background (bool, optional): Load in a daemon thread. Defaults to True.
+
+    Returns:
+        threading.Thread | None: The loader thread if background is set
+    """
+
+    def load() -> None:
+        for engine in engines:
+            try:
+                get_encoding(engine)
+            except Exception as error:
+                log.warning("Could not warm up encoder for %s: %s", engine, error)
+
+    if not background:
+        load()
+        return None
+    thread = threading.Thread(target=load, name="revChatGPT-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def set_offline(cache_dir: str | Path, bpe_files: dict[str, str | Path] = None) -> None:
+    """Load BPE ranks from a local cache instead of downloading them
+
+    tiktoken looks up its downloads in TIKTOKEN_CACHE_DIR under the SHA-1 of
+    their URL, so local BPE files are copied there under that name. From
+    then on, get_encoding raises FileNotFoundError for encodings missing
+    from the cache rather than downloading them.
+
+    Args:
+        cache_dir (str | Path): Directory holding the cached BPE files
+        bpe_files (dict[str, str | Path], optional): Encoding name to a local
+            .tiktoken file to seed the cache with. Defaults to None.
+    """
+    global _offline_dir
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    for name, bpe_file in (bpe_files or {}).items():
+        if name not in BPE_URLS:
+            raise NotImplementedError(f"Unknown encoding {name}")
+        target = cache_dir / _cache_key(name)
+        if not target.exists():
+            shutil.copyfile(bpe_file, target)
+    os.environ["TIKTOKEN_CACHE_DIR"] = str(cache_dir)
+    _offline_dir = cache_dir
@@ -0,0 +1,207 @@
+"""
+Shared, pooled HTTP clients for the official API
+"""
+from __future__ import annotations
+
+import asyncio
+import importlib.util
+import logging
+import threading
+import time
+import weakref
+
+import httpx
+
+log = logging.getLogger(__name__)
+
+DEFAULT_LIMITS = httpx.Limits(
+    max_connections=100,
+    max_keepalive_connections=20,
+    keepalive_expiry=30.0,
+)
+
+
+class RequestTrace:
+    """
+    Connection events of a single request, fed by the httpcore trace extension
+
+    Pass it as extensions={"trace": trace} when sending a request.
+    """
+
+    def __init__(self) -> None:
+        self.started: float = time.perf_counter()
+        self.events: dict[str, float] = {}
+
+    def __call__(self, event_name: str, info: dict) -> None:
+        self.events[event_name] = time.perf_counter()
+
+    @property
+    def reused(self) -> bool:
+        """
+        Whether the request went out on a kept-alive connection
+        """
+        return "connection.connect_tcp.started" not in self.events
+
+
+class AsyncRequestTrace(RequestTrace):
+    """
+    RequestTrace for async clients, which await their trace callback
+    """
+
+    async def __call__(self, event_name: str, info: dict) -> None:
+        self.events[event_name] = time.perf_counter()
+
+
+class ConnectionStats:
+    """
+    Connection reuse counters of a transport
+    """
+
+    def __init__(self) -> None:
+        self.requests: int = 0
+        self.new_connections: int = 0
+        self.reused_connections: int = 0
+        self.__lock = threading.Lock()
+
+    def record(self, trace: RequestTrace) -> None:
+        """
+        Count a finished request
+        """
+        with self.__lock:
+            self.requests += 1
+            if trace.reused:
+                self.reused_connections += 1
+            else:
+                self.new_connections += 1
+
+    def to_dict(self) -> dict[str, int]:
+        return {
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "reused_connections": self.reused_connections,
+        }
+
+
+class Transport:
+    """
+    A sync client and per-event-loop async clients sharing one configuration
+
+    Clients are created on first use and keep their connections alive, so
+    every Chatbot using the same transport shares TLS sessions to the API.
+    API keys are sent per request and are not part of the transport.
+    """
+
+    def __init__(
+        self,
+        proxy: str = None,
+        http2: bool = True,
+        limits: httpx.Limits = DEFAULT_LIMITS,
+    ) -> None:
+        if proxy and proxy.startswith("socks5h://"):
+            # httpx resolves hostnames on the proxy for socks5 already
+            proxy = "socks5://" + proxy[len("socks5h://") :]
+        if http2 and importlib.util.find_spec("h2") is None:
+            log.debug("h2 is not installed, falling back to HTTP/1.1")
+            http2 = False
+        self.proxy = proxy
+        self.http2 = http2
+        self.limits = limits
+        self.stats = ConnectionStats()
+        self.__lock = threading.Lock()
+        self.__client: httpx.Client = None
+        self.__aclients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    @property
+    def client(self) -> httpx.Client:
+        """
+        The shared sync client
+        """
+        if self.__client is None:
+            with self.__lock:
+                if self.__client is None:
+                    self.__client = httpx.Client(
+                        follow_redirects=True,
+                        proxy=self.proxy,
+                        http2=self.http2,
+                        limits=self.limits,
+                    )
+        return self.__client
+
+    @property
+    def aclient(self) -> httpx.AsyncClient:
+        """
+        The async client of the running event loop
+
+        Connections cannot move between event loops, so each loop gets its
+        own client. Call aclose() before the loop ends.
+        """
+        loop = asyncio.get_running_loop()
+        with self.__lock:
+            # Pooled connections keep their loop alive, so the clients of
+            # loops that ended without aclose() are only dropped here
+            for closed in [other for other in self.__aclients if other.is_closed()]:
+                del self.__aclients[closed]
+            aclient = self.__aclients.get(loop)
+            if aclient is None:
+                aclient = self.__aclients[loop] = httpx.AsyncClient(
+                    follow_redirects=True,
+                    proxy=self.proxy,
+                    http2=self.http2,
+                    limits=self.limits,
+                )
+        return aclient
+
+    async def aclose(self) -> None:
+        """
+        Close the async client of the running event loop
+
+        Its connections are not reused afterwards, but the next request on
+        the loop opens a new client.
+        """
+        loop = asyncio.get_running_loop()
+        with self.__lock:
+            aclient = self.__aclients.pop(loop, None)
+        if aclient is not None:
+            await aclient.aclose()
+
+    def close(self) -> None:
+        """
+        Close the sync client. Async clients are closed by aclose() on their
+        event loop.
+        """
+        with self.__lock:
+            if self.__client is not None:
+                self.__client.close()
+                self.__client = None
+
+
+_lock = threading.Lock()
+_transports: dict[tuple, Transport] = {}
+
+
+def get_transport(
+    proxy: str = None,
+    http2: bool = True,
+    limits: httpx.Limits = DEFAULT_LIMITS,
+) -> Transport:
+    """Get the process-wide transport for a configuration
+
+    Args:
+        proxy (str, optional): Proxy URL. Defaults to None.
+        http2 (bool, optional): Use HTTP/2 when h2 is installed. Defaults to True.
+        limits (httpx.Limits, optional): Pool limits. Defaults to DEFAULT_LIMITS.
+
+    Returns:
+        Transport: The shared transport
+    """
+    key = (
+        proxy,
+        http2,
+        limits.max_connections,
+        limits.max_keepalive_connections,
+        limits.keepalive_expiry,
+    )
+    with _lock:
+        if key not in _transports:
+            _transports[key] = Transport(proxy=proxy, http2=http2, limits=limits)
+        return _transports[key]
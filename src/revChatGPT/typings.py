@@ -3,13 +3,13 @@ A module that contains all the types used in this project
 """
 
 import os
-import platform
+import sys
 from enum import Enum
 from typing import Union
 
 
-python_version = list(platform.python_version_tuple())
-SUPPORT_ADD_NOTES = int(python_version[0]) >= 3 and int(python_version[1]) >= 11
+python_version = [str(part) for part in sys.version_info[:3]]
+SUPPORT_ADD_NOTES = sys.version_info >= (3, 11)
 
 
 class ChatbotError(Exception):
@@ -170,6 +170,20 @@ class RequestError(APIConnectionError):
     """
 
 
+class StreamTimeoutError(APIConnectionError):
+    """
+    Subclass of APIConnectionError
+
+    A limit of a streamed request's deadline ran out. limit names it: "connect", "first_token",
+    "token_gap" or "total", and partial holds the text received before it did
+    """
+
+    def __init__(self, limit: str, partial: str = "", *args: object) -> None:
+        self.limit: str = limit
+        self.partial: str = partial
+        super().__init__(f"{limit} deadline exceeded", *args)
+
+
 class Colors:
     """
     Colors for printing
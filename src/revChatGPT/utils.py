@@ -1,14 +1,17 @@
+from __future__ import annotations
+
 import re
 from typing import Set
+from typing import TYPE_CHECKING
 
-from prompt_toolkit import prompt
-from prompt_toolkit import PromptSession
-from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
-from prompt_toolkit.completion import WordCompleter
-from prompt_toolkit.history import InMemoryHistory
-from prompt_toolkit.key_binding import KeyBindings
+# prompt_toolkit is only needed by the command line interfaces, so it is
+# imported by the functions using it rather than with this module
+if TYPE_CHECKING:
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.completion import WordCompleter
+    from prompt_toolkit.key_binding import KeyBindings
 
-bindings = KeyBindings()
+bindings: KeyBindings | None = None
 
 
 def create_keybindings(key: str = "c-@") -> KeyBindings:
@@ -16,6 +19,11 @@ def create_keybindings(key: str = "c-@") -> KeyBindings:
     Create keybindings for prompt_toolkit. Default key is ctrl+space.
     For possible keybindings, see: https://python-prompt-toolkit.readthedocs.io/en/stable/pages/advanced_topics/key_bindings.html#list-of-special-keys
     """
+    from prompt_toolkit.key_binding import KeyBindings
+
+    global bindings
+    if bindings is None:
+        bindings = KeyBindings()
 
     @bindings.add(key)
     def _(event: dict) -> None:
@@ -25,10 +33,15 @@ def create_keybindings(key: str = "c-@") -> KeyBindings:
 
 
 def create_session() -> PromptSession:
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.history import InMemoryHistory
+
     return PromptSession(history=InMemoryHistory())
 
 
 def create_completer(commands: list, pattern_str: str = "$") -> WordCompleter:
+    from prompt_toolkit.completion import WordCompleter
+
     return WordCompleter(words=commands, pattern=re.compile(pattern_str))
 
 
@@ -40,6 +53,9 @@ def get_input(
     """
     Multiline input function.
     """
+    from prompt_toolkit import prompt
+    from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
+
     return (
         session.prompt(
             completer=completer,
@@ -59,6 +75,9 @@ async def get_input_async(
     """
     Multiline input function.
     """
+    from prompt_toolkit import prompt
+    from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
+
     return (
         await session.prompt_async(
             completer=completer,
@@ -0,0 +1,233 @@
+"""
+Shared fixtures: a local stub of the HTTP APIs and an offline tokenizer
+"""
+from __future__ import annotations
+
+import contextlib
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable
+from typing import Iterator
+from urllib.parse import parse_qsl
+
+import pytest
+
+SRC = Path(__file__).parents[1] / "src"
+if str(SRC) not in sys.path:
+    sys.path.insert(0, str(SRC))
+
+
+class StubRequest:
+    """
+    A request received by the stub server
+    """
+
+    def __init__(
+        self,
+        method: str,
+        path: str,
+        headers: dict,
+        body: bytes,
+        port: int,
+        query: dict = None,
+    ) -> None:
+        self.method = method
+        self.path = path
+        self.query = query or {}
+        self.headers = headers
+        self.body = body
+        # Client port, the same for requests on one kept-alive connection
+        self.port = port
+
+    def json(self) -> dict:
+        return json.loads(self.body)
+
+
+class StubResponse:
+    """
+    A canned response, sent as chunks delay seconds apart
+
+    A number among the chunks pauses the response for that many seconds.
+    """
+
+    def __init__(
+        self,
+        status: int = 200,
+        chunks: list[bytes | float] = (),
+        headers: dict = None,
+        delay: float = 0.0,
+    ) -> None:
+        self.status = status
+        self.chunks = list(chunks)
+        self.headers = headers or {}
+        self.delay = delay
+
+
+Route = Callable[[StubRequest], StubResponse]
+
+
+class StubServer:
+    """
+    A local HTTP server answering each path with the response of its route
+    """
+
+    def __init__(self) -> None:
+        self.routes: dict[str, Route] = {}
+        self.requests: list[StubRequest] = []
+        self.__server = ThreadingHTTPServer(("127.0.0.1", 0), self.__handler())
+        self.__server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.__server.server_port}"
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    @staticmethod
+    def sse(payloads: list[dict], done: bool = True) -> list[bytes]:
+        """
+        Chunks of a server-sent event stream with one event per payload
+        """
+        chunks = [
+            b"data: " + json.dumps(payload).encode() + b"\n\n" for payload in payloads
+        ]
+        if done:
+            chunks.append(b"data: [DONE]\n\n")
+        return chunks
+
+    @classmethod
+    def completion(cls, words: list[str], n: int = 1) -> list[bytes]:
+        """
+        Chunks of a streamed chat completion of the official API
+        """
+        deltas = [{"role": "assistant"}] + [{"content": word} for word in words]
+        payloads = [
+            {"choices": [{"index": index, "delta": delta} for index in range(n)]}
+            for delta in deltas
+        ]
+        payloads.append(
+            {
+                "choices": [
+                    {"index": index, "delta": {}, "finish_reason": "stop"}
+                    for index in range(n)
+                ],
+            },
+        )
+        return cls.sse(payloads)
+
+    def __handler(self) -> type[BaseHTTPRequestHandler]:
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args: object) -> None:
+                pass
+
+            def handle(self) -> None:
+                # Clients may drop kept-alive connections at any time
+                with contextlib.suppress(ConnectionResetError):
+                    super().handle()
+
+            def do_GET(self) -> None:
+                self.respond()
+
+            def do_POST(self) -> None:
+                self.respond()
+
+            def respond(self) -> None:
+                length = int(self.headers.get("content-length") or 0)
+                path, _, query = self.path.partition("?")
+                request = StubRequest(
+                    self.command,
+                    path,
+                    dict(self.headers),
+                    self.rfile.read(length),
+                    self.client_address[1],
+                    dict(parse_qsl(query)),
+                )
+                stub.requests.append(request)
+                route = stub.routes.get(request.path)
+                response = route(request) if route else StubResponse(404)
+                self.send_response(response.status)
+                for name, value in response.headers.items():
+                    self.send_header(name, value)
+                self.send_header("transfer-encoding", "chunked")
+                self.end_headers()
+                try:
+                    for chunk in response.chunks:
+                        if not isinstance(chunk, bytes):
+                            time.sleep(chunk)
+                            continue
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                        self.wfile.flush()
+                        time.sleep(response.delay)
+                    self.wfile.write(b"0\r\n\r\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+        return Handler
+
+
+@pytest.fixture
+def stub_server() -> Iterator[StubServer]:
+    server = StubServer()
+    yield server
+    server.close()
+
+
+class WordEncoding:
+    """
+    Counts words as tokens, so tests need no downloaded BPE ranks
+    """
+
+    name = "words"
+
+    def encode(self, text: str) -> list[str]:
+        return text.split()
+
+    def encode_batch(self, texts: list[str], num_threads: int = 8) -> list[list[str]]:
+        return [text.split() for text in texts]
+
+
+@pytest.fixture
+def word_tokens(monkeypatch: pytest.MonkeyPatch) -> WordEncoding:
+    from revChatGPT import tokenizer
+    from revChatGPT.V3 import ENGINES
+
+    encoding = WordEncoding()
+    monkeypatch.setattr(
+        tokenizer,
+        "_encodings",
+        {engine: encoding for engine in ENGINES},
+    )
+    return encoding
+
+
+@pytest.fixture
+def completions(
+    stub_server: StubServer,
+    monkeypatch: pytest.MonkeyPatch,
+) -> StubServer:
+    """
+    stub_server answering chat completions with "Hello world", and the
+    official API pointed at it
+    """
+
+    def complete(request: StubRequest) -> StubResponse:
+        return StubResponse(
+            chunks=StubServer.completion(
+                ["Hello", " world"], request.json().get("n", 1)
+            ),
+            headers={"content-type": "text/event-stream"},
+        )
+
+    stub_server.routes["/v1/chat/completions"] = complete
+    monkeypatch.setenv("API_URL", f"{stub_server.url}/v1/chat/completions")
+    return stub_server
@@ -0,0 +1,127 @@
+"""
+Pooled Arkose tokens of the V1 chatbot, served by the stub server
+"""
+import asyncio
+import itertools
+import json
+import threading
+
+import pytest
+from conftest import StubRequest
+from conftest import StubResponse
+from conftest import StubServer
+from revChatGPT import V1
+from revChatGPT.transport import get_transport
+from revChatGPT.V1 import ArkoseTokenProvider
+
+
+@pytest.fixture
+def arkose(stub_server: StubServer, monkeypatch: pytest.MonkeyPatch) -> StubServer:
+    """
+    stub_server serving the endpoint statuses and numbered tokens
+    """
+    counter = itertools.count()
+    statuses = [
+        {
+            "group": "Arkose Labs",
+            "name": f"{stub_server.url}/token",
+            "results": [{"success": True}] * 5,
+        },
+        {
+            "group": "Arkose Labs",
+            "name": f"{stub_server.url}/down",
+            "results": [{"success": False}] * 5,
+        },
+    ]
+
+    def token(request: StubRequest) -> StubResponse:
+        body = json.dumps({"token": f"token-{next(counter)}"}).encode()
+        return StubResponse(chunks=[body])
+
+    stub_server.routes["/statuses"] = lambda request: StubResponse(
+        chunks=[json.dumps(statuses).encode()],
+    )
+    stub_server.routes["/token"] = token
+    monkeypatch.setattr(V1, "ARKOSE_STATUS_URL", f"{stub_server.url}/statuses")
+    return stub_server
+
+
+def paths(server: StubServer) -> list[str]:
+    return [request.path for request in server.requests]
+
+
+def test_pool_refills_in_background(arkose: StubServer) -> None:
+    provider = ArkoseTokenProvider(pool_size=2)
+    assert provider.get_token() == "token-0"
+    provider._ArkoseTokenProvider__refill_thread.join()
+    assert [token for token, _ in provider.pool] == ["token-1", "token-2"]
+    assert provider.get_token() == "token-1"
+    provider._ArkoseTokenProvider__refill_thread.join()
+    assert len(provider.pool) == 2
+    # Endpoint health is fetched once, the unhealthy endpoint never used
+    assert paths(arkose).count("/statuses") == 1
+    assert "/down" not in paths(arkose)
+
+
+def test_expired_tokens_are_skipped(arkose: StubServer) -> None:
+    provider = ArkoseTokenProvider(pool_size=1, token_ttl=0)
+    provider.prefetch()
+    provider._ArkoseTokenProvider__refill_thread.join()
+    assert provider.get_token() == "token-1"
+
+
+def test_pool_is_shared_between_threads(arkose: StubServer) -> None:
+    provider = ArkoseTokenProvider(pool_size=3)
+    tokens = []
+
+    def take() -> None:
+        for _ in range(10):
+            tokens.append(provider.get_token())
+
+    threads = [threading.Thread(target=take) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    provider._ArkoseTokenProvider__refill_thread.join()
+    # Every token is handed out once and the pool never overfills
+    assert len(set(tokens)) == len(tokens) == 80
+    assert len(provider.pool) <= 3
+
+
+def test_async_fetches_reuse_one_connection(arkose: StubServer) -> None:
+    provider = ArkoseTokenProvider(pool_size=0)
+
+    async def main() -> list[str]:
+        tokens = [await provider.get_token_async() for _ in range(5)]
+        await provider.aclose()
+        return tokens
+
+    assert asyncio.run(main()) == [f"token-{index}" for index in range(5)]
+    assert len({request.port for request in arkose.requests}) == 1
+
+
+def test_token_traffic_goes_through_the_proxy(arkose: StubServer) -> None:
+    proxy = StubServer()
+    try:
+        # A forward proxy receives absolute URLs and relays them to arkose
+        for path in ("/statuses", "/token"):
+            proxy.routes[arkose.url + path] = arkose.routes[path]
+        provider = ArkoseTokenProvider(pool_size=0, proxy=proxy.url)
+        assert provider.transport is get_transport(proxy=proxy.url)
+        assert provider.get_token() == "token-0"
+
+        async def main() -> str:
+            token = await provider.get_token_async()
+            await provider.aclose()
+            return token
+
+        assert asyncio.run(main()) == "token-1"
+        assert not arkose.requests
+        assert [request.path for request in proxy.requests] == [
+            f"{arkose.url}/statuses",
+            f"{arkose.url}/token",
+            f"{arkose.url}/token",
+        ]
+    finally:
+        proxy.close()
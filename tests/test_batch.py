@@ -0,0 +1,25 @@
+"""
+Fan-out of many prompts with ask_many
+"""
+from conftest import StubServer
+from conftest import WordEncoding
+from revChatGPT.transport import Transport
+from revChatGPT.V3 import Chatbot
+
+
+def test_ask_many(completions: StubServer, word_tokens: WordEncoding) -> None:
+    transport = Transport(http2=False)
+    chatbot = Chatbot("key", transport=transport)
+    finished = []
+    report = chatbot.ask_many(
+        ["one", "two", ("three", "kept")],
+        concurrency=2,
+        on_result=lambda result: finished.append(result.index),
+    )
+    assert [result.response for result in report.results] == ["Hello world"] * 3
+    assert sorted(finished) == [0, 1, 2]
+    assert len(completions.requests) == 3
+    # Temporary conversations are removed, named ones kept
+    assert set(chatbot.conversation) == {"default", "kept"}
+    # The batch's loop has ended, and its client with it
+    assert not transport._Transport__aclients
@@ -0,0 +1,108 @@
+"""
+Several choices of one chat completion
+"""
+import asyncio
+from typing import AsyncIterator
+
+from conftest import StubRequest
+from conftest import StubResponse
+from conftest import StubServer
+from conftest import WordEncoding
+from revChatGPT.V3 import asplit_choices
+from revChatGPT.V3 import Chatbot
+from revChatGPT.V3 import split_choices
+
+
+def three_choices(request: StubRequest) -> StubResponse:
+    """
+    Three choices with their own text, the second one cut at max_tokens
+    """
+    assert request.json()["n"] == 3
+    payloads = [
+        {"choices": [{"index": index, "delta": {"role": "assistant"}}]}
+        for index in range(3)
+    ]
+    for word in ("Hello", " world"):
+        payloads.append(
+            {
+                "choices": [
+                    {"index": index, "delta": {"content": f"{word}{index}"}}
+                    for index in range(3)
+                ],
+            },
+        )
+    payloads.append(
+        {
+            "choices": [
+                {"index": 0, "delta": {}, "finish_reason": "stop"},
+                {"index": 1, "delta": {}, "finish_reason": "length"},
+                {"index": 2, "delta": {}, "finish_reason": "content_filter"},
+            ],
+        },
+    )
+    return StubResponse(chunks=StubServer.sse(payloads))
+
+
+def test_every_choice_gets_its_own_branch(
+    completions: StubServer,
+    word_tokens: WordEncoding,
+) -> None:
+    completions.routes["/v1/chat/completions"] = three_choices
+    chatbot = Chatbot("key", reply_count=3)
+    assert chatbot.ask("hi") == "Hello0 world0"
+
+    history = chatbot.conversation["default"][:-1]
+    assert chatbot.conversation["default"][-1]["content"] == "Hello0 world0"
+    assert chatbot.finish_reasons["default"] == "stop"
+    for index, reason in ((1, "length"), (2, "content_filter")):
+        branch = Chatbot.choice_branch("default", index)
+        assert branch == f"default#{index}"
+        assert chatbot.conversation[branch][:-1] == history
+        assert chatbot.conversation[branch][-1]["role"] == "assistant"
+        assert chatbot.conversation[branch][-1]["content"] == (
+            f"Hello{index} world{index}"
+        )
+        assert chatbot.finish_reasons[branch] == reason
+
+    # Going on in a branch sends that choice as the reply
+    completions.routes["/v1/chat/completions"] = lambda request: StubResponse(
+        chunks=StubServer.completion(["Sure"]),
+    )
+    assert chatbot.ask("more", convo_id="default#1", n=1) == "Sure"
+    messages = completions.requests[-1].json()["messages"]
+    assert messages[-2]["content"] == "Hello1 world1"
+
+
+def test_all_choices_are_streamed(
+    completions: StubServer,
+    word_tokens: WordEncoding,
+) -> None:
+    completions.routes["/v1/chat/completions"] = three_choices
+    chatbot = Chatbot("key", reply_count=3)
+    streamed = list(chatbot.ask_stream("hi", all_choices=True))
+    for index in range(3):
+        assert [text for i, text in streamed if i == index] == [
+            f"Hello{index}",
+            f" world{index}",
+        ]
+
+
+def test_split_choices(completions: StubServer, word_tokens: WordEncoding) -> None:
+    completions.routes["/v1/chat/completions"] = three_choices
+    chatbot = Chatbot("key", reply_count=3)
+    streams = split_choices(chatbot.ask_stream("hi", all_choices=True), 3)
+    # Reading the last choice first buffers the others
+    assert "".join(streams[2]) == "Hello2 world2"
+    assert "".join(streams[0]) == "Hello0 world0"
+    assert "".join(streams[1]) == "Hello1 world1"
+
+    async def read(stream: AsyncIterator[str]) -> str:
+        return "".join([text async for text in stream])
+
+    async def main() -> list[str]:
+        streams = asplit_choices(chatbot.ask_stream_async("again", all_choices=True), 3)
+        texts = await asyncio.gather(*(read(stream) for stream in streams))
+        await chatbot.transport.aclose()
+        return texts
+
+    assert asyncio.run(main()) == [f"Hello{index} world{index}" for index in range(3)]
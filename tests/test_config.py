@@ -0,0 +1,38 @@
+"""
+Saving and loading the configuration of the official API chatbot
+"""
+import json
+from pathlib import Path
+
+from conftest import WordEncoding
+from revChatGPT.hedging import HedgePolicy
+from revChatGPT.streaming import Deadline
+from revChatGPT.V3 import Chatbot
+from revChatGPT.V3 import KeepPinned
+
+
+def test_save_and_load_skip_objects(tmp_path: Path, word_tokens: WordEncoding) -> None:
+    config = tmp_path / "config.json"
+    chatbot = Chatbot(
+        "key",
+        temperature=0.2,
+        truncate_policy=KeepPinned(),
+        deadline=Deadline(total=5),
+        hedge_policy=HedgePolicy(),
+    )
+    chatbot.add_to_conversation("hello", "user")
+    chatbot.save(config)
+    saved = json.loads(config.read_text())
+    assert not Chatbot.UNSAVED_KEYS & set(saved)
+    assert saved["temperature"] == 0.2
+    assert saved["conversation"]["default"][-1] == {"role": "user", "content": "hello"}
+
+    other = Chatbot("key", deadline=Deadline(total=1))
+    policy, deadline, transport = other.truncate_policy, other.deadline, other.transport
+    other.load(config)
+    assert other.temperature == 0.2
+    assert other.truncate_policy is policy
+    assert other.deadline is deadline
+    assert other.transport is transport
+    assert other.conversation["default"][-1]["content"] == "hello"
+    assert other.get_token_count() == chatbot.get_token_count()
@@ -0,0 +1,141 @@
+"""
+Mapping every ChatGPT web conversation to its current node
+"""
+import asyncio
+import gc
+import json
+import time
+
+import pytest
+from conftest import StubRequest
+from conftest import StubResponse
+from conftest import StubServer
+from revChatGPT import typings as t
+from revChatGPT.V1 import AsyncChatbot
+from revChatGPT.V1 import Chatbot
+
+CONVERSATIONS = [f"conversation-{index}" for index in range(7)]
+# Seconds each history takes, so serial fetches would take CONVERSATIONS times longer
+HISTORY_DELAY = 0.3
+
+
+@pytest.fixture
+def backend(stub_server: StubServer) -> StubServer:
+    """
+    stub_server serving pages of conversations and their slow histories
+    """
+
+    def conversations(request: StubRequest) -> StubResponse:
+        offset = int(request.query["offset"])
+        limit = int(request.query["limit"])
+        items = [{"id": cid} for cid in CONVERSATIONS[offset : offset + limit]]
+        return StubResponse(chunks=[json.dumps({"items": items}).encode()])
+
+    def history(cid: str) -> StubResponse:
+        body = json.dumps({"current_node": f"{cid}-node"}).encode()
+        return StubResponse(chunks=[HISTORY_DELAY, body])
+
+    stub_server.routes["/backend-api/conversations"] = conversations
+    for cid in CONVERSATIONS:
+        stub_server.routes[
+            f"/backend-api/conversation/{cid}"
+        ] = lambda request, cid=cid: history(cid)
+    return stub_server
+
+
+def requested_offsets(backend: StubServer) -> list[str]:
+    return [
+        request.query["offset"]
+        for request in backend.requests
+        if request.path == "/backend-api/conversations"
+    ]
+
+
+def test_map_all_pages_concurrently(backend: StubServer) -> None:
+    chatbot = Chatbot(
+        {"access_token": "token"},
+        base_url=f"{backend.url}/backend-api/",
+        lazy_loading=False,
+    )
+    started = time.perf_counter()
+    chatbot._Chatbot__map_conversations(page_size=3)
+    elapsed = time.perf_counter() - started
+    assert requested_offsets(backend) == ["0", "3", "6"]
+    assert chatbot.conversation_mapping == {cid: f"{cid}-node" for cid in CONVERSATIONS}
+    assert elapsed < HISTORY_DELAY * len(CONVERSATIONS) / 2
+
+
+def test_map_all_pages_concurrently_async(backend: StubServer) -> None:
+    async def main() -> float:
+        chatbot = AsyncChatbot(
+            {"access_token": "token"},
+            base_url=f"{backend.url}/backend-api/",
+            lazy_loading=False,
+        )
+        try:
+            started = time.perf_counter()
+            await chatbot._AsyncChatbot__map_conversations(page_size=3)
+            elapsed = time.perf_counter() - started
+        finally:
+            await chatbot.session.aclose()
+        assert chatbot.conversation_mapping == {
+            cid: f"{cid}-node" for cid in CONVERSATIONS
+        }
+        return elapsed
+
+    elapsed = asyncio.run(main())
+    assert requested_offsets(backend) == ["0", "3", "6"]
+    assert elapsed < HISTORY_DELAY * len(CONVERSATIONS) / 2
+
+
+def test_first_error_cancels_pending_histories(backend: StubServer) -> None:
+    backend.routes[
+        "/backend-api/conversation/conversation-0"
+    ] = lambda request: StubResponse(500, [b"failed"])
+    chatbot = Chatbot(
+        {"access_token": "token"},
+        base_url=f"{backend.url}/backend-api/",
+        lazy_loading=False,
+    )
+    with pytest.raises(t.Error):
+        chatbot._Chatbot__map_conversations(concurrency=1, page_size=3)
+    histories = [
+        request
+        for request in backend.requests
+        if request.path.startswith("/backend-api/conversation/")
+    ]
+    # At most the history already running when the first one failed
+    assert len(histories) <= 2
+
+
+def test_failed_page_cancels_started_histories_async(backend: StubServer) -> None:
+    backend.routes["/backend-api/conversations"] = lambda request, page=backend.routes[
+        "/backend-api/conversations"
+    ]: (
+        page(request)
+        if request.query["offset"] == "0"
+        else StubResponse(500, [b"failed"])
+    )
+    unhandled = []
+
+    async def main() -> AsyncChatbot:
+        asyncio.get_running_loop().set_exception_handler(
+            lambda loop, context: unhandled.append(context),
+        )
+        chatbot = AsyncChatbot(
+            {"access_token": "token"},
+            base_url=f"{backend.url}/backend-api/",
+            lazy_loading=False,
+        )
+        try:
+            with pytest.raises(t.Error):
+                await chatbot._AsyncChatbot__map_conversations(page_size=3)
+        finally:
+            await chatbot.session.aclose()
+        gc.collect()
+        return chatbot
+
+    chatbot = asyncio.run(main())
+    # The histories of the first page were still loading
+    assert chatbot.conversation_mapping == {}
+    assert not unhandled
@@ -0,0 +1,62 @@
+"""
+Delta stream mode of the V1 chatbot
+"""
+from revChatGPT.V1 import DeltaTracker
+
+
+def record(parent_id: str, message: str, model: str = "m") -> dict:
+    return {
+        "author": {"role": "assistant"},
+        "message": message,
+        "conversation_id": "c",
+        "parent_id": parent_id,
+        "model": model,
+        "finish_details": None,
+        "end_turn": None,
+        "recipient": "all",
+        "citations": [],
+    }
+
+
+def replay(records: list[dict]) -> str:
+    """
+    The text a consumer of the deltas ends up with
+    """
+    text = ""
+    track = DeltaTracker()
+    for delta in map(track, records):
+        text = delta["message"] if delta["reset"] else text + delta["message"]
+    return text
+
+
+def test_deltas_extend_the_text() -> None:
+    track = DeltaTracker()
+    first = track(record("m1", "Hel"))
+    second = track(record("m1", "Hello"))
+    assert (first["message"], first["reset"]) == ("Hel", False)
+    assert (second["message"], second["reset"]) == ("lo", False)
+    # Unchanged metadata is left out
+    assert "model" in first and "model" not in second
+    assert "author" not in second
+
+
+def test_rewritten_text_resets() -> None:
+    track = DeltaTracker()
+    track(record("m1", "Hello wrold"))
+    delta = track(record("m1", "Hello world"))
+    assert (delta["message"], delta["reset"]) == ("Hello world", True)
+    assert replay([record("m1", "Hello wrold"), record("m1", "Hello world")]) == (
+        "Hello world"
+    )
+
+
+def test_new_message_resets() -> None:
+    records = [
+        record("m1", "Searching"),
+        record("m1", "Searching..."),
+        record("m2", "Found"),
+        record("m2", "Found it"),
+    ]
+    assert replay(records) == "Found it"
+    # The first message of a stream, e.g. a continuation, extends the text
+    assert DeltaTracker()(record("m3", "more"))["reset"] is False
@@ -0,0 +1,52 @@
+"""
+Hedged requests racing a slow stream
+"""
+import asyncio
+import time
+
+from conftest import StubRequest
+from conftest import StubResponse
+from conftest import StubServer
+from conftest import WordEncoding
+from revChatGPT.hedging import HedgePolicy
+from revChatGPT.transport import Transport
+from revChatGPT.V3 import Chatbot
+
+
+def test_policy_delay() -> None:
+    policy = HedgePolicy(percentile=99.9, min_samples=3, initial_delay=0.5)
+    assert policy.delay() == 0.5
+    for seconds in (0.01, 0.2, 0.3):
+        policy.observe(seconds)
+    assert policy.delay() == 0.3
+    assert HedgePolicy().delay() is None
+
+
+def test_hedge_wins_slow_stream(
+    completions: StubServer,
+    word_tokens: WordEncoding,
+) -> None:
+    def complete(request: StubRequest) -> StubResponse:
+        chunks = StubServer.completion(["Hello", " world"])
+        if len(completions.requests) == 1:
+            chunks.insert(1, 2.0)
+        return StubResponse(chunks=chunks)
+
+    completions.routes["/v1/chat/completions"] = complete
+    policy = HedgePolicy(initial_delay=0.1, api_key="other")
+    transport = Transport(http2=False)
+    chatbot = Chatbot("key", transport=transport, hedge_policy=policy)
+
+    async def main() -> None:
+        started = time.perf_counter()
+        assert await chatbot.ask_async("hi") == "Hello world"
+        assert time.perf_counter() - started < 1.0
+        await asyncio.sleep(0.1)
+        pool = transport.aclient._transport._pool
+        assert all(connection.is_idle() for connection in pool.connections)
+        await transport.aclose()
+
+    asyncio.run(main())
+    assert policy.stats()["fired"] == 1
+    assert policy.stats()["won"] == 1
+    assert completions.requests[1].headers["Authorization"] == "Bearer other"
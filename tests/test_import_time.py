@@ -0,0 +1,62 @@
+"""
+Startup budgets of the package and the command line interface
+"""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+SRC = Path(__file__).parents[1] / "src"
+# Loaded on first use only, never by importing the package or printing help
+HEAVY_MODULES = {
+    "httpx",
+    "requests",
+    "tiktoken",
+    "rich",
+    "prompt_toolkit",
+    "OpenAIAuth",
+}
+# Cumulative import times in microseconds, generous so slow machines pass
+PACKAGE_BUDGET = 50_000
+CLI_HELP_BUDGET = 150_000
+
+
+def import_times(*args: str) -> tuple[dict[str, int], int]:
+    """
+    Cumulative import time of every module imported by a python run, and
+    the total of the run
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, (str(SRC), env.get("PYTHONPATH"))))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+    times = {}
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        times[name.strip()] = int(cumulative)
+        # Nested imports are indented below the import that caused them
+        if not name.startswith("  "):
+            total += int(cumulative)
+    return times, total
+
+
+def test_import_package() -> None:
+    times, _ = import_times("-c", "import revChatGPT")
+    assert not HEAVY_MODULES & set(times)
+    assert times["revChatGPT"] < PACKAGE_BUDGET
+
+
+def test_cli_help() -> None:
+    times, total = import_times("-m", "revChatGPT", "--V3", "--help")
+    assert not HEAVY_MODULES & set(times)
+    assert total < CLI_HELP_BUDGET
@@ -0,0 +1,121 @@
+"""
+Latency measurements of streamed requests
+"""
+import urllib.request
+
+import pytest
+from conftest import StubRequest
+from conftest import StubResponse
+from conftest import StubServer
+from conftest import WordEncoding
+from revChatGPT import typings as t
+from revChatGPT.metrics import add_hook
+from revChatGPT.metrics import percentile
+from revChatGPT.metrics import PrometheusExporter
+from revChatGPT.metrics import remove_hook
+from revChatGPT.metrics import RequestMetrics
+from revChatGPT.V3 import Chatbot
+
+# Seconds between the response headers and the first token
+FIRST_TOKEN_DELAY = 0.2
+
+
+def test_percentile() -> None:
+    values = [5.0, 1.0, 4.0, 2.0, 3.0]
+    assert percentile([], 50) is None
+    assert percentile(values, 0) == 1.0
+    assert percentile(values, 50) == 3.0
+    assert percentile(values, 100) == 5.0
+
+
+def test_percentile_of_fractional_rank() -> None:
+    assert percentile([1, 2, 3], 99.5) == 3
+    assert percentile([1, 2, 3], 33.4) == 2
+    assert percentile(list(range(1000)), 99.9) == 998
+
+
+@pytest.fixture
+def slow_start(completions: StubServer) -> StubServer:
+    """
+    completions waiting FIRST_TOKEN_DELAY seconds after the headers
+    """
+
+    def complete(request: StubRequest) -> StubResponse:
+        return StubResponse(
+            chunks=[FIRST_TOKEN_DELAY, *StubServer.completion(["Hello", " world"])],
+            headers={"content-type": "text/event-stream"},
+            delay=0.01,
+        )
+
+    completions.routes["/v1/chat/completions"] = complete
+    return completions
+
+
+def test_hooks_and_exporter(slow_start: StubServer, word_tokens: WordEncoding) -> None:
+    measured: list[RequestMetrics] = []
+    exporter = PrometheusExporter()
+    add_hook(measured.append)
+    add_hook(exporter)
+    try:
+        assert Chatbot("key").ask("hi") == "Hello world"
+    finally:
+        remove_hook(measured.append)
+        remove_hook(exporter)
+
+    (metrics,) = measured
+    assert metrics.source == "V3"
+    assert metrics.model == "gpt-3.5-turbo"
+    assert metrics.ok
+    assert metrics.attempts == 1
+    assert metrics.tokens == 2
+    assert metrics.first_byte < FIRST_TOKEN_DELAY
+    assert metrics.first_token >= FIRST_TOKEN_DELAY
+    assert metrics.first_byte < metrics.first_token <= metrics.last_token
+    assert metrics.last_token <= metrics.finished
+    assert len(metrics.gaps) == 1
+    assert metrics.to_dict()["tokens_per_second"] == metrics.tokens_per_second
+
+    text = exporter.render()
+    labels = 'source="V3",model="gpt-3.5-turbo"'
+    assert f'revchatgpt_requests_total{{{labels},status="ok"}} 1' in text
+    assert f"revchatgpt_tokens_total{{{labels}}} 2" in text
+    assert f"revchatgpt_time_to_first_token_seconds_count{{{labels}}} 1" in text
+    assert (
+        f'revchatgpt_time_to_first_token_seconds_bucket{{{labels},le="0.1"}} 0' in text
+    )
+    assert (
+        f'revchatgpt_time_to_first_token_seconds_bucket{{{labels},le="+Inf"}} 1' in text
+    )
+    assert f"revchatgpt_inter_token_gap_seconds_count{{{labels}}} 1" in text
+
+    server = exporter.serve(port=0, host="127.0.0.1")
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/metrics"
+        with urllib.request.urlopen(url) as response:
+            assert response.read().decode() == text
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_failed_requests_are_counted(
+    completions: StubServer,
+    word_tokens: WordEncoding,
+) -> None:
+    completions.routes["/v1/chat/completions"] = lambda request: StubResponse(
+        400,
+        [b'{"error": "bad request"}'],
+    )
+    exporter = PrometheusExporter(prefix="bot")
+    add_hook(exporter)
+    try:
+        with pytest.raises(t.APIConnectionError):
+            Chatbot("key").ask("hi")
+    finally:
+        remove_hook(exporter)
+    text = exporter.render()
+    labels = 'source="V3",model="gpt-3.5-turbo"'
+    assert f'bot_requests_total{{{labels},status="APIConnectionError"}} 1' in text
+    assert f'bot_requests_total{{{labels},status="ok"}}' not in text
+    assert f"bot_tokens_total{{{labels}}} 0" in text
+    assert "bot_time_to_first_token_seconds_count" not in text
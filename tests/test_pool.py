@@ -0,0 +1,137 @@
+"""
+Spreading ChatGPT web requests over the accounts of a ChatbotPool
+"""
+from __future__ import annotations
+
+import threading
+import time
+from typing import Generator
+
+import pytest
+from revChatGPT import typings as t
+from revChatGPT import V1
+from revChatGPT.V1 import ChatbotPool
+
+
+class FakeChatbot:
+    """
+    Answers every prompt with two records of a conversation named after the
+    account and the prompt
+    """
+
+    def __init__(self, config: dict, **kwargs) -> None:
+        self.name = config["email"]
+        self.delay = config.get("delay", 0.0)
+        self.rate_limited = config.get("rate_limited", False)
+        self.closed = 0
+
+    def reset_chat(self) -> None:
+        pass
+
+    def ask(
+        self,
+        prompt: str,
+        conversation_id: str | None = None,
+        **kwargs,
+    ) -> Generator[dict, None, None]:
+        cid = conversation_id or f"{self.name}-{prompt}"
+        if self.rate_limited:
+            raise t.Error(source="fake", message="Too many requests", code=429)
+        try:
+            for message in ("Hello", "Hello world"):
+                time.sleep(self.delay)
+                yield {"message": message, "conversation_id": cid}
+        finally:
+            self.closed += 1
+
+
+@pytest.fixture
+def fake_chatbots(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(V1, "Chatbot", FakeChatbot)
+
+
+@pytest.fixture
+def pool(fake_chatbots: None) -> ChatbotPool:
+    return ChatbotPool([{"email": "a"}, {"email": "b"}])
+
+
+def test_conversations_stay_with_their_owner(pool: ChatbotPool) -> None:
+    first = list(pool.ask("hi"))
+    cid = first[-1]["conversation_id"]
+    owner = pool.owner(cid)
+    assert owner is not None
+    assert list(pool.ask("again", conversation_id=cid))[-1]["conversation_id"] == cid
+    assert pool.stats()[owner.name]["requests"] == 2
+
+
+def test_closing_early_releases_the_account(pool: ChatbotPool) -> None:
+    records = pool.ask("hi")
+    record = next(records)
+    account = pool.owner(record["conversation_id"])
+    assert account.holder == threading.get_ident()
+    assert account.in_flight == 1
+    records.close()
+    assert account.holder is None
+    assert account.in_flight == 0
+    assert account.chatbot.closed == 1
+    # The same account can serve the conversation from another thread
+    thread = threading.Thread(
+        target=lambda: list(pool.ask("more", record["conversation_id"])),
+    )
+    thread.start()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+
+def test_one_thread_interleaving_streams(pool: ChatbotPool) -> None:
+    first, second = pool.ask("one"), pool.ask("two")
+    # Round robin over two streams runs them on different accounts
+    records = [next(first), next(second), next(first), next(second)]
+    assert {record["conversation_id"] for record in records} == {"a-one", "b-two"}
+    # Every account is busy with a stream of this thread, so waiting would
+    # never end
+    with pytest.raises(t.Error) as error:
+        next(pool.ask("three"))
+    assert error.value.code == t.ErrorType.PROHIBITED_CONCURRENT_QUERY_ERROR
+    with pytest.raises(t.Error):
+        next(pool.ask("again", conversation_id="a-one"))
+    first.close()
+    second.close()
+    assert list(pool.ask("three"))[-1]["conversation_id"] == "a-three"
+
+
+def test_threads_wait_for_busy_accounts(fake_chatbots: None) -> None:
+    pool = ChatbotPool([{"email": "a", "delay": 0.02}])
+    replies = []
+
+    def ask(index: int) -> None:
+        replies.append(list(pool.ask(f"q{index}"))[-1]["message"])
+
+    threads = [threading.Thread(target=ask, args=(index,)) for index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert replies == ["Hello world"] * 4
+    stats = pool.stats()["a"]
+    assert stats["requests"] == 4
+    assert stats["in_flight"] == 0
+    assert stats["average_latency"] >= 0.04
+
+
+def test_owners_are_capped(fake_chatbots: None) -> None:
+    pool = ChatbotPool([{"email": "a"}], max_conversations=2)
+    for index in range(3):
+        list(pool.ask(f"q{index}"))
+    assert pool.owner("a-q0") is None
+    assert pool.owner("a-q1") is not None
+    assert pool.owner("a-q2") is not None
+
+
+def test_rate_limited_accounts_cool_down(fake_chatbots: None) -> None:
+    pool = ChatbotPool([{"email": "a", "rate_limited": True}, {"email": "b"}])
+    assert list(pool.ask("hi"))[-1]["conversation_id"] == "b-hi"
+    stats = pool.stats()
+    assert stats["a"]["rate_limited"] == stats["a"]["failures"] == 1
+    assert not stats["a"]["healthy"]
+    assert stats["b"]["healthy"]
@@ -0,0 +1,81 @@
+"""
+Client-side rate limits and retries of official API requests
+"""
+import pytest
+from conftest import StubRequest
+from conftest import StubResponse
+from conftest import StubServer
+from conftest import WordEncoding
+from revChatGPT.ratelimit import parse_duration
+from revChatGPT.ratelimit import RateLimiter
+from revChatGPT.ratelimit import RetryPolicy
+from revChatGPT.ratelimit import TokenBucket
+from revChatGPT.V3 import Chatbot
+
+
+@pytest.mark.parametrize(
+    ("value", "seconds"),
+    [("6m0s", 360.0), ("1.5s", 1.5), ("20ms", 0.02), ("1h2m", 3720.0), ("", None)],
+)
+def test_parse_duration(value: str, seconds: float) -> None:
+    assert parse_duration(value) == pytest.approx(seconds)
+
+
+def test_token_bucket_queues_callers() -> None:
+    bucket = TokenBucket(60)
+    assert bucket.acquire(60) == 0.0
+    # One unit per second, reserved in order
+    assert bucket.acquire(1) == pytest.approx(1, abs=0.05)
+    assert bucket.acquire(2) == pytest.approx(3, abs=0.05)
+    # Larger than the bucket waits for a full bucket at most
+    assert bucket.acquire(600) == pytest.approx(63, abs=0.05)
+
+
+def test_rate_limiter_learns_from_headers() -> None:
+    limiter = RateLimiter()
+    assert limiter.acquire(10**6) == 0.0
+    limiter.observe(
+        {
+            "x-ratelimit-limit-requests": "60",
+            "x-ratelimit-remaining-requests": "0",
+            "x-ratelimit-limit-tokens": "1000",
+            "x-ratelimit-remaining-tokens": "1000",
+        },
+    )
+    assert limiter.requests.capacity == 60
+    assert limiter.tokens.capacity == 1000
+    # No requests left: the next one waits about a second for a refill
+    delay = limiter._RateLimiter__reserve(1)
+    assert 0.9 < delay <= 1.0
+
+
+def test_retry_policy_follows_the_server() -> None:
+    policy = RetryPolicy(max_retries=2, base_delay=1, max_delay=30)
+    assert policy.get_delay(0, 429, {"retry-after-ms": "250"}) == 0.25
+    assert policy.get_delay(0, 503, {"retry-after": "3"}) == 3.0
+    reset = {"x-ratelimit-remaining-tokens": "0", "x-ratelimit-reset-tokens": "1m"}
+    # Longer than max_delay, so give up rather than wait
+    assert policy.get_delay(0, 429, reset) is None
+    assert 0.5 <= policy.get_delay(0, 500) <= 1.0
+    assert 1.0 <= policy.get_delay(1, None) <= 2.0
+    assert policy.get_delay(2, 500) is None
+    assert policy.get_delay(0, 400) is None
+
+
+def test_chatbot_retries_rate_limited_requests(
+    completions: StubServer,
+    word_tokens: WordEncoding,
+) -> None:
+    complete = completions.routes["/v1/chat/completions"]
+    attempts = []
+
+    def rate_limited(request: StubRequest) -> StubResponse:
+        attempts.append(request)
+        if len(attempts) == 1:
+            return StubResponse(429, [b"{}"], headers={"retry-after-ms": "10"})
+        return complete(request)
+
+    completions.routes["/v1/chat/completions"] = rate_limited
+    chatbot = Chatbot("key", rate_limiter=RateLimiter())
+    assert chatbot.ask("hi") == "Hello world"
+    assert len(attempts) == 2
@@ -0,0 +1,56 @@
+"""
+Encoding official API request bodies from cached message JSON
+"""
+import json
+
+import pytest
+from conftest import StubServer
+from conftest import WordEncoding
+from revChatGPT.request_body import encode_body
+from revChatGPT.request_body import encode_message
+from revChatGPT.store import Message
+from revChatGPT.V3 import Chatbot
+
+MESSAGES = [
+    Message("system", "Réponds en français"),
+    Message("user", 'quote " and \\ backslash\n', name="alice"),
+    {"role": "function", "name": "search", "content": "{}", "extra": [1, 2]},
+]
+
+
+@pytest.mark.parametrize(
+    "params",
+    [{}, {"model": "gpt-3.5-turbo", "stream": True, "temperature": 0.5, "n": 2}],
+)
+def test_body_matches_plain_json(params: dict) -> None:
+    body = {"messages": MESSAGES, **params}
+    expected = {
+        "messages": [dict(message.items()) for message in MESSAGES],
+        **params,
+    }
+    assert json.loads(encode_body(body)) == expected
+
+
+def test_messages_are_encoded_once() -> None:
+    message = Message("user", "hello")
+    encoded = encode_message(message)
+    assert message.encoded is encoded
+    assert encode_body({"messages": [message]}) == b'{"messages":[' + encoded + b"]}"
+
+
+def test_chatbot_sends_encoded_conversation(
+    completions: StubServer,
+    word_tokens: WordEncoding,
+) -> None:
+    chatbot = Chatbot("key", system_prompt="Réponds en français", temperature=0.2)
+    chatbot.ask("bonjour")
+    chatbot.ask("encore")
+    sent = completions.requests[-1].json()
+    assert sent["temperature"] == 0.2
+    assert sent["stream"] is True
+    assert [message["content"] for message in sent["messages"]] == [
+        "Réponds en français",
+        "bonjour",
+        "Hello world",
+        "encore",
+    ]
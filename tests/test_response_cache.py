@@ -0,0 +1,75 @@
+"""
+Caches of complete responses to deterministic requests
+"""
+import time
+from pathlib import Path
+
+import pytest
+from conftest import StubServer
+from conftest import WordEncoding
+from revChatGPT.response_cache import MemoryResponseCache
+from revChatGPT.response_cache import request_key
+from revChatGPT.response_cache import ResponseCache
+from revChatGPT.response_cache import SQLiteResponseCache
+from revChatGPT.V3 import Chatbot
+
+
+def test_incomplete_cache_fails_on_creation() -> None:
+    class GetOnly(ResponseCache):
+        def _get(self, key: str) -> dict:
+            return None
+
+    with pytest.raises(TypeError):
+        GetOnly(max_entries=1)
+
+
+def test_request_key_ignores_order_and_stream() -> None:
+    messages = [{"role": "user", "content": "hi"}]
+    key = request_key({"model": "m", "temperature": 0, "messages": messages})
+    assert key == request_key(
+        {"messages": messages, "stream": True, "temperature": 0, "model": "m"},
+    )
+    assert key != request_key({"model": "m", "temperature": 1, "messages": messages})
+
+
+@pytest.mark.parametrize("kind", ["memory", "sqlite"])
+def test_cache_evicts_and_expires(kind: str, tmp_path: Path) -> None:
+    if kind == "memory":
+        cache = MemoryResponseCache(max_entries=2, ttl=0.2)
+    else:
+        cache = SQLiteResponseCache(tmp_path / "cache.db", max_entries=2, ttl=0.2)
+        cache.EVICT_EVERY = 1
+    cache.set("a", {"text": "a"})
+    cache.set("b", {"text": "b"})
+    assert cache.get("a") == {"text": "a"}
+    cache.set("c", {"text": "c"})
+    # b was the least recently used
+    assert cache.get("b") is None
+    assert cache.get("c") == {"text": "c"}
+    time.sleep(0.3)
+    assert cache.get("a") is None
+    assert cache.stats() == {"hits": 2, "misses": 2, "hit_rate": 0.5}
+
+
+def test_chatbot_replays_cached_replies(
+    completions: StubServer,
+    word_tokens: WordEncoding,
+) -> None:
+    chatbot = Chatbot(
+        "key",
+        temperature=0,
+        reply_count=2,
+        response_cache=MemoryResponseCache(max_entries=8),
+    )
+    streamed = list(chatbot.ask_stream("hi", convo_id="first", all_choices=True))
+    replayed = list(chatbot.ask_stream("hi", convo_id="second", all_choices=True))
+    assert replayed == streamed
+    assert len(completions.requests) == 1
+    # The replay stores the reply and its branches like the API's stream
+    assert chatbot.conversation["second#1"] == chatbot.conversation["first#1"]
+    assert chatbot.finish_reasons["second"] == "stop"
+    assert chatbot.finish_reasons["second#1"] == "stop"
+    # Asked for, the request is sent again
+    assert chatbot.ask("hi", convo_id="third", cache=False) == "Hello world"
+    assert len(completions.requests) == 2
+    assert chatbot.response_cache.stats()["hits"] == 1
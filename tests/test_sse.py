@@ -0,0 +1,79 @@
+"""
+Decoding server-sent event streams split into arbitrary chunks
+"""
+import asyncio
+from typing import AsyncIterator
+
+from revChatGPT.sse import aiter_events
+from revChatGPT.sse import iter_events
+from revChatGPT.sse import SSEDecoder
+
+STREAM = (
+    ": keep-alive\r\n"
+    "event: delta\r\n"
+    "id: 7\r\n"
+    "retry: 1500\r\n"
+    'data: {"text": "Grüße"}\r\n'
+    "\r\n"
+    "data: first\n"
+    "data:second\n"
+    "\n"
+    "\n"
+    "data: [DONE]\n"
+    "\n"
+).encode()
+
+
+def summary(events: list) -> list[tuple]:
+    return [(event.event, event.data, event.id, event.retry) for event in events]
+
+
+EXPECTED = [
+    ("delta", '{"text": "Grüße"}', "7", 1500),
+    ("message", "first\nsecond", "7", 1500),
+    ("message", "[DONE]", "7", 1500),
+]
+
+
+def test_whole_stream() -> None:
+    events = list(iter_events([STREAM]))
+    assert summary(events) == EXPECTED
+    assert events[0].json() == {"text": "Grüße"}
+
+
+def test_every_split_point() -> None:
+    # Splits land inside CRLF pairs, field names and multi-byte characters
+    for index in range(len(STREAM) + 1):
+        chunks = [STREAM[:index], STREAM[index:]]
+        assert summary(iter_events(chunks)) == EXPECTED, index
+
+
+def test_byte_by_byte() -> None:
+    chunks = [STREAM[index : index + 1] for index in range(len(STREAM))]
+    assert summary(iter_events(chunks)) == EXPECTED
+
+
+def test_flush_dispatches_unterminated_event() -> None:
+    decoder = SSEDecoder()
+    assert decoder.feed(b"data: a\ndata: b") == []
+    assert [event.data for event in decoder.flush()] == ["a\nb"]
+    assert decoder.flush() == []
+
+
+def test_raw_lines() -> None:
+    body = b"Internal Server Error\nretry-after: 5\n"
+    assert list(iter_events([body])) == []
+    # Lines with a colon are fields of unknown names, ignored either way
+    (event,) = iter_events([body], raw_lines=True)
+    assert (event.event, event.data) == ("raw", "Internal Server Error")
+
+
+def test_aiter_events() -> None:
+    async def chunks() -> AsyncIterator[bytes]:
+        for index in range(0, len(STREAM), 5):
+            yield STREAM[index : index + 5]
+
+    async def collect() -> list:
+        return [event async for event in aiter_events(chunks())]
+
+    assert summary(asyncio.run(collect())) == EXPECTED
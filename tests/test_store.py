@@ -0,0 +1,176 @@
+"""
+Conversation stores and the message table of the official API chatbot
+"""
+import gc
+import json
+import tracemalloc
+from pathlib import Path
+
+import pytest
+from conftest import WordEncoding
+from revChatGPT.store import as_dict
+from revChatGPT.store import MemoryStore
+from revChatGPT.store import Message
+from revChatGPT.store import SQLiteStore
+from revChatGPT.V3 import Chatbot
+
+
+def fill(chatbot: Chatbot, conversations: int) -> None:
+    for index in range(conversations):
+        convo_id = f"c{index}"
+        chatbot.reset(convo_id)
+        chatbot.add_to_conversation(f"question {index}", "user", convo_id)
+        chatbot.add_to_conversation("an answer of five words", "assistant", convo_id)
+
+
+def test_sqlite_store_round_trip(tmp_path: Path, word_tokens: WordEncoding) -> None:
+    path = tmp_path / "conversations.db"
+    chatbot = Chatbot("key", conversation_store=SQLiteStore(path))
+    fill(chatbot, 3)
+    chatbot.rollback(1, "c1")
+    chatbot.conversation.close()
+
+    store = SQLiteStore(path)
+    assert set(store) == {"default", "c0", "c1", "c2"}
+    assert [message["content"] for message in store["c1"]][1:] == ["question 1"]
+    assert store["c2"][-1]["role"] == "assistant"
+    del store["c0"]
+    assert "c0" not in store
+    assert len(store) == 3
+
+
+def test_count_tokens_bulk_beyond_max_cached(
+    tmp_path: Path,
+    word_tokens: WordEncoding,
+) -> None:
+    store = SQLiteStore(tmp_path / "conversations.db", max_cached=2)
+    chatbot = Chatbot("key", conversation_store=store)
+    fill(chatbot, 6)
+    counts = chatbot.count_tokens_bulk()
+    assert set(counts) == {"default"} | {f"c{index}" for index in range(6)}
+    for convo_id, count in counts.items():
+        assert count["tokens"] == chatbot.get_token_count(convo_id)
+    # Counted again from the stored token counts
+    assert chatbot.count_tokens_bulk() == counts
+
+
+def test_sqlite_store_clear(tmp_path: Path, word_tokens: WordEncoding) -> None:
+    store = SQLiteStore(tmp_path / "conversations.db", max_cached=2)
+    chatbot = Chatbot("key", conversation_store=store)
+    fill(chatbot, 20)
+    statements = []
+    store._SQLiteStore__db.set_trace_callback(statements.append)
+    store.clear()
+    # One statement per table, no conversation is loaded
+    assert not any(statement.startswith("SELECT") for statement in statements)
+    assert sum(statement.startswith("DELETE") for statement in statements) == 2
+    assert len(store) == 0
+
+
+def test_load_keeps_persistent_conversations(
+    tmp_path: Path,
+    word_tokens: WordEncoding,
+) -> None:
+    config = tmp_path / "config.json"
+    config.write_text(
+        json.dumps(
+            {"conversation": {"c0": [{"role": "system", "content": "loaded"}]}},
+        ),
+    )
+    store = SQLiteStore(tmp_path / "conversations.db")
+    chatbot = Chatbot("key", conversation_store=store)
+    fill(chatbot, 2)
+    chatbot.load(config, "conversation")
+    assert set(store) == {"default", "c0", "c1"}
+    assert store["c0"] == [{"role": "system", "content": "loaded"}]
+    assert (
+        chatbot.get_token_count("c0")
+        == chatbot.count_tokens_bulk(["c0"])["c0"]["tokens"]
+    )
+
+    # In memory, the loaded conversations replace all others
+    chatbot = Chatbot("key", conversation_store=MemoryStore())
+    fill(chatbot, 2)
+    chatbot.load(config, "conversation")
+    assert set(chatbot.conversation) == {"c0"}
+
+
+def test_message_reads_like_its_dict() -> None:
+    message = Message("user", "hi", name="alice")
+    assert message == {"role": "user", "content": "hi", "name": "alice"}
+    assert dict(message) == message.to_dict() == as_dict(message)
+    assert message["name"] == "alice" and len(message) == 3
+    plain = Message("user", "hi")
+    assert "name" not in plain and plain.get("name") is None
+    with pytest.raises(KeyError):
+        plain["name"]
+    # Roles are shared strings
+    assert Message("".join(["us", "er"]), "x").role is plain.role
+    assert not hasattr(plain, "__dict__")
+
+
+def test_message_from_dict() -> None:
+    message = Message.from_dict({"role": "user", "content": "hi"})
+    assert isinstance(message, Message)
+    assert Message.from_dict(message) is message
+    # Fields the API knows but Message does not are kept as a dict
+    call = {"role": "assistant", "content": None, "function_call": {}}
+    assert Message.from_dict(call) is call
+    assert as_dict(call) is call
+
+
+def test_message_table_shares_and_releases(word_tokens: WordEncoding) -> None:
+    chatbot = Chatbot("key")
+    table = chatbot.message_table
+    fill(chatbot, 3)
+    # One system prompt and one answer shared by every conversation
+    assert len(table) == 5
+    assert chatbot.conversation["c0"][2] is chatbot.conversation["c2"][2]
+    snapshot = chatbot.snapshot(["c1"])
+    for convo_id in ("c0", "c1", "c2"):
+        del chatbot.conversation[convo_id]
+    gc.collect()
+    # Only the system prompt and what the snapshot refers to are left
+    assert len(table) == 3
+    chatbot.restore(snapshot)
+    assert chatbot.conversation["c1"][1]["content"] == "question 1"
+    assert chatbot.get_token_count("c1") > 0
+
+
+def test_memory_stays_flat_across_reset(word_tokens: WordEncoding) -> None:
+    chatbot = Chatbot("key")
+
+    def chat(rounds: int) -> None:
+        for index in range(rounds):
+            chatbot.add_to_conversation(f"question {index}", "user")
+            chatbot.add_to_conversation(f"answer {index} " * 20, "assistant")
+            chatbot.get_token_count()
+            if index % 10 == 9:
+                chatbot.rollback(2)
+                chatbot.reset()
+        gc.collect()
+
+    tracemalloc.start()
+    try:
+        chat(100)
+        before = tracemalloc.get_traced_memory()[0]
+        chat(2000)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    assert len(chatbot.message_table) == 1
+    assert after - before < 32 * 1024
+
+
+def test_memory_stays_flat_across_eviction(
+    tmp_path: Path,
+    word_tokens: WordEncoding,
+) -> None:
+    store = SQLiteStore(tmp_path / "conversations.db", max_cached=2)
+    chatbot = Chatbot("key", conversation_store=store)
+    fill(chatbot, 50)
+    chatbot.count_tokens_bulk()
+    gc.collect()
+    # The system prompt, the shared answer and the questions of the
+    # conversations still cached
+    assert len(chatbot.message_table) <= 4
@@ -0,0 +1,201 @@
+"""
+Cancellation, stop sequences and deadlines of streamed replies
+"""
+import asyncio
+import socket
+import threading
+import time
+from typing import Generator
+
+import pytest
+from conftest import StubResponse
+from conftest import StubServer
+from conftest import WordEncoding
+from revChatGPT import typings as t
+from revChatGPT.ratelimit import RetryPolicy
+from revChatGPT.streaming import CancelToken
+from revChatGPT.streaming import Deadline
+from revChatGPT.transport import Transport
+from revChatGPT.V3 import Chatbot
+
+
+def paced(words: list[str], pause: float) -> list:
+    """
+    Chunks of a completion of words, one network write per event
+    """
+    chunks = []
+    for chunk in StubServer.completion(words):
+        chunks += [chunk, pause]
+    return chunks
+
+
+def test_stop_sequence_split_across_chunks(
+    completions: StubServer,
+    word_tokens: WordEncoding,
+) -> None:
+    completions.routes["/v1/chat/completions"] = lambda request: StubResponse(
+        chunks=paced(["Hello", " world\n", "\nUser:", " more", " text"], 0.05),
+    )
+    chatbot = Chatbot("key")
+    streamed = list(chatbot.ask_stream("hi", stop=["\n\nUser:"]))
+    # The newline is held back until the next chunk shows it starts the stop
+    # sequence
+    assert streamed == ["Hello", " world"]
+    assert chatbot.finish_reasons["default"] == "stop"
+    assert chatbot.conversation["default"][-1]["content"] == "Hello world"
+
+
+def test_cancel_from_another_thread(
+    completions: StubServer,
+    word_tokens: WordEncoding,
+) -> None:
+    completions.routes["/v1/chat/completions"] = lambda request: StubResponse(
+        chunks=paced(["Hello"] + [" world"] * 20, 0.1),
+    )
+    chatbot = Chatbot("key")
+    cancel = CancelToken()
+    streamed = []
+    started = time.perf_counter()
+    for content in chatbot.ask_stream("hi", cancel=cancel):
+        streamed.append(content)
+        if len(streamed) == 1:
+            threading.Thread(target=cancel.cancel).start()
+    assert time.perf_counter() - started < 1.0
+    assert streamed[0] == "Hello"
+    assert len(streamed) < 21
+    assert chatbot.finish_reasons["default"] == "cancelled"
+    assert chatbot.conversation["default"][-1]["content"] == "".join(streamed)
+
+
+def test_aclose_keeps_the_partial_reply(
+    completions: StubServer,
+    word_tokens: WordEncoding,
+) -> None:
+    complete = completions.routes["/v1/chat/completions"]
+    completions.routes["/v1/chat/completions"] = lambda request: StubResponse(
+        chunks=paced(["Hello"] + [" world"] * 20, 0.1),
+    )
+    chatbot = Chatbot("key")
+
+    async def main() -> None:
+        stream = chatbot.ask_stream_async("hi")
+        assert await stream.__anext__() == "Hello"
+        await stream.aclose()
+        assert chatbot.finish_reasons["default"] == "cancelled"
+        assert chatbot.conversation["default"][-1]["content"] == "Hello"
+        # The conversation goes on from the partial reply
+        completions.routes["/v1/chat/completions"] = complete
+        assert await chatbot.ask_async("go on") == "Hello world"
+        await chatbot.transport.aclose()
+
+    asyncio.run(main())
+    messages = completions.requests[-1].json()["messages"]
+    assert [(message["role"], message["content"]) for message in messages[1:]] == [
+        ("user", "hi"),
+        ("assistant", "Hello"),
+        ("user", "go on"),
+    ]
+    assert chatbot.finish_reasons["default"] == "stop"
+
+
+def test_token_gap_keeps_pool_clean(
+    completions: StubServer,
+    word_tokens: WordEncoding,
+) -> None:
+    chunks = StubServer.completion(["Hello", " world"])
+    chunks.insert(2, 2.0)
+    completions.routes["/v1/chat/completions"] = lambda request: StubResponse(
+        chunks=chunks,
+    )
+    transport = Transport(http2=False)
+    chatbot = Chatbot("key", transport=transport)
+
+    async def main() -> None:
+        started = time.perf_counter()
+        with pytest.raises(t.StreamTimeoutError) as error:
+            await chatbot.ask_async("hi", deadline=Deadline(token_gap=0.2))
+        assert error.value.limit == "token_gap"
+        assert error.value.partial == "Hello"
+        assert time.perf_counter() - started < 1.0
+        # The stalled connection was closed, not left checked out
+        pool = transport.aclient._transport._pool
+        assert all(connection.is_idle() for connection in pool.connections)
+        await transport.aclose()
+
+    asyncio.run(main())
+
+
+@pytest.fixture
+def unreachable(monkeypatch: pytest.MonkeyPatch) -> Generator[None, None, None]:
+    """
+    Point the official API at a server whose connection queue is full, so
+    connecting never completes
+    """
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(0)
+    port = server.getsockname()[1]
+    queued = socket.create_connection(("127.0.0.1", port))
+    monkeypatch.setenv("API_URL", f"http://127.0.0.1:{port}/v1/chat/completions")
+    yield
+    queued.close()
+    server.close()
+
+
+def test_connect_limit(unreachable: None, word_tokens: WordEncoding) -> None:
+    chatbot = Chatbot(
+        "key",
+        retry_policy=RetryPolicy(max_retries=0),
+        deadline=Deadline(connect=0.2),
+    )
+    started = time.perf_counter()
+    with pytest.raises(t.StreamTimeoutError) as error:
+        chatbot.ask("hi")
+    assert error.value.limit == "connect"
+    assert error.value.partial == ""
+    assert time.perf_counter() - started < 1.0
+
+
+def test_first_token_limit(completions: StubServer, word_tokens: WordEncoding) -> None:
+    chunks = StubServer.completion(["Hello", " world"])
+    completions.routes["/v1/chat/completions"] = lambda request: StubResponse(
+        chunks=[2.0, *chunks],
+    )
+    chatbot = Chatbot("key", deadline=Deadline(first_token=0.2))
+    started = time.perf_counter()
+    with pytest.raises(t.StreamTimeoutError) as error:
+        chatbot.ask("hi")
+    assert error.value.limit == "first_token"
+    assert error.value.partial == ""
+    assert time.perf_counter() - started < 1.0
+
+    async def main() -> None:
+        started = time.perf_counter()
+        with pytest.raises(t.StreamTimeoutError) as error:
+            # Streams of ask_async tell the first token from the next ones
+            await chatbot.ask_async(
+                "hi",
+                deadline=Deadline(first_token=0.2, token_gap=5),
+            )
+        assert error.value.limit == "first_token"
+        assert time.perf_counter() - started < 1.0
+        await chatbot.transport.aclose()
+
+    asyncio.run(main())
+
+
+def test_total_limit(completions: StubServer, word_tokens: WordEncoding) -> None:
+    words = ["Hello"] + [" world"] * 20
+    completions.routes["/v1/chat/completions"] = lambda request: StubResponse(
+        chunks=paced(words, 0.1),
+    )
+    chatbot = Chatbot("key")
+    started = time.perf_counter()
+    with pytest.raises(t.StreamTimeoutError) as error:
+        # Every token arrives well within the token gap
+        chatbot.ask("hi", deadline=Deadline(token_gap=1.0, total=0.5))
+    elapsed = time.perf_counter() - started
+    assert error.value.limit == "total"
+    assert error.value.partial.startswith("Hello world")
+    assert error.value.partial != "".join(words)
+    assert 0.5 <= elapsed < 1.0
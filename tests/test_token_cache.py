@@ -0,0 +1,119 @@
+"""
+Access tokens shared by processes through one cache file
+"""
+import base64
+import json
+import multiprocessing
+import threading
+import time
+from pathlib import Path
+
+from revChatGPT.token_cache import TokenCache
+
+WRITERS = 4
+TOKENS_PER_WRITER = 25
+
+
+def fake_jwt(name: str) -> str:
+    payload = json.dumps({"exp": 4102444800, "sub": name}).encode()
+    encoded = base64.urlsafe_b64encode(payload).rstrip(b"=").decode()
+    return f"header.{encoded}.signature"
+
+
+def write_tokens(path: str, writer: int) -> None:
+    """
+    Cache tokens of accounts of one writer, each through a fresh cache as
+    separate processes would
+    """
+    for index in range(TOKENS_PER_WRITER):
+        email = f"{writer}-{index}@example.com"
+        TokenCache(path).set(email, fake_jwt(email))
+
+
+def rewrite_tokens(path: str, rounds: int) -> None:
+    """
+    Keep replacing the tokens of every account
+    """
+    cache = TokenCache(path)
+    for turn in range(rounds):
+        for index in range(10):
+            cache.set(f"{index}@example.com", fake_jwt(f"{index}-{turn}"))
+
+
+def assert_all_written(path: Path) -> None:
+    data = json.loads(path.read_text())
+    emails = {
+        f"{writer}-{index}@example.com"
+        for writer in range(WRITERS)
+        for index in range(TOKENS_PER_WRITER)
+    }
+    assert set(data["access_tokens"]) == emails
+    assert set(data["access_token_expiry"]) == emails
+    cache = TokenCache(path)
+    for email in emails:
+        assert cache.get(email).access_token == fake_jwt(email)
+
+
+def test_concurrent_processes_keep_every_token(tmp_path: Path) -> None:
+    path = tmp_path / "cache.json"
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=write_tokens, args=(str(path), writer))
+        for writer in range(WRITERS)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+    assert_all_written(path)
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_concurrent_threads_keep_every_token(tmp_path: Path) -> None:
+    path = tmp_path / "cache.json"
+    threads = [
+        threading.Thread(target=write_tokens, args=(str(path), writer))
+        for writer in range(WRITERS)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=60)
+    assert_all_written(path)
+
+
+def test_readers_never_see_a_torn_file(tmp_path: Path) -> None:
+    path = tmp_path / "cache.json"
+    rounds = 40
+    valid = {
+        f"{index}@example.com": {
+            fake_jwt(f"{index}-{turn}") for turn in range(-1, rounds)
+        }
+        for index in range(10)
+    }
+    cache = TokenCache(path)
+    for index in range(10):
+        cache.set(f"{index}@example.com", fake_jwt(f"{index}--1"))
+
+    context = multiprocessing.get_context("spawn")
+    writer = context.Process(target=rewrite_tokens, args=(str(path), rounds))
+    writer.start()
+    reads = 0
+    deadline = time.monotonic() + 60
+    while writer.is_alive() and time.monotonic() < deadline:
+        # The file itself is always complete JSON
+        data = json.loads(path.read_text())
+        assert len(data["access_tokens"]) == 10
+        for email, tokens in valid.items():
+            entry = cache.get(email)
+            assert entry is not None
+            assert entry.access_token in tokens
+            assert entry.expires_at == 4102444800
+        reads += 1
+    writer.join(timeout=60)
+    assert writer.exitcode == 0
+    assert reads > 0
+    for index in range(10):
+        email = f"{index}@example.com"
+        assert cache.get(email).access_token == fake_jwt(f"{index}-{rounds - 1}")
@@ -0,0 +1,60 @@
+"""
+Counting the tokens of many conversations at once
+"""
+from conftest import WordEncoding
+from revChatGPT.V3 import Chatbot
+
+CONVERSATIONS = {
+    "a": [("user", "Hello there"), ("assistant", "Hi, how can I help?")],
+    "b": [("user", "Hello there"), ("assistant", "General Kenobi")],
+    "c": [],
+}
+
+
+def message_tokens(role: str, content: str) -> int:
+    """
+    Tokens of a message as the API counts them, with words as tokens
+    """
+    return 5 + len(role.split()) + len(content.split())
+
+
+def make_chatbot() -> Chatbot:
+    chatbot = Chatbot("key", system_prompt="You are a helpful bot")
+    for convo_id, messages in CONVERSATIONS.items():
+        chatbot.reset(convo_id)
+        for role, content in messages:
+            chatbot.add_to_conversation(content, role, convo_id)
+    return chatbot
+
+
+def test_bulk_counts_match_the_messages(word_tokens: WordEncoding) -> None:
+    chatbot = make_chatbot()
+    counts = chatbot.count_tokens_bulk()
+    assert set(counts) == {"default", *CONVERSATIONS}
+    for convo_id, messages in CONVERSATIONS.items():
+        expected = sum(
+            message_tokens(role, content)
+            for role, content in [("system", "You are a helpful bot"), *messages]
+        )
+        # every reply is primed with <im_start>assistant
+        expected += 5
+        assert counts[convo_id]["tokens"] == expected
+        assert counts[convo_id]["cost"] == chatbot.get_cost(expected)
+    # Counting one conversation at a time gives the same totals
+    single = make_chatbot()
+    for convo_id in CONVERSATIONS:
+        assert single.get_token_count(convo_id) == counts[convo_id]["tokens"]
+
+
+def test_bulk_counts_follow_changes(word_tokens: WordEncoding) -> None:
+    chatbot = make_chatbot()
+    before = chatbot.count_tokens_bulk(["a", "c"])
+    assert set(before) == {"a", "c"}
+    chatbot.add_to_conversation("Tell me a joke", "user", "a")
+    after = chatbot.count_tokens_bulk(["a", "c"])
+    assert after["a"]["tokens"] == before["a"]["tokens"] + message_tokens(
+        "user",
+        "Tell me a joke",
+    )
+    assert after["c"] == before["c"]
+    assert chatbot.get_token_count("a") == after["a"]["tokens"]
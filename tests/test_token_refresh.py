@@ -0,0 +1,47 @@
+"""
+Renewing the access token of the ChatGPT web chatbot in the background
+"""
+import asyncio
+import base64
+import json
+import threading
+import time
+
+from revChatGPT.V1 import AsyncChatbot
+
+
+def fake_jwt(expires_in: float) -> str:
+    payload = json.dumps({"exp": int(time.time() + expires_in)}).encode()
+    encoded = base64.urlsafe_b64encode(payload).rstrip(b"=").decode()
+    return f"header.{encoded}.signature"
+
+
+def refresh_threads() -> list[threading.Thread]:
+    return [
+        thread
+        for thread in threading.enumerate()
+        if thread.name == "revChatGPT-token-refresh"
+    ]
+
+
+def test_async_chatbot_refreshes_on_the_event_loop() -> None:
+    async def main() -> None:
+        chatbot = AsyncChatbot(
+            {
+                "email": "user@example.com",
+                "password": "password",
+                "access_token": fake_jwt(3600),
+            },
+            auto_refresh=True,
+        )
+        try:
+            assert not refresh_threads()
+            task = chatbot.token_refresher.start_async()
+            # Started once the async session was set up, not on each call
+            assert task is chatbot.token_refresher.start_async()
+            assert not task.done()
+        finally:
+            chatbot.token_refresher.stop()
+            await chatbot.session.aclose()
+
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+"""
+Process-wide tiktoken encoders
+"""
+import hashlib
+import logging
+import socket
+import threading
+from pathlib import Path
+
+import pytest
+import tiktoken
+import tiktoken.load
+from revChatGPT import tokenizer
+
+
+class FakeEncoding:
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+
+@pytest.fixture
+def loads(monkeypatch: pytest.MonkeyPatch) -> list[str]:
+    """
+    Encoding names loaded from tiktoken, which hands out fake encodings
+    """
+    loaded = []
+
+    def get_encoding(name: str) -> FakeEncoding:
+        loaded.append(name)
+        return FakeEncoding(name)
+
+    monkeypatch.setattr(tokenizer, "_encodings", {})
+    monkeypatch.setattr(tiktoken, "get_encoding", get_encoding)
+    return loaded
+
+
+def test_one_encoding_per_model(loads: list[str]) -> None:
+    encodings = []
+    threads = [
+        threading.Thread(
+            target=lambda: encodings.append(tokenizer.get_encoding("gpt-4")),
+        )
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert loads == ["cl100k_base"]
+    assert all(encoding is encodings[0] for encoding in encodings)
+    assert tokenizer.get_encoding("gpt-4") is encodings[0]
+    assert tokenizer.get_encoding("gpt-3.5-turbo").name == "cl100k_base"
+    assert loads == ["cl100k_base", "cl100k_base"]
+
+
+def test_encoding_names() -> None:
+    assert tokenizer.get_encoding_name("gpt-4-32k") == "cl100k_base"
+    assert tokenizer.get_encoding_name("gpt-3.5-turbo-0613") == "cl100k_base"
+    with pytest.raises(NotImplementedError):
+        tokenizer.get_encoding_name("no-such-model")
+
+
+def test_warm_up(loads: list[str], caplog: pytest.LogCaptureFixture) -> None:
+    thread = tokenizer.warm_up(["gpt-4", "no-such-model", "gpt-3.5-turbo"])
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert thread.daemon
+    assert loads == ["cl100k_base", "cl100k_base"]
+    assert "no-such-model" in caplog.text
+    # Loaded encoders are not loaded again
+    with caplog.at_level(logging.WARNING):
+        assert tokenizer.warm_up(["gpt-4"], background=False) is None
+    assert len(loads) == 2
+
+
+@pytest.fixture
+def offline(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """
+    A BPE file of cl100k_base, to be used offline without any network
+    """
+
+    def connect(*args, **kwargs) -> None:
+        raise AssertionError("network access")
+
+    monkeypatch.setattr(socket, "getaddrinfo", connect)
+    monkeypatch.setattr(socket.socket, "connect", connect)
+    monkeypatch.setattr(tokenizer, "_offline_dir", None)
+    monkeypatch.delenv("TIKTOKEN_CACHE_DIR", raising=False)
+    bpe_file = tmp_path / "cl100k_base.tiktoken"
+    bpe_file.write_bytes(b"SGVsbG8= 0\n")
+    return bpe_file
+
+
+def test_set_offline_uses_the_local_file(
+    tmp_path: Path,
+    offline: Path,
+    loads: list[str],
+) -> None:
+    cache_dir = tmp_path / "cache"
+    tokenizer.set_offline(cache_dir, {"cl100k_base": offline})
+    url = tokenizer.BPE_URLS["cl100k_base"]
+    cached = cache_dir / hashlib.sha1(url.encode()).hexdigest()
+    assert cached.read_bytes() == offline.read_bytes()
+    # tiktoken finds the file in the cache instead of fetching it
+    assert tiktoken.load.read_file_cached(url) == offline.read_bytes()
+    assert tiktoken.load.load_tiktoken_bpe(url) == {b"Hello": 0}
+    assert tokenizer.get_encoding("gpt-4").name == "cl100k_base"
+
+
+def test_set_offline_never_fetches(tmp_path: Path, offline: Path) -> None:
+    with pytest.raises(NotImplementedError):
+        tokenizer.set_offline(tmp_path, {"gpt2": offline})
+    tokenizer.set_offline(tmp_path, {"cl100k_base": offline})
+    with pytest.raises(FileNotFoundError, match="p50k_base"):
+        tokenizer.get_encoding("text-davinci-003")
+    assert "text-davinci-003" not in tokenizer._encodings
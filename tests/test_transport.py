@@ -0,0 +1,51 @@
+"""
+Shared HTTP clients of the official API
+"""
+import asyncio
+
+from conftest import StubResponse
+from conftest import StubServer
+from revChatGPT.transport import Transport
+
+
+def test_clients_take_proxy() -> None:
+    transport = Transport(proxy="socks5h://127.0.0.1:1080", http2=False)
+    assert transport.proxy == "socks5://127.0.0.1:1080"
+    assert transport.client is transport.client
+    transport.close()
+
+
+def test_aclose_closes_loop_client() -> None:
+    transport = Transport(http2=False)
+
+    async def main() -> None:
+        aclient = transport.aclient
+        assert transport.aclient is aclient
+        await transport.aclose()
+        assert aclient.is_closed
+        assert transport.aclient is not aclient
+        await transport.aclose()
+
+    asyncio.run(main())
+
+
+def test_clients_of_ended_loops_are_dropped(stub_server: StubServer) -> None:
+    stub_server.routes["/"] = lambda request: StubResponse(chunks=[b"ok"])
+    transport = Transport(http2=False)
+    aclients = transport._Transport__aclients
+
+    async def get() -> None:
+        response = await transport.aclient.get(stub_server.url)
+        assert response.text == "ok"
+
+    # The kept-alive connection holds on to the ended loop
+    asyncio.run(get())
+    assert len(aclients) == 1
+
+    async def get_and_close() -> None:
+        await get()
+        assert len(aclients) == 1
+        await transport.aclose()
+
+    asyncio.run(get_and_close())
+    assert len(aclients) == 0
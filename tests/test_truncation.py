@@ -0,0 +1,65 @@
+"""
+Truncating official API conversations to their token limit
+"""
+import pytest
+from conftest import StubServer
+from conftest import WordEncoding
+from revChatGPT.V3 import Chatbot
+from revChatGPT.V3 import DropMiddle
+from revChatGPT.V3 import KeepNewest
+from revChatGPT.V3 import KeepPinned
+from revChatGPT.V3 import TruncationPolicy
+
+MESSAGES = [
+    {"role": "system", "content": "prompt"},
+    {"role": "user", "content": "first"},
+    {"role": "system", "content": "search results"},
+    {"role": "assistant", "content": "answer"},
+    {"role": "user", "content": "second"},
+    {"role": "assistant", "content": "answer"},
+]
+SIZES = [10, 4, 6, 3, 5, 2]
+
+
+@pytest.mark.parametrize(
+    ("policy", "excess", "drop"),
+    [
+        (KeepNewest(), 0, []),
+        (KeepNewest(), 4, [1]),
+        (KeepNewest(), 5, [1, 2]),
+        (KeepNewest(), 100, [1, 2, 3, 4, 5]),
+        (KeepPinned(), 8, [1, 3, 4]),
+        (KeepPinned(lambda message: message["content"] == "first"), 6, [2]),
+        (DropMiddle(), 9, [2, 3]),
+        (DropMiddle(keep_head=2), 4, [3, 4]),
+    ],
+)
+def test_plan(policy: TruncationPolicy, excess: int, drop: list[int]) -> None:
+    assert policy.plan(MESSAGES, SIZES, excess) == drop
+
+
+@pytest.mark.parametrize("policy", [KeepNewest(), KeepPinned(), DropMiddle()])
+def test_requests_fit_the_limit(
+    policy: TruncationPolicy,
+    completions: StubServer,
+    word_tokens: WordEncoding,
+) -> None:
+    chatbot = Chatbot(
+        "key",
+        system_prompt="system prompt",
+        truncate_limit=60,
+        truncate_policy=policy,
+        check_token_count=True,
+    )
+    for index in range(10):
+        chatbot.ask(f"question {index} with some padding words")
+        sent = completions.requests[-1].json()["messages"]
+        assert sent[0] == {"role": "system", "content": "system prompt"}
+        assert sent[-1]["content"] == f"question {index} with some padding words"
+        # The ledger still matches a recount after each truncation
+        assert chatbot.get_token_count() > 0
+    if isinstance(policy, DropMiddle):
+        assert sent[1]["content"] == "question 0 with some padding words"
+    # Words plus 5 per message, 1 per role and 5 for the reply
+    tokens = sum(len(message["content"].split()) + 6 for message in sent) + 5
+    assert tokens <= 60